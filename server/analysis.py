@@ -3,6 +3,7 @@ import pylab as plt
 import seaborn as sns
 from seaborn import xkcd_rgb as xkcd
 from mathtools.fit import Fit
+from projection import projections
 from scipy.signal import resample
 from database import *
 from models import *
@@ -56,16 +57,15 @@ class FeatureExtractor(object):
         m = np.cumsum(metric)
         mx = np.linspace(0,1,len(m))
         
-        fit = Fit(mx, nb_bases=25, reg_coefs=[0,1e-3,1e-3])
-        ft = fit.fit(m)
-
-        # Extract the derivatives.
-        dy = ft.dy
-        d2y = ft.d2y
+        # Extract the derivatives (the grid never changes; see projection.py).
+        dy = projections.fit(mx, m, nb_bases=25, reg_coefs=[0,1e-3,1e-3],\
+                output='dy')
+        d2y = projections.fit(mx, m, nb_bases=25, reg_coefs=[0,1e-3,1e-3],\
+                output='d2y')
      
         # Find the break in the curve (where curvature, i.e. second derivative
         # is the highest.
-        winner = np.argmax(abs(ft.d2y))
+        winner = np.argmax(abs(d2y))
         depth = depths[winner]
 
         idx = np.nonzero(self.v>depth)[0] 
@@ -162,9 +162,8 @@ class FeatureExtractor(object):
         self.residuals = []
         for pulse in self.pulses:
             gx = np.linspace(0,1,len(self.golden_pulse))
-            smooth_fit = Fit(gx, nb_bases=10, reg_coefs=[0,1e-2,1e-1])
-            pfit = smooth_fit.fit(1.0*pulse)
-            resid = pulse - pfit.y
+            resid = pulse - projections.fit(gx, 1.0*pulse, nb_bases=10,\
+                    reg_coefs=[0,1e-2,1e-1])
             resid -= resid.mean()
             resid /= resid.std()
             self.residuals.append(resid)
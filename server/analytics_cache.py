@@ -0,0 +1,162 @@
+'''Cache heart rate and pulse metrics so stream polls need not recompute them.'''
+import threading
+import logging
+import numpy as np
+from buffers import TrailingWindow
+from lru import LRU
+from processor import estimate_bpm, golden_representation
+from projection import projections
+
+
+# Analyses look at data within this many seconds of the current time.
+ANALYSIS_HALF_WIDTH = 20
+
+# Playback analyses are centred on multiples of this fraction of the half
+# width, so nearby polls share them.
+PLAYBACK_RESOLUTION = 0.1
+
+
+class RollingAnalytics(object):
+    '''BPM and pulse metric over the trailing window of one time series.
+    -----
+        Only the last few tens of seconds of the series are kept, in a
+        TrailingWindow. Each update asks the series for segments completed
+        since the last one we saw; if there are none, the cached values
+        stand. Otherwise the new samples are appended and the analysis is
+        rerun on the window (and only on the window). The current time is
+        the middle of the newest segment, as it always was for /stream.
+        After a long gap between updates, only the segments that fit in
+        the window are read; catching up costs a window, not the gap.
+    '''
+
+    def __init__(self, half_width=ANALYSIS_HALF_WIDTH):
+        self.half_width = half_width
+        self.window = None # sized once we know the sampling rate.
+        self.nb_segments = None # segments that fill the window.
+        self.last_seq = None
+        self.t_cur = -1
+        self.bpm = 0
+        self.metric = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+
+
+    def update(self, series):
+        '''Catch up with new segments; recompute if there were any.'''
+        with self.lock:
+            if self.last_seq is None:
+                self.start(series)
+            latest = series.model['segment_counter'] - 1
+            self.last_seq = max(self.last_seq, latest - self.nb_segments)
+            segments = series.segments_after(self.last_seq)
+            if len(segments) == 0:
+                return False
+            for seq, t, v in segments:
+                self.window.append(t, v)
+            self.last_seq = segments[-1][0]
+            self.t_cur = np.mean(segments[-1][1])
+            self.compute()
+            return True
+
+
+    def start(self, series):
+        '''Size the window; skip history we will never look at.'''
+        dt, fs = series.mean_sampling_rate()
+        size = series.model['segment_size']
+        if fs > 0:
+            nb_samples = int(2 * self.half_width * fs) + 2 * size
+            nb_segments = int(np.ceil(nb_samples / size))
+        else:
+            nb_samples, nb_segments = 2**16, 0
+        self.window = TrailingWindow(nb_samples)
+        self.nb_segments = int(np.ceil(nb_samples / size))
+        self.last_seq = series.model['segment_counter'] - nb_segments - 1
+
+
+    def compute(self):
+        '''Rerun the analyses on the window around the current time.'''
+        t, v = self.window.arrays()
+        lo = np.searchsorted(t, self.t_cur - self.half_width, side='left')
+        hi = np.searchsorted(t, self.t_cur + self.half_width, side='right')
+        self.bpm, self.metric = analyze(t[lo:hi], v[lo:hi],\
+                default=(self.bpm, self.metric))
+
+
+    @property
+    def values(self):
+        '''The latest (bpm, metric).'''
+        return self.bpm, self.metric
+
+
+class AnalyticsCache(object):
+    '''Per-series rolling analytics, plus memoized analyses for playback.
+    -----
+        Live views (the client asking for the latest data) are served from
+        a RollingAnalytics per series. Playback asks about arbitrary times;
+        those results are remembered, keyed by series and time (rounded to
+        PLAYBACK_RESOLUTION of the half width, so that successive polls,
+        each centred a little further on, hit the cache). Windows that
+        lie entirely within written data can never change, so they are
+        cached for good; windows reaching past the end of the series are
+        also keyed by the segment count, so they refresh as data arrives.
+    '''
+
+    def __init__(self, capacity=64, playback_capacity=1024,\
+            half_width=ANALYSIS_HALF_WIDTH):
+        self.half_width = half_width
+        self.rolling = LRU(capacity)
+        self.playback = LRU(playback_capacity)
+        self.lock = threading.Lock()
+
+
+    def live(self, series):
+        '''Current (bpm, metric) for a series; recomputed only on new data.
+           A series being recorded knows its own heart rate, beat by beat
+           (see beats.py); that wins over the windowed estimate.'''
+        with self.lock:
+            rolling = self.rolling.get(series._id)
+            if rolling is None:
+                rolling = RollingAnalytics(self.half_width)
+                self.rolling.put(series._id, rolling)
+        rolling.update(series)
+        bpm, metric = rolling.values
+        return (series.bpm or bpm), metric
+
+
+    def around(self, series, t_cur):
+        '''(bpm, metric) for the window around (about) t_cur, memoized.'''
+        step = PLAYBACK_RESOLUTION * self.half_width
+        t_cur = float(np.round(t_cur / step) * step)
+        key = (series._id, t_cur)
+        max_time = series.stats['max_time']
+        if (max_time is None) or (t_cur + self.half_width > max_time):
+            key += (series.model['segment_counter'],)
+        values = self.playback.get(key)
+        if values is None:
+            t, v = series.range_array(t_cur - self.half_width,\
+                    t_cur + self.half_width)
+            values = analyze(t, v)
+            self.playback.put(key, values)
+        return values
+
+
+    @property
+    def stats(self):
+        '''Cache health.'''
+        return {'rolling': self.rolling.stats,\
+                'playback': self.playback.stats,\
+                'projections': projections.stats}
+
+
+def analyze(t, v, default=(0, 0)):
+    '''Estimate (bpm, metric) for a stretch of data; default when there
+       aren't enough (good) pulses to go on. RollingAnalytics passes its
+       previous values as the default, so they stand.'''
+    try:
+        bpm = estimate_bpm(t, v)
+        _, _, _, metric = golden_representation(t, v)
+    except (IndexError, ValueError) as error: # too few peaks or pulses.
+        logging.getLogger(__name__).warning(' > Could not analyze {:d}'\
+                ' samples ({}); using {}.'.format(len(t), error, default))
+        return default
+    return bpm, metric
@@ -0,0 +1,195 @@
+'''Detect heart beats as samples arrive, and keep a running heart rate.
+-----
+    find_peaks looks back over a window of data; BeatDetector applies the
+    same rules as the data come in. Samples above a threshold belong to a
+    pulse, and samples above it no more than CLUSTER_GAP samples apart
+    belong to the same one; the highest sample of a pulse is its beat. A
+    pulse is finished once CLUSTER_GAP samples have gone by below the
+    threshold, so a beat is known about a tenth of a second after the fact.
+
+    The threshold is find_peaks' (see sig_proc.peak_threshold), over the
+    last THRESHOLD_WINDOW seconds, recomputed every half window: the
+    windows scan_for_peaks would look at, but only ever looking back. A beat
+    closer than the refractory period to the one before is the same beat
+    seen twice, as scan_for_peaks would have it; the taller one stands. So
+    each beat is confirmed once the refractory period has passed.
+
+    Work per block of samples is a handful of vectorized passes, plus a
+    sort of the window twice a window; the heart rate is the median beat
+    interval over the last BPM_WINDOW seconds, updated with each beat.
+'''
+import numpy as np
+from sig_proc import peak_threshold, run_argmax
+
+
+# Samples above threshold this close (or closer) are one pulse.
+CLUSTER_GAP = 50
+
+# Seconds of data the threshold is set from.
+THRESHOLD_WINDOW = 3.0
+
+# Shortest beat interval (s), and the fraction of the typical interval
+# inside which a second beat is really the first seen twice.
+REFRACTORY = 0.25
+REFRACTORY_FRACTION = 0.5
+
+# Seconds of beats the heart rate is taken over.
+BPM_WINDOW = 20.0
+
+
+class BeatDetector(object):
+    '''Online peak detector: push blocks of samples, get beats back.'''
+
+    def __init__(self, fs, state=None):
+        '''Set up a detector for data sampled at fs.
+        INPUTS
+            fs - float
+                Sampling rate (Hz); sizes the threshold window.
+            state - dict
+                What state returned, to carry on where that left off.
+        '''
+        self.fs = fs
+        self.window = np.zeros(max(int(THRESHOLD_WINDOW * fs), 2))
+        self.hop = len(self.window) // 2
+        self._nb_window = 0 # samples in the window so far.
+        self._since = 0 # samples since the threshold was set.
+        self.nb_seen = 0
+        self.threshold = None
+        self._open = None # [index, t, v, last index above] of a pulse.
+        self._pending = None # [t, v] of a beat inside the refractory period.
+        self.times = [] # beat times within BPM_WINDOW of the latest.
+        self.bpm = 0
+        if state:
+            self.nb_seen = state['nb_seen']
+            self.threshold = state['threshold']
+            self._open = state['open']
+            self._pending = state['pending']
+            self.times = list(state['times'])
+            self.bpm = state['bpm']
+
+
+    @property
+    def state(self):
+        '''Everything needed to resume (but the threshold window, which
+           refills); plain types, for the time series model.'''
+        return {'nb_seen': self.nb_seen, 'threshold': self.threshold,\
+                'open': self._open, 'pending': self._pending,\
+                'times': list(self.times), 'bpm': self.bpm}
+
+
+    @property
+    def refractory(self):
+        '''Beats closer together than this (s) are one beat.'''
+        if len(self.times) < 2:
+            return REFRACTORY
+        return max(REFRACTORY, REFRACTORY_FRACTION *\
+                np.median(np.diff(self.times)))
+
+
+    def push(self, t, v):
+        '''Consume samples; return beats confirmed, as (t, v, bpm).'''
+        t, v = np.asarray(t, dtype=float), np.asarray(v, dtype=float)
+        beats = []
+        start = 0
+        while start < len(v):
+            # The threshold holds until the next hop's worth of samples.
+            stop = min(len(v), start + self.hop - self._since)
+            if self.threshold is not None:
+                for candidate in self.pulses(t[start:stop], v[start:stop]):
+                    beats += self.candidate(*candidate)
+            self.remember(v[start:stop])
+            self.nb_seen += stop - start
+            start = stop
+        if len(t) > 0:
+            beats += self.confirm(t[-1])
+        return beats
+
+
+    def pulses(self, t, v):
+        '''Peaks of the pulses that end in this block, as (t, v).'''
+        found = []
+        idx = np.flatnonzero(v > self.threshold)
+        if len(idx) > 0:
+            # Runs of samples above threshold; each is a pulse, as
+            # [index, t, v, last index above].
+            position = self.nb_seen + idx
+            starts = np.append(0, np.flatnonzero(np.diff(position) >\
+                    CLUSTER_GAP) + 1)
+            peaks = run_argmax(v[idx], starts)
+            last = position[np.append(starts[1:], len(idx)) - 1]
+            runs = [[int(position[k]), float(t[idx[k]]), float(v[idx[k]]),\
+                    int(end)] for k, end in zip(peaks, last)]
+
+            # The first run may carry on the pulse left open last block:
+            # it does if it starts (not peaks) close enough to its end.
+            if self._open is not None:
+                if position[starts[0]] - self._open[3] > CLUSTER_GAP:
+                    found.append(self._open)
+                elif runs[0][2] <= self._open[2]:
+                    runs[0][:3] = self._open[:3]
+            found += runs[:-1]
+            self._open = runs[-1]
+
+        # A pulse is over once CLUSTER_GAP samples go by without it.
+        if (self._open is not None) and\
+                (self.nb_seen + len(v) - 1 - self._open[3] >= CLUSTER_GAP):
+            found.append(self._open)
+            self._open = None
+        return [(pulse[1], pulse[2]) for pulse in found]
+
+
+    def remember(self, v):
+        '''Add samples to the threshold window; reset the threshold every
+           hop samples.'''
+        size = len(self.window)
+        at = (self._nb_window + np.arange(len(v))) % size
+        self.window[at[-size:]] = v[-size:]
+        self._nb_window += len(v)
+        self._since += len(v)
+        if self._since >= self.hop:
+            self._since = 0
+            try:
+                self.threshold = float(peak_threshold(\
+                        self.window[:min(self._nb_window, size)]))
+            except (IndexError, ValueError):
+                pass # flat data; keep what we had.
+
+
+    def candidate(self, t, v):
+        '''A pulse peak: a beat, unless it is the last one seen twice.'''
+        if self._pending is None:
+            self._pending = [float(t), float(v)]
+            return []
+        if t - self._pending[0] < self.refractory:
+            if v > self._pending[1]:
+                self._pending = [float(t), float(v)]
+            return []
+        beat, self._pending = self._pending, [float(t), float(v)]
+        return [self.beat(*beat)]
+
+
+    def confirm(self, t_now):
+        '''Confirm the pending beat, once nothing can replace it.'''
+        if (self._pending is None) or\
+                (t_now - self._pending[0] < self.refractory) or\
+                (self._open is not None):
+            return []
+        beat, self._pending = self._pending, None
+        return [self.beat(*beat)]
+
+
+    def flush(self):
+        '''Confirm the pending beat now (recording has stopped). A pulse
+           still open is left out, as find_peaks leaves out the last.'''
+        if self._pending is None:
+            return []
+        beat, self._pending = self._pending, None
+        return [self.beat(*beat)]
+
+
+    def beat(self, t, v):
+        '''Record a beat; update the heart rate, and give both.'''
+        self.times = [s for s in self.times if s > t - BPM_WINDOW] + [t]
+        if len(self.times) > 1:
+            self.bpm = float(60 / np.median(np.diff(self.times)))
+        return t, v, self.bpm
@@ -0,0 +1,89 @@
+'''Check that online beat detection doesn't depend on block size; time it.
+-----
+    BeatDetector sees data in whatever blocks they are written in. Feeding
+    the same signal whole, sample by sample, in blocks of fixed sizes and
+    in random blocks must give the same beats (and heart rates), as must
+    a single pulse cut anywhere along its length. Beats are also compared
+    with scan_for_peaks' peaks on the whole recording.
+
+    python beats_benchmark.py --data chl_data.dat
+'''
+import argparse
+import numpy as np
+from time import time
+from mathtools.utils import Vessel
+from beats import BeatDetector
+from processor import scan_for_peaks
+
+
+def detect(t, v, fs, cuts):
+    '''Beats found when (t, v) arrive in blocks ending at cuts.'''
+    detector = BeatDetector(fs)
+    beats, start = [], 0
+    for stop in list(cuts) + [len(t)]:
+        beats += detector.push(t[start:stop], v[start:stop])
+        start = stop
+    return beats + detector.flush()
+
+
+def random_cuts(nb_samples, max_block, seed=0):
+    '''Block ends for blocks of 1 to max_block samples.'''
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, max_block + 1, size=nb_samples)
+    cuts = np.cumsum(sizes)
+    return cuts[cuts < nb_samples]
+
+
+def one_pulse(fs=500.0, seed=0):
+    '''Two flat seconds, then a pulse 0.4 s long that crosses the threshold
+       at once and peaks 0.3 s later; then flat again. Slightly noisy.
+       Gives t, v, fs and the index the pulse starts at.'''
+    rng = np.random.default_rng(seed)
+    v = np.concatenate([np.zeros(int(2 * fs)), np.linspace(0.6, 1, 151),\
+            np.linspace(1, 0.6, 50)[1:], np.zeros(int(2.6 * fs))])
+    v += 0.01 * rng.standard_normal(len(v))
+    return np.arange(len(v)) / fs, v, fs, int(2 * fs)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='chl_data.dat')
+    args = parser.parse_args()
+    data = Vessel(args.data)
+    t, v = np.array(data.t), np.array(data.v)
+    fs = 1 / np.median(np.diff(t))
+
+    # One pulse, cut at every sample across it.
+    t_, v_, fs_, start = one_pulse()
+    whole = detect(t_, v_, fs_, [])
+    for cut in range(start - 5, start + 205):
+        assert detect(t_, v_, fs_, [cut]) == whole,\
+                'pulse cut at {:d} gives different beats'.format(cut)
+    print(' > one pulse, cut anywhere: {:d} beat(s), always.'.format(
+            len(whole)))
+
+    # Recorded data, in blocks of many sizes.
+    whole = detect(t, v, fs, [])
+    for size in [1, 7, 64, 100, 333, 800, 1000, 4096]:
+        assert detect(t, v, fs, range(size, len(t), size)) == whole,\
+                'blocks of {:d} give different beats'.format(size)
+    for seed in range(10):
+        assert detect(t, v, fs, random_cuts(len(t), 1000, seed)) == whole,\
+                'random blocks (seed {:d}) give different beats'.format(seed)
+    print(' > {:d} beats, whatever the blocks.'.format(len(whole)))
+
+    # Against the batch scan.
+    peaks = t[scan_for_peaks(t, v)]
+    times = np.array([beat[0] for beat in whole])
+    near = np.min(np.abs(times[:, None] - peaks[None, :]), 1) < 0.02
+    print(' > {:d} of {:d} beats within 20 ms of {:d} scan_for_peaks peaks.'.\
+            format(near.sum(), len(times), len(peaks)))
+
+    # Time it.
+    for size in [100, 1000]:
+        start = time()
+        detect(t, v, fs, range(size, len(t), size))
+        elapsed = time() - start
+        print(' > blocks of {:4d}: {:.2f} us per sample'.format(size,\
+                1e6 * elapsed / len(t)))
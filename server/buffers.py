@@ -0,0 +1,223 @@
+'''Buffering between the serial reader and the database writer.'''
+import threading
+import logging
+import numpy as np
+from time import time
+
+
+class RingBuffer(object):
+    '''A preallocated, fixed-capacity FIFO of (timestamp, value) samples.
+    -----
+        The acquisition thread appends to the buffer; a writer thread drains
+        it. Neither side ever allocates: samples live in fixed NumPy arrays
+        and only the head/tail counters move. If the writer falls so far
+        behind that the buffer fills, incoming samples are dropped (and
+        counted) rather than blocking the serial reader.
+    '''
+
+    def __init__(self, capacity=2**16):
+        '''Allocate storage for capacity samples.'''
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.v = np.zeros(capacity)
+        self.arrival = np.zeros(capacity)
+        self.lock = threading.Lock()
+
+        # Monotonic counters; the buffer index is the counter mod capacity.
+        self._head = 0
+        self._tail = 0
+
+        # Health counters.
+        self.high_water = 0
+        self.overruns = 0
+        self.dropped = 0
+
+
+    def __len__(self):
+        return self._tail - self._head
+
+
+    def append(self, timestamps, values):
+        '''Append arrays of samples. Returns the number actually stored.'''
+        now = time()
+        with self.lock:
+            free = self.capacity - (self._tail - self._head)
+            nb_new = len(timestamps)
+            if nb_new > free:
+                # No room at the inn. Keep what fits; count what doesn't.
+                self.overruns += 1
+                self.dropped += nb_new - free
+                nb_new = free
+            if nb_new == 0:
+                return 0
+
+            # Copy in, wrapping around the end of storage if necessary.
+            start = self._tail % self.capacity
+            first = min(nb_new, self.capacity - start)
+            self.t[start:start+first] = timestamps[:first]
+            self.v[start:start+first] = values[:first]
+            self.arrival[start:start+first] = now
+            if first < nb_new:
+                rest = nb_new - first
+                self.t[:rest] = timestamps[first:nb_new]
+                self.v[:rest] = values[first:nb_new]
+                self.arrival[:rest] = now
+            self._tail += nb_new
+            self.high_water = max(self.high_water, self._tail - self._head)
+        return nb_new
+
+
+    def drain(self, max_samples=None):
+        '''Remove and return up to max_samples as (t, v, arrival) copies.'''
+        with self.lock:
+            nb_out = self._tail - self._head
+            if max_samples is not None:
+                nb_out = min(nb_out, max_samples)
+            idx = (self._head + np.arange(nb_out)) % self.capacity
+            out = (self.t[idx], self.v[idx], self.arrival[idx])
+            self._head += nb_out
+        return out
+
+
+    @property
+    def stats(self):
+        '''Report buffer health.'''
+        return {'backlog': len(self), 'capacity': self.capacity,\
+                'high_water': self.high_water, 'overruns': self.overruns,\
+                'dropped': self.dropped}
+
+
+class TrailingWindow(object):
+    '''The most recent capacity (timestamp, value) samples.
+    -----
+        Unlike a RingBuffer, nothing is ever drained and nothing is refused:
+        new samples overwrite the oldest ones. Handy for analyses that only
+        ever look at the last few seconds of a series.
+    '''
+
+    def __init__(self, capacity=2**16):
+        '''Allocate storage for capacity samples.'''
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.v = np.zeros(capacity)
+        self._tail = 0 # total samples ever appended
+
+
+    def __len__(self):
+        return min(self._tail, self.capacity)
+
+
+    def append(self, timestamps, values):
+        '''Append arrays of samples, overwriting the oldest as necessary.'''
+        nb_new = len(timestamps)
+        nb_kept = min(nb_new, self.capacity)
+        start = self._tail + nb_new - nb_kept
+        idx = (start + np.arange(nb_kept)) % self.capacity
+        self.t[idx] = timestamps[nb_new-nb_kept:]
+        self.v[idx] = values[nb_new-nb_kept:]
+        self._tail += nb_new
+
+
+    def arrays(self):
+        '''Return the window, oldest sample first, as (t, v) copies.'''
+        nb_out = len(self)
+        idx = (self._tail - nb_out + np.arange(nb_out)) % self.capacity
+        return self.t[idx], self.v[idx]
+
+
+class StorageWriter(threading.Thread):
+    '''Drain per-channel ring buffers into a stream on a dedicated thread.
+    -----
+        The stream object is the same one a BioBoard streams to: it exposes
+        channels and a time_series dictionary whose values accept
+        .extend(t, v). Segment filtering and database writes all happen
+        here, off the serial-reading thread. If the stream can commit (as a
+        SessionController can), segments completed on all channels during a
+        drain are written together, and the stream is closed on exit.
+    '''
+
+    def __init__(self, stream, capacity=2**16, batch_size=4096,\
+            interval=0.05, on_write=None):
+        '''Create buffers for each channel of the stream.
+        INPUTS
+            stream - object
+                Destination of the data (a SessionController, say).
+            capacity - int
+                Number of samples each channel buffer can hold.
+            batch_size - int
+                Maximum number of samples handed to the stream at once.
+            interval - float
+                Longest time, in seconds, the writer sleeps between drains.
+            on_write - function
+                Optional callback, on_write(channel, arrival_times), invoked
+                after each batch is written. Handy for measuring latency.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_write = on_write
+        self.buffers = {}
+        for channel in stream.channels:
+            self.buffers[channel] = RingBuffer(capacity)
+        self.go = True
+        self._wake = threading.Event()
+        self.log = logging.getLogger(__name__)
+
+        # Batch writes across channels, if the stream knows how.
+        self.bulk = hasattr(stream, 'commit')
+        if self.bulk:
+            for series in stream.time_series.values():
+                series.autocommit = False
+
+
+    def append(self, channel, timestamps, values):
+        '''Hand samples to the writer. Never touches the database.'''
+        self.buffers[channel].append(timestamps, values)
+        self._wake.set()
+
+
+    def run(self):
+        '''Drain buffers until stopped; then drain whatever is left.'''
+        try:
+            while self.go:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                self.drain()
+            self.drain()
+            if self.bulk:
+                self.stream.close() # write out partial segments, too.
+        except:
+            self.log.exception(' > Storage writer failed. Data not saved!')
+        finally:
+            if self.bulk:
+                for series in self.stream.time_series.values():
+                    series.autocommit = True
+
+
+    def drain(self):
+        '''Empty every buffer into the stream, batch by batch.'''
+        for channel, buf in self.buffers.items():
+            while len(buf) > 0:
+                t, v, arrival = buf.drain(self.batch_size)
+                self.stream.time_series[channel].extend(t, v)
+                if self.on_write:
+                    self.on_write(channel, arrival)
+        if self.bulk:
+            self.stream.commit()
+
+
+    def stop(self, wait=False):
+        '''Stop the writer after it has flushed everything it holds.'''
+        self.go = False
+        self._wake.set()
+        if wait:
+            self.join()
+
+
+    @property
+    def stats(self):
+        '''Buffer health, per channel.'''
+        return {str(channel): buf.stats for channel, buf in\
+                self.buffers.items()}
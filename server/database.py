@@ -1,6 +1,6 @@
 '''Routines for dealing with Mongo databases.'''
 import numpy as np
-from bson import ObjectId
+from bson import ObjectId, Binary
 import numpy as np
 import time
 from pymongo import MongoClient
@@ -70,6 +70,47 @@ def find_inserted_document(insertion_response, collection):
     return doc
 
 
+def pack_array(array, dtype='<f8', scale=None):
+    '''Pack an array into a single binary blob with a small dtype header.
+    INPUTS
+        array - array_like
+            The column to store.
+        dtype - string
+            Little-endian NumPy dtype to store it as (e.g. '<f8', '<f4').
+        scale - float
+            For integer dtypes: the stored value is round(array/scale).
+    '''
+    array = np.asarray(array, dtype=np.float64)
+    if scale:
+        array = np.round(array / scale)
+    packed = {}
+    packed['dtype'] = dtype
+    packed['shape'] = list(array.shape)
+    packed['data'] = Binary(np.ascontiguousarray(array, dtype=dtype).\
+            tobytes())
+    if scale:
+        packed['scale'] = scale
+    return packed
+
+
+def unpack_array(column):
+    '''Return a float64 array from a packed blob or a legacy list.'''
+    if isinstance(column, dict):
+        array = np.frombuffer(column['data'], dtype=column['dtype']).\
+                reshape(column['shape']).astype(np.float64)
+        if 'scale' in column:
+            array *= column['scale']
+        return array
+    return np.array(column, dtype=np.float64)
+
+
+def concatenate(t, v):
+    '''Stitch lists of time/value arrays together into (t, v) arrays.'''
+    if len(t) == 0:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(t), np.concatenate(v)
+
+
 def string_to_obj(string):
     return ObjectId(string)
 
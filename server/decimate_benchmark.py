@@ -0,0 +1,70 @@
+'''Benchmark display decimation (lttb, minmax) against downsample.
+-----
+    Builds a long, pulse-like signal (narrow peaks on a slow baseline, plus
+    noise), reduces it to a chart's worth of points each way, and reports
+    the time taken and how much of the pulse height survives. downsample
+    is given the target rate that yields the same number of points.
+
+    python decimate_benchmark.py --samples 5000000 --points 2000
+'''
+import argparse
+import numpy as np
+from time import time
+from sig_proc import downsample, decimate, DECIMATORS
+
+
+def pulse_signal(nb_samples=5000000, fs=500., bpm=72):
+    '''Narrow peaks once per beat on a slow baseline, plus noise.'''
+    t = np.arange(nb_samples) / fs
+    phase = (t * bpm / 60.) % 1
+    pulse = np.exp(-0.5 * ((phase - 0.2) / 0.01)**2)
+    baseline = 0.3 * np.sin(2 * np.pi * 0.1 * t)
+    noise = 0.02 * np.random.default_rng(0).standard_normal(nb_samples)
+    return t, pulse + baseline + noise
+
+
+def best_of(func, repeats=3):
+    '''Best wall time of a few runs; and the last result.'''
+    times = []
+    for _ in range(repeats):
+        start = time()
+        result = func()
+        times.append(time() - start)
+    return min(times), result
+
+
+def peak_height(t, x, window=10.):
+    '''Median over windows of (max - min): how tall the pulses look.'''
+    t, x = np.asarray(t), np.asarray(x)
+    edges = np.searchsorted(t, np.arange(t[0], t[-1], window))
+    heights = [x[lo:hi].max() - x[lo:hi].min() for lo, hi in\
+            zip(edges[:-1], edges[1:]) if hi > lo]
+    return np.median(heights)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--samples', type=int, default=5000000)
+    parser.add_argument('--points', type=int, default=2000)
+    args = parser.parse_args()
+    fs = 500.
+    t, x = pulse_signal(args.samples, fs)
+    true_height = peak_height(t, x, window=args.samples / fs / 50)
+    print(' > {:d} samples to {:d} points; pulse height {:.3f}'.format(\
+            args.samples, args.points, true_height))
+
+    # What we used to do: block means, at whatever rate gives the points.
+    rate = fs * args.points / args.samples
+    elapsed, (t_, x_) = best_of(lambda: downsample(t, x, rate))
+    height = peak_height(t_, x_, window=args.samples / fs / 50)
+    print(' > {:10s} {:8.1f} ms  {:6d} points  height {:.3f} ({:.0f}%)'.\
+            format('downsample', 1e3*elapsed, len(t_), height,\
+            100*height/true_height))
+
+    for mode in sorted(DECIMATORS):
+        elapsed, (t_, x_) = best_of(lambda: decimate(t, x, args.points, mode))
+        height = peak_height(t_, x_, window=args.samples / fs / 50)
+        print(' > {:10s} {:8.1f} ms  {:6d} points  height {:.3f} ({:.0f}%)'.\
+                format(mode, 1e3*elapsed, len(t_), height,\
+                100*height/true_height))
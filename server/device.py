@@ -3,7 +3,9 @@ import time
 import logging
 import numpy as np
 import serial
+from serial import SerialException
 from serial_lib import *
+from buffers import StorageWriter
 import re
 
 
@@ -20,16 +22,23 @@ class BioBoard(threading.Thread):
         YMMV.
     '''
 
-    def __init__(self, port=None, baud_rate=921600, verbose=logging.INFO):
+    def __init__(self, port=None, baud_rate=921600, verbose=logging.INFO,\
+            serial_class=serial.Serial, on_write=None):
         '''Create a new thread that will communicate with the biomonitor.
         INPUTS
             port - string
                 Name of port to connect to. If no port is specified we'll look
-                for available USB ports and check them.
+                for available USB ports and check them. A board given a port
+                sticks to it, reconnecting whenever it reappears.
             baud_rate - int
                 The serial port's expected baud rate.
             verbose - int
                 Set the logging level of the connection. Default is INFO.
+            serial_class - class
+                Opens serial ports. Swap in simulator.ReplaySource to run
+                without a physical board.
+            on_write - function
+                Optional callback handed to the StorageWriter; see buffers.
         '''
         # We'll run in a separate thread.
         threading.Thread.__init__(self)
@@ -48,10 +57,15 @@ class BioBoard(threading.Thread):
         self.go = True
         self.do_stream = False
         self._trouble = False
+        self.writer = None
 
-        # Connection variables.
+        # Connection variables. The port is also our last known-good port.
+        self.requested_port = port
         self.port = port
+        self.retry_interval = 1
         self.baud_rate = baud_rate
+        self.serial_class = serial_class
+        self.on_write = on_write
 
         # Board communications & conversion stuff.
         self.COV_FACTOR = 2.5 / (2**24-1)
@@ -69,12 +83,14 @@ class BioBoard(threading.Thread):
                     self.connect()
 
                 # We're connected, so open that serial port up!
-                with serial.Serial(self.port, self.baud_rate, timeout=2) as\
-                        ser:
-                    if (self.is_connected and self.go):
-                        self.log.info(' > Reading data from biomonitor.')
-                    while (self.is_connected and self.go):
-                        self.collect(ser)
+                try:
+                    self.listen()
+                except (SerialException, OSError):
+                    # Unplugged, most likely (in_waiting raises a plain
+                    # OSError then). Go back to looking for it.
+                    self.log.warning(' > Lost biomonitor on {:s}.'.format(\
+                            self.port))
+                    self._is_connected = False
 
             # And we're leaving main run loop & the thread, honorably.
             self.info(' > Closing BioDriver. Bye!')
@@ -87,44 +103,73 @@ class BioBoard(threading.Thread):
         '''Kill this thread, with moderate prejudice.'''
         self.go = False
         self._is_connected = False
+        if self.writer:
+            self.writer.stop()
+
+
+    def listen(self):
+        '''Read from the connected port until disconnected or killed.'''
+        with self.serial_class(self.port, self.baud_rate, timeout=2) as ser:
+            if (self.is_connected and self.go):
+                self.log.info(' > Reading data from biomonitor.')
+            self.reader = FrameReader(ser)
+            while (self.is_connected and self.go):
+                self.collect()
 
 
     def connect(self):
         '''Attempt to connect to the serial monitor.'''
-        ports = find_serial_devices()
-        for port in ports:
-            self.info(' > Pinging {:s}'.format(port))
-            if self.ping(port):
-                self.info(' > Connected to biomonitor on {:s}.'.format(port))
-                self.port = port
-                self._is_connected = True
-                return # leave this search; we've found our man.
+        if self.requested_port:
+            candidates = [self.requested_port]
+        else:
+            candidates = find_serial_devices()
 
+        # The last known-good port gets first crack; it's usually right.
+        if self.port in candidates:
+            self.info(' > Pinging {:s}'.format(self.port))
+            if self.ping(self.port):
+                return self._connected_to(self.port)
+            candidates.remove(self.port)
 
-    def ping(self, port):
-        '''Ping the serial port. See if a legit biomonitor lives there.'''
-        with serial.Serial(port, self.baud_rate, timeout=1) as ser:
-            try:
-                output = ser.readline()
-            except:
-                self.log.exception(' > Serial connection failed unexpectedly.')
-                output = ''
-            parsed = re.search(self.bio_regex, str(output))
-            return ((parsed) and (parsed.group(1) == 'B1')) # really legit?
+        # Otherwise ping everyone at once.
+        good_ports = probe_ports(candidates, self.ping)
+        if len(good_ports) > 0:
+            return self._connected_to(good_ports[0])
+
+        # Nobody home. Don't spin.
+        time.sleep(self.retry_interval)
 
 
-    def collect(self, ser):
-        '''Collect data from current serial connection.'''
-        channel, timestamp, value = read_data(ser)
+    def _connected_to(self, port):
+        '''Record a successful connection.'''
+        self.info(' > Connected to biomonitor on {:s}.'.format(port))
+        self.port = port
+        self._is_connected = True
 
-        # If no valid channel is present, increment bad_data_count.
-        if channel and (self.do_stream) and (channel in self.stream.channels):
-            # Valid data? Streaming? Listening to this channel? Okay then...
-            ts = timestamp/1e6 + self.time_offset
-            vl = value * self.COV_FACTOR
-            self.stream.time_series[channel].push(ts, vl)
 
-        if (channel is None):
+    def ping(self, port):
+        '''Ping the serial port. See if a legit biomonitor lives there.'''
+        return ping(port, self.baud_rate, self.serial_class)
+
+
+    def collect(self):
+        '''Collect everything waiting on the current serial connection.'''
+        channels, timestamps, values = self.reader.read()
+
+        # Valid data? Streaming? Listening to this channel? Okay then...
+        # Samples only go into the writer's buffers; never to the database.
+        writer = self.writer
+        if (self.do_stream) and (writer) and (len(channels) > 0):
+            ts = timestamps/1e6 + self.time_offset
+            vl = values * self.COV_FACTOR
+            for channel in self.stream.channels:
+                idx = np.nonzero(channels == channel)[0]
+                if len(idx) > 0:
+                    writer.append(channel, ts[idx], vl[idx])
+
+        # A timed out read, or a full read with nothing legible, is bad data.
+        if self.reader.timed_out or (len(channels) == 0 and\
+                (self.reader.garbled or not self.reader.remainder)):
             self.info(' > Hmm. Not seeing data at the moment...')
             self._trouble = True
             if self._last_read_bad:
@@ -133,7 +178,7 @@ class BioBoard(threading.Thread):
             if self._bad_data_count > 1:
                 self._is_connected = False
                 self._trouble = False
-        else: 
+        elif len(channels) > 0:
             self._last_read_bad = False
             self._bad_data_count = 0
             self._trouble = False
@@ -142,10 +187,18 @@ class BioBoard(threading.Thread):
     def stream_to(self, stream):
         '''Start saving data to specified filename via a time series object.'''
 
+        # Don't leave a previous writer dangling.
+        if self.do_stream:
+            self.stop_stream()
+
         # Specify a streamable object (like a session, for example).
         self.time_offset = time.time()
         self.stream = stream
 
+        # Database writes happen on their own thread.
+        self.writer = StorageWriter(stream, on_write=self.on_write)
+        self.writer.start()
+
         # Start the collection process.
         self.log.info(' > Starting to stream data to database.')
         self.do_stream = True
@@ -155,6 +208,23 @@ class BioBoard(threading.Thread):
         ''' Turn stream to database off.'''
         self.info(' > Stopping data collection.')
         self.do_stream = False
+        if self.writer:
+            # Flush remaining samples, and wait: a writer started next on
+            # the same session must not find this one still committing.
+            self.writer.stop(wait=True)
+
+
+    @property
+    def status(self):
+        '''Summarize the board for the status endpoint.'''
+        data = {}
+        data['is_connected'] = self.is_connected
+        data['is_streaming'] = self.do_stream
+        data['status_message'] = self.status_message
+        data['device_port'] = self.port
+        data['session_id'] = self.stream._id if self.do_stream else None
+        data['buffer_stats'] = self.buffer_stats
+        return data
 
 
     @property
@@ -170,6 +240,14 @@ class BioBoard(threading.Thread):
         return message
 
 
+    @property
+    def buffer_stats(self):
+        '''Ring buffer health (high-water mark, overruns, drops), per channel.'''
+        if self.writer:
+            return self.writer.stats
+        return {}
+
+
     @property
     def is_active(self):
         '''Return Boolean indicating whether the thread is alive.'''
@@ -182,6 +260,185 @@ class BioBoard(threading.Thread):
         return self._is_connected
 
 
+class BoardManager(threading.Thread):
+    '''Discover biomonitors; run one BioBoard acquisition worker per device.
+    -----
+        The manager periodically scans for serial devices, pings any new
+        ones in parallel, and starts a BioBoard pinned to each port that
+        answers. Each worker streams to its own session, so a single host
+        can record from several biomonitors at once. Workers keep their
+        port (and session) through USB hiccups and reconnect as soon as the
+        device comes back. A worker that dies anyway is replaced on the
+        next scan, and its session carries on with the replacement.
+
+        Sessions asked to stream before any biomonitor is free wait for
+        one: each scan hands waiting sessions to idle workers, as a single
+        board used to start streaming once it connected.
+    '''
+
+    def __init__(self, baud_rate=921600, serial_class=serial.Serial,\
+            scan_interval=2, scan=find_serial_devices,\
+            verbose=logging.INFO):
+        '''Set up the manager. Call start() to begin scanning.
+        INPUTS
+            baud_rate - int
+                Baud rate handed to each board.
+            serial_class - class
+                Opens serial ports; see BioBoard.
+            scan_interval - float
+                Seconds between scans for newly attached devices.
+            scan - function
+                Returns the list of candidate ports.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.baud_rate = baud_rate
+        self.serial_class = serial_class
+        self.scan_interval = scan_interval
+        self.scan = scan
+        self.verbose = verbose
+        self.boards = {} # indexed by port
+        self.waiting = {} # (stream, port) of sessions without a board, by _id.
+        self.lock = threading.RLock()
+        self.go = True
+        self.log = logging.getLogger(__name__)
+
+
+    def run(self):
+        '''Scan for devices until killed.'''
+        while self.go:
+            try:
+                self.discover()
+            except:
+                self.log.exception(' > Device discovery failed.')
+            time.sleep(self.scan_interval)
+
+
+    def discover(self):
+        '''Replace dead workers; ping unclaimed ports in parallel; start
+           workers for biomonitors; give waiting sessions to idle ones.'''
+        ping_port = lambda port: ping(port, self.baud_rate, self.serial_class)
+        with self.lock:
+            self.prune()
+            new_ports = [p for p in self.scan() if p not in self.boards]
+        for port in probe_ports(new_ports, ping_port):
+            self.log.info(' > Found biomonitor on {:s}.'.format(port))
+            board = BioBoard(port=port, baud_rate=self.baud_rate,\
+                    serial_class=self.serial_class, verbose=self.verbose)
+            board.daemon = True
+            board.start()
+            with self.lock:
+                self.boards[port] = board
+        self.assign()
+
+
+    def prune(self):
+        '''Forget workers whose threads have exited, so their ports are
+           probed again. Their sessions wait for the next worker.'''
+        with self.lock:
+            for port, board in list(self.boards.items()):
+                if board.is_alive():
+                    continue
+                self.log.warning(' > Worker on {:s} stopped; will look for'\
+                        ' the biomonitor again.'.format(port))
+                self.boards.pop(port)
+                if board.do_stream:
+                    board.stop_stream()
+                    self.waiting[board.stream._id] = (board.stream, port)
+
+
+    def assign(self):
+        '''Start waiting sessions streaming, on idle workers if there are
+           any (connected or not: a worker streams once it connects).'''
+        with self.lock:
+            for session_id, (stream, port) in list(self.waiting.items()):
+                if port is not None:
+                    board = self.boards.get(port)
+                else:
+                    idle = [self.boards[p] for p in sorted(self.boards) if\
+                            not self.boards[p].do_stream]
+                    board = idle[0] if idle else None
+                if (board is None) or board.do_stream:
+                    continue
+                self.waiting.pop(session_id)
+                self.log.info(' > Streaming waiting session to {:s}.'.\
+                        format(board.port))
+                board.stream_to(stream)
+
+
+    def board(self, port=None):
+        '''Return the board on port; or the first idle one if unspecified.'''
+        with self.lock:
+            if port is not None:
+                return self.boards.get(port)
+            for port in sorted(self.boards):
+                board = self.boards[port]
+                if board.is_connected and not board.do_stream:
+                    return board
+
+
+    def board_for_session(self, session_id):
+        '''Return the board streaming to the given session, if any.'''
+        with self.lock:
+            for board in self.boards.values():
+                if board.do_stream and (board.stream._id == session_id):
+                    return board
+
+
+    def stream_to(self, stream, port=None):
+        '''Route a board (a specific one, or any idle one) to a session. If
+           there is none, the session waits for one; see assign. Returns the
+           board, or None while waiting.'''
+        with self.lock:
+            board = self.board_for_session(stream._id) or self.board(port)
+            if board is None:
+                self.log.warning(' > No available biomonitor yet; will'\
+                        ' stream once one is found.')
+                self.waiting[stream._id] = (stream, port)
+                return None
+            self.waiting.pop(stream._id, None)
+            board.stream_to(stream)
+            return board
+
+
+    def stop_stream(self, session_id):
+        '''Stop whichever board is streaming to this session (or stop it
+           waiting for one).'''
+        with self.lock:
+            self.waiting.pop(session_id, None)
+        board = self.board_for_session(session_id)
+        if board:
+            board.stop_stream()
+        return board
+
+
+    def kill(self):
+        '''Kill every worker, then the manager.'''
+        self.go = False
+        with self.lock:
+            for board in self.boards.values():
+                board.kill()
+
+
+    @property
+    def status(self):
+        '''Status of every known board, ordered by port.'''
+        with self.lock:
+            return [self.boards[port].status for port in sorted(self.boards)]
+
+
+def ping(port, baud_rate=921600, serial_class=serial.Serial):
+    '''Ping the serial port. See if a legit biomonitor lives there.'''
+    try:
+        with serial_class(port, baud_rate, timeout=1) as ser:
+            output = ser.readline()
+    except:
+        # Port vanished, is busy, or isn't a serial device at all.
+        return False
+    frames = parse_frames(output + b'\n')
+    return len(frames[0]) > 0 # really legit?
+
+
 if __name__ == '__main__':
 
     # Open a connection to the board. Try to start reading some data.
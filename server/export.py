@@ -0,0 +1,208 @@
+'''Stream session history out, segment by segment, in several formats.
+-----
+    Every format is produced by a generator, so memory use stays constant
+    however long the session: data are read from Mongo a segment at a time,
+    encoded, and handed to the web server as they go.
+
+    Asked for a number of points, we decimate for display instead (min/max
+    envelope or LTTB; see sig_proc.decimate). Zoomed out, that starts from
+    precomputed summaries (a bucket's min and max for every 10, 100 or 1000
+    samples; see pyramid.py), so the cost doesn't grow with the length of
+    the session. Otherwise there are fewer than a few times points samples
+    in range, and those are decimated in memory.
+
+        json    - what /history always returned: a list of time series
+                  models, each with its [t, v] pairs under 'data'.
+        binary  - the packed column format of wire.py.
+        csv     - channel,time,value rows.
+        npz     - one (n, 2) array of [t, v] rows per channel, for numpy.load.
+'''
+import io
+import struct
+import zipfile
+import numpy as np
+from sig_proc import decimate
+from pyramid import EnvelopeMerge, envelope
+from serial_lib import serialize, to_json
+from wire import COLUMN_DTYPES, WIRE_VERSION, padding
+
+
+EXPORT_MIMETYPES = {'json': 'application/json',\
+        'binary': 'application/octet-stream', 'csv': 'text/csv',\
+        'npz': 'application/octet-stream'}
+
+
+class SeriesExport(object):
+    '''One channel's worth of history: its metadata, size, and data.'''
+
+    def __init__(self, series, min_time=-np.inf, max_time=np.inf,\
+            points=None, mode='minmax'):
+        '''Count what we're about to send. Decimate to ~points, if given.'''
+        self.series = series
+        self.min_time = min_time
+        self.max_time = max_time
+        self.points = points
+        self.mode = mode
+        self.meta = series.public_model
+        self.decimated = None # (t, v), if decimating.
+
+        # Decimated data are at most a few times points long, so they are
+        # made here, from a single read. The count is then exactly what
+        # blocks sends, however the summaries change meanwhile (buckets are
+        # rewritten as they fill). Zoomed out far enough? Then summaries
+        # will do, read from the coarsest level with enough buckets.
+        level = None
+        if points:
+            level = series.summary_level(min_time, max_time,\
+                    max(points // 2, 1))
+        if level:
+            self.decimated = self.from_summaries(list(series.iter_summary(\
+                    level, min_time, max_time)))
+        else:
+            # Stored segments never change; count_range fixes the last.
+            nb_samples, self.last_seq = series.count_range(min_time, max_time)
+            if points and (nb_samples > points):
+                self.decimated = decimate(*self.gather(self.sample_blocks()),\
+                        points=points, mode=mode)
+        if self.decimated is not None:
+            self.count = len(self.decimated[0])
+        else:
+            self.count = nb_samples
+
+
+    def blocks(self):
+        '''Generate (t, v) arrays, a segment's worth at a time.'''
+        pieces = self.sample_blocks() if self.decimated is None else\
+                [self.decimated]
+        for t, v in pieces:
+            if len(t) > 0:
+                yield t, v
+
+
+    def sample_blocks(self):
+        '''Stored samples.'''
+        return self.series.iter_range(self.min_time, self.max_time,\
+                last_seq=self.last_seq)
+
+
+    def from_summaries(self, documents):
+        '''Summary buckets (one dict of arrays per document), as an envelope
+           merged down to the point budget; or decimated from the envelope.'''
+        nb_buckets = sum(len(buckets['t']) for buckets in documents)
+        if self.mode != 'minmax':
+            return decimate(*self.gather(envelope(buckets) for buckets in\
+                    documents), points=self.points, mode=self.mode)
+        merger = EnvelopeMerge(max(int(np.ceil(2 * nb_buckets /\
+                self.points)), 1))
+        pieces = [merger.push(buckets) for buckets in documents]
+        return self.gather(pieces + [merger.flush()])
+
+
+    def gather(self, pieces):
+        '''Concatenate (t, v) pieces. Only ever a few times points long.'''
+        pieces = list(pieces)
+        if len(pieces) == 0:
+            return np.array([]), np.array([])
+        return tuple(np.concatenate(column) for column in zip(*pieces))
+
+
+def json_chunks(exports):
+    '''[{...model..., "data": [[t, v], ...]}, ...], a segment at a time.'''
+    yield '['
+    for k, export in enumerate(exports):
+        meta = to_json(serialize(export.meta))
+        yield (',' if k > 0 else '') + meta[:-1] + ',"data":['
+        first = True
+        for t, v in export.blocks():
+            rows = to_json(np.column_stack((t, v)))[1:-1]
+            yield rows if first else ',' + rows
+            first = False
+        yield ']}'
+    yield ']'
+
+
+def csv_chunks(exports):
+    '''channel,time,value rows.'''
+    yield 'channel,time,value\n'
+    for export in exports:
+        channel = export.meta['physical_channel']
+        for t, v in export.blocks():
+            text = io.StringIO()
+            rows = np.column_stack((np.full(len(t), channel), t, v))
+            np.savetxt(text, rows, fmt=['%d', '%.6f', '%.9g'], delimiter=',')
+            yield text.getvalue()
+
+
+def binary_chunks(exports):
+    '''The wire.py format. Counts are known up front, so is the header.'''
+    header = {'version': WIRE_VERSION, 'series': []}
+    offset = 0
+    for export in exports:
+        meta = serialize(export.meta)
+        meta['columns'] = []
+        for name, dtype in COLUMN_DTYPES:
+            nb_bytes = export.count * np.dtype(dtype).itemsize
+            meta['columns'].append({'name': name,\
+                    'dtype': np.dtype(dtype).name, 'length': export.count,\
+                    'offset': offset})
+            offset += nb_bytes + padding(nb_bytes)
+        header['series'].append(meta)
+    text = to_json(header).encode()
+    text += b' ' * padding(4 + len(text))
+    yield struct.pack('<I', len(text)) + text
+
+    # Columns are contiguous, so each one is a pass over the data.
+    for export in exports:
+        for column, (name, dtype) in enumerate(COLUMN_DTYPES):
+            nb_bytes = 0
+            for block in export.blocks():
+                data = np.ascontiguousarray(block[column], dtype=dtype)
+                nb_bytes += data.nbytes
+                yield data.tobytes()
+            yield b'\0' * padding(nb_bytes)
+
+
+class ChunkWriter(io.RawIOBase):
+    '''A write-only, unseekable file that saves bytes until collected.'''
+
+    def __init__(self):
+        self.chunks = []
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+    def collect(self):
+        '''Hand over (and forget) everything written so far.'''
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def npz_chunks(exports):
+    '''A .npz archive, written as it goes. Each channel is an (n, 2) array
+       of [t, v] rows; the .npy header is written up front from the count.'''
+    writer = ChunkWriter()
+    with zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_STORED,\
+            allowZip64=True) as archive:
+        for export in exports:
+            name = 'channel_{}.npy'.format(export.meta['physical_channel'])
+            with archive.open(name, mode='w', force_zip64=True) as entry:
+                header = {'descr': '<f8', 'fortran_order': False,\
+                        'shape': (export.count, 2)}
+                np.lib.format.write_array_header_1_0(entry, header)
+                for t, v in export.blocks():
+                    entry.write(np.column_stack((t, v)).astype('<f8').\
+                            tobytes())
+                    yield writer.collect()
+            yield writer.collect()
+    yield writer.collect()
+
+
+EXPORT_FORMATS = {'json': json_chunks, 'binary': binary_chunks,\
+        'csv': csv_chunks, 'npz': npz_chunks}
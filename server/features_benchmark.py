@@ -0,0 +1,126 @@
+'''Compare batch pulse features with the original per-pulse fits, and time.
+-----
+    Slides a 40 s window (as the analytics use) along recorded data, and
+    runs golden_representation both ways: the original, fitting each pulse
+    separately, copied here; and the current one, all pulses at once. The
+    median pulse should agree closely where it matters (before 0.6), as
+    should the score.
+
+    python features_benchmark.py --data chl_data.dat
+'''
+import argparse
+import numpy as np
+from time import time
+from mathtools.utils import Vessel
+from mathtools.fit import Fit
+from taut_string import taut_string
+from processor import scan_for_peaks, extract_pulses, filter_pulses,\
+        golden_representation, FEATURE_GRID, dex
+from projection import projections
+
+
+def legacy_feature(pulse):
+    '''The original processor.feature, verbatim.'''
+    v = pulse
+    t_ = np.linspace(0,1,len(v))
+    v /= v.max()
+
+    md = np.median(v)
+    half_max = (1+md)/2
+    half_max_pos = np.nonzero( v <= half_max )[0][0]
+
+    dilation_factor = 0.1/t_[half_max_pos]
+    td = t_ * dilation_factor
+    stretch_point = np.nonzero(td >= 0.2)[0][0]
+    md = v[stretch_point]
+    delta = (1-md)
+    v -= md
+    v /= delta
+    t_final = np.linspace(0,1,200)
+    fitter = Fit(td, nb_bases=75)
+    f = fitter.fit(v)
+    f = fitter.resample(t_final)
+    return t_final, f.y
+
+
+def legacy_golden_representation(t,v):
+    '''The original golden_representation, verbatim (but for names).'''
+    peaks = scan_for_peaks(t,v,dt=3)
+    times, pulses = extract_pulses(t, v, peaks)
+    clean_pulses = filter_pulses(pulses)
+    fpulses = []
+    for k, pulse in enumerate(clean_pulses):
+        try:
+            tf, fp = legacy_feature(pulse)
+            fpulses.append(fp)
+        except:
+            pass
+
+    # Stack these guys up.
+    fpulses = np.vstack(fpulses)
+
+    # Compute the mean pulse.
+    the_pulse = np.median(fpulses,0)
+    fitter = Fit(tf, nb_bases=50, reg_coefs=[0,1e-3,1e-3])
+    f = fitter.fit(the_pulse)
+    the_pulse = f.y
+
+    i_ = dex(tf<0.60)
+
+    taut = taut_string(the_pulse, 0.05)
+    taut = taut
+    resid = the_pulse - taut
+    resid = resid[i_]
+    resid -= resid.min()
+    resid *= 10
+    t_resid = np.linspace(0,1,len(i_))
+    a_ = dex((t_resid>0.3) * (t_resid<0.7))
+    area = resid[a_].sum() * np.median(np.diff(t_resid))
+
+    # Normalized score, for the moment.
+    score = np.min([400*area,100])
+
+    return the_pulse, resid, t_resid, score
+
+
+def timed(func, *args):
+    '''Wall time of one run; and the result.'''
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='chl_data.dat')
+    parser.add_argument('--width', type=float, default=40)
+    parser.add_argument('--step', type=float, default=1.5)
+    args = parser.parse_args()
+    data = Vessel(args.data)
+    t, v = np.array(data.t), np.array(data.v)
+
+    # Built once per process; time it separately.
+    elapsed, _ = timed(projections.operator, FEATURE_GRID, 75, None, None,\
+            FEATURE_GRID)
+    print(' > smoothing operator built in {:.1f} ms'.format(1e3*elapsed))
+
+    t_old, t_new, pulse_diff, score_diff = 0, 0, [], []
+    half = args.width/2
+    for t_cur in np.arange(t[0]+half, t[-1]-half, args.step):
+        i_ = dex((t>t_cur-half) * (t<t_cur+half))
+        elapsed, old = timed(legacy_golden_representation, t[i_], v[i_])
+        t_old += elapsed
+        elapsed, new = timed(golden_representation, t[i_], v[i_])
+        t_new += elapsed
+        pulse_diff.append(np.abs(old[0] - new[0])[:120].max())
+        score_diff.append(abs(old[3] - new[3]))
+    pulse_diff, score_diff = np.array(pulse_diff), np.array(score_diff)
+    print(' > {:d} windows; pulse (t < 0.6) differs by at most {:.4f}'.\
+            format(len(score_diff), pulse_diff.max()))
+    print(' > score differs by {:.2f} (median), more than 5 in {:d}'.\
+            format(np.median(score_diff), np.sum(score_diff > 5)))
+    print(' > golden_representation: {:.1f} ms -> {:.1f} ms ({:.0f}x)'.\
+            format(1e3*t_old/len(score_diff), 1e3*t_new/len(score_diff),\
+            t_old/t_new))
+    print(' > projection cache: {}'.format(projections.stats))
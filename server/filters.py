@@ -1,12 +1,90 @@
 import seaborn
 import pylab as plt
 import numpy as np
-from scipy.signal import butter, lfilter
+from functools import lru_cache
+from scipy.signal import butter, lfilter, sosfilt, iirnotch, tf2sos
 from mathtools.utils import Vessel
 
 
+# What time series have always been filtered with: see lowpass.
+DEFAULT_STAGES = [('lowpass', 3, 10)]
+
+
+@lru_cache(maxsize=256)
+def design_sos(kind, fs, *params):
+    '''Design one filter stage as second-order sections. Cached: the same
+       few designs are asked for over and over.
+    INPUTS
+        kind - string
+            'lowpass' or 'highpass' (params: order, cutoff); 'bandpass' or
+            'bandstop' (params: order, low, high); or 'notch' (params:
+            frequency, quality factor). Frequencies in Hz.
+        fs - float
+            Sampling rate, in Hz.
+    OUTPUTS
+        sos - array
+            (sections, 6) coefficients. Read-only; it is shared.
+    '''
+    if kind == 'notch':
+        frequency, quality = params
+        sos = tf2sos(*iirnotch(frequency, quality, fs=fs))
+    elif kind in ['bandpass', 'bandstop']:
+        order, low, high = params
+        sos = butter(order, [low, high], btype=kind, fs=fs, output='sos')
+    else:
+        order, cutoff = params
+        sos = butter(order, cutoff, btype=kind, fs=fs, output='sos')
+    sos.setflags(write=False)
+    return sos
+
+
+class StreamingFilter(object):
+    '''A cascade of filter stages, run batch by batch with state carried over.
+    -----
+        The stages are stacked into one set of second-order sections, and
+        each batch is a single sosfilt call. Filtering a signal in pieces
+        gives what filtering it all at once would. Batches are 1-D (one
+        channel), or 2-D (channels by samples), in which case every channel
+        is filtered in the same call, each with its own state.
+    '''
+
+    def __init__(self, fs, stages=DEFAULT_STAGES, state=None):
+        '''Design (or look up) the filter.
+        INPUTS
+            fs - float
+                Sampling rate, in Hz.
+            stages - list
+                (kind, params...) for each stage, applied in order; see
+                design_sos.
+            state - list
+                Filter state to resume from, as returned by state.
+        '''
+        self.fs = fs
+        self.stages = [tuple(stage) for stage in stages]
+        self.sos = np.vstack([design_sos(stage[0], fs, *stage[1:]) for\
+                stage in self.stages])
+        self.zi = np.array(state, dtype=float) if state else None
+
+
+    def filter(self, y):
+        '''Filter the next batch of samples (along the last axis).'''
+        y = np.asarray(y, dtype=float)
+        shape = (len(self.sos),) + y.shape[:-1] + (2,)
+        if (self.zi is None) or (self.zi.shape != shape):
+            self.zi = np.zeros(shape) # starts at rest, as lowpass does.
+        y_filt, self.zi = sosfilt(self.sos, y, axis=-1, zi=self.zi)
+        return y_filt
+
+
+    @property
+    def state(self):
+        '''Filter state, as nested lists (fit for a Mongo document).'''
+        return [] if self.zi is None else self.zi.tolist()
+
+
 def lowpass(t, y, filter_order=3, freq_cutoff=10, zi=[]):
-    '''Lowpass Butterworth filter the signal.'''
+    '''Lowpass Butterworth filter the signal. (Time series now use
+       StreamingFilter; this is kept for existing callers.)'''
 
     # Determine the sampling rate of the supplied data.
     fs = 1/np.median(np.diff(t))
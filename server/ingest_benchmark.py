@@ -0,0 +1,114 @@
+'''Benchmark the ingest path: serial frames -> BioBoard -> SessionController.
+-----
+    Replays a recording through a fake serial port (see simulator.py) and
+    streams it into a throwaway Mongo database, exactly as the server would.
+    Reports sustained throughput, per-sample latency (from the moment the
+    reader buffered a sample to the moment it was handed to the time series)
+    and any samples dropped along the way.
+
+    python ingest_benchmark.py --rate 5000 --channels 4 --duration 20
+'''
+import argparse
+import numpy as np
+from time import time, sleep
+from database import connect_to_database
+from models import SessionController
+from device import BioBoard
+from simulator import ReplaySource
+
+
+class LatencyRecorder(object):
+    '''Collect per-sample storage latencies from the StorageWriter.'''
+
+    def __init__(self):
+        self.latencies = []
+        self.nb_written = 0
+
+
+    def __call__(self, channel, arrival):
+        self.latencies.append(time() - arrival)
+        self.nb_written += len(arrival)
+
+
+    def percentiles(self, q=[50, 95, 99, 100]):
+        if len(self.latencies) == 0:
+            return [np.nan for _ in q]
+        return np.percentile(np.concatenate(self.latencies), q)
+
+
+def run_benchmark(rate=500, nb_channels=1, duration=10,\
+        recording='data/good_collection.dat', database_name='biomonitor_bench'):
+    '''Stream replayed data for duration seconds; return a report dict.'''
+    db = connect_to_database(database_name)
+    channels = list(range(1, nb_channels+1))
+    source = ReplaySource(recording, rate=rate, channels=channels)
+    recorder = LatencyRecorder()
+
+    # A fresh session, one time series per replayed channel.
+    session = {'name': 'Ingest Benchmark'}
+    session['channels'] = [{'physical_channel': chn, 'description':\
+            'Replay {:d}'.format(chn)} for chn in channels]
+    s = SessionController(db, data=session)
+
+    # Fire up the board against the fake port; wait for it to connect.
+    board = BioBoard(port='replay', serial_class=source, on_write=recorder)
+    board.start()
+    while not board.is_connected:
+        sleep(0.1)
+
+    # Stream for a while.
+    emitted_at_start = source.frames_emitted
+    start = time()
+    board.stream_to(s)
+    sleep(duration)
+    board.stop_stream()
+    emitted = source.frames_emitted - emitted_at_start
+    board.writer.join()
+    elapsed = time() - start
+    board.kill()
+
+    # Tally up.
+    stats = board.buffer_stats
+    report = {}
+    report['frames_emitted'] = emitted
+    report['samples_written'] = recorder.nb_written
+    report['samples_per_sec'] = recorder.nb_written / elapsed
+    report['latency_percentiles'] = dict(zip(['p50', 'p95', 'p99', 'max'],\
+            recorder.percentiles()))
+    report['buffer_dropped'] = sum([c['dropped'] for c in stats.values()])
+    report['buffer_overruns'] = sum([c['overruns'] for c in stats.values()])
+    report['buffer_high_water'] = max([c['high_water'] for c in\
+            stats.values()])
+    report['bad_frames'] = board.reader.nb_bad_frames
+    report['unaccounted'] = emitted - recorder.nb_written -\
+            report['buffer_dropped']
+
+    # Clean up after ourselves.
+    s.delete()
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=500,\
+            help='samples/sec per channel; 0 replays as fast as possible')
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--recording', default='data/good_collection.dat')
+    args = parser.parse_args()
+
+    report = run_benchmark(rate=args.rate or None,\
+            nb_channels=args.channels, duration=args.duration,\
+            recording=args.recording)
+    print(' > Frames emitted:     {:d}'.format(report['frames_emitted']))
+    print(' > Samples written:    {:d}'.format(report['samples_written']))
+    print(' > Sustained rate:     {:.0f} samples/sec'.format(\
+            report['samples_per_sec']))
+    for name, value in report['latency_percentiles'].items():
+        print(' > Latency {:>4s}:      {:.2f} ms'.format(name, 1e3*value))
+    print(' > Buffer high water:  {:d}'.format(report['buffer_high_water']))
+    print(' > Buffer overruns:    {:d}'.format(report['buffer_overruns']))
+    print(' > Dropped samples:    {:d}'.format(report['buffer_dropped']))
+    print(' > Bad frames:         {:d}'.format(report['bad_frames']))
+    print(' > Unaccounted frames: {:d}'.format(report['unaccounted']))
@@ -15,7 +15,8 @@ class Stream(object):
         biomonitor board. The stream object must expose a channels attribute,
         as well as a time_series dictionary indexed by the physical channel
         number. The time_series must expose a .push(t,v) methods that accepts
-        a timestamp, t, and and value, v. See Series, below, for more details.
+        a timestamp, t, and and value, v, and an .extend(t,v) method that
+        accepts arrays of them. See Series, below, for more details.
     '''
 
     def __init__(self):
@@ -45,6 +46,11 @@ class Series(object):
         self.v.append(value)
 
 
+    def extend(self, timestamps, values):
+        self.t.extend(timestamps)
+        self.v.extend(values)
+
+
 if __name__ == '__main__':
 
     # This is it, folks. Open up the biomonitor. Read data to database.
@@ -0,0 +1,209 @@
+'''Push new session data to browsers as server-sent events.'''
+import logging
+import gevent
+import numpy as np
+from gevent.queue import Queue, Full, Empty
+from serial_lib import serialize, to_json
+from registry import as_object_id
+from sig_proc import downsample
+
+
+# Display rate of pushed data, as for /stream.
+TARGET_FREQUENCY = 100
+
+
+class LiveProducer(object):
+    '''Watch one session; publish each new stretch of data to subscribers.
+    -----
+        A single greenlet per session, however many browsers are watching.
+        Every tick it checks each channel's segment counter (free, for the
+        pinned controller being recorded to); when segments have been
+        completed it reads just those, downsamples them once, and hands the
+        same event to every subscriber. The producer exits when the last
+        subscriber leaves.
+
+        Events carry a cursor, the last segment sent on each channel, as
+        their id. A browser that reconnects sends it back (Last-Event-ID)
+        and picks up exactly where it left off.
+    '''
+
+    def __init__(self, session_id, registry, analytics, tick=0.25,\
+            backlog=3, target_frequency=TARGET_FREQUENCY):
+        '''Set up the producer. Call start() to begin watching.
+        INPUTS
+            session_id - ObjectId
+                Session to watch.
+            registry - ControllerRegistry
+                Supplies the (shared) session controller.
+            analytics - AnalyticsCache
+                Supplies bpm and metric.
+            tick - float
+                Seconds between checks for new segments.
+            backlog - int
+                Segments sent to a new subscriber that has no cursor.
+            target_frequency - float
+                Sampling rate of the data pushed to browsers.
+        '''
+        self.session_id = session_id
+        self.registry = registry
+        self.analytics = analytics
+        self.tick = tick
+        self.backlog = backlog
+        self.target_frequency = target_frequency
+        self.subscribers = set()
+        self.cursor = None # {physical channel: last segment seq}
+        self.greenlet = None
+        self.log = logging.getLogger(__name__)
+
+
+    def start(self):
+        '''Start publishing from a greenlet.'''
+        self.cursor = self.latest_cursor()
+        self.greenlet = gevent.spawn(self.run)
+
+
+    def run(self):
+        '''Publish until nobody is listening.'''
+        while len(self.subscribers) > 0:
+            try:
+                event = self.event_since(self.cursor)
+                if event is not None:
+                    self.cursor = event['cursor']
+                    self.publish(event)
+            except:
+                self.log.exception(' > Live producer failed to read data.')
+            gevent.sleep(self.tick)
+
+
+    def subscribe(self, cursor=None, maxsize=64):
+        '''Return a queue of events; prime it to catch the subscriber up.'''
+        queue = Queue(maxsize=maxsize)
+        if cursor is None:
+            cursor = {chn: seq - self.backlog for chn, seq in\
+                    self.cursor.items()}
+        event = self.event_since(cursor, until=self.cursor)
+        if event is not None:
+            queue.put(event)
+        self.subscribers.add(queue)
+        return queue
+
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+    def publish(self, event):
+        '''Hand the event to every subscriber. Stragglers miss out.'''
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except Full:
+                self.log.warning(' > Live subscriber is falling behind.')
+
+
+    def latest_cursor(self):
+        '''The cursor pointing at the newest completed segment everywhere.'''
+        session = self.registry.session(self.session_id)
+        return {chn: series.model['segment_counter'] - 1 for chn, series in\
+                session.time_series.items()}
+
+
+    def event_since(self, cursor, until=None):
+        '''Build an event holding segments after cursor (up to until).'''
+        session = self.registry.session(self.session_id)
+        series_data, new_cursor, nb_new = [], {}, 0
+        for chn, series in session.time_series.items():
+            seq = cursor.get(chn, -1)
+            last = until.get(chn, seq) if until else\
+                    series.model['segment_counter'] - 1
+            if last <= seq:
+                new_cursor[chn] = seq
+                continue
+            segments = [s for s in series.segments_after(seq, limit=last-seq)\
+                    if s[0] <= last]
+            if len(segments) == 0:
+                new_cursor[chn] = seq
+                continue
+            new_cursor[chn] = segments[-1][0]
+            nb_new += len(segments)
+            series_data.append(self.series_delta(series, segments))
+        if nb_new == 0:
+            return None
+        return {'cursor': new_cursor, 'series': series_data}
+
+
+    def series_delta(self, series, segments):
+        '''Describe new segments the way /stream describes its data.'''
+        t = np.concatenate([s[1] for s in segments])
+        v = np.concatenate([s[2] for s in segments])
+        t_, v_ = downsample(t, v, self.target_frequency)
+        time_series = series.public_model
+        time_series['data'] = np.column_stack((t_, v_)) # [t, v] rows.
+        time_series['bpm'], time_series['metric'] = \
+                [float(x) for x in self.analytics.live(series)]
+        time_series['duration'], time_series['sampling_rate'] = \
+                [float(x) for x in series.props]
+        time_series['min_time'] = float(t[0])
+        time_series['max_time'] = float(t[-1])
+        time_series['seq'] = segments[-1][0]
+        return time_series
+
+
+class LiveHub(object):
+    '''One LiveProducer per watched session, created on demand.'''
+
+    def __init__(self, registry, analytics, **options):
+        self.registry = registry
+        self.analytics = analytics
+        self.options = options
+        self.producers = {}
+
+
+    def subscribe(self, session_id, cursor=None):
+        '''Return (producer, queue) for a new subscriber.'''
+        producer = self.producers.get(session_id)
+        if (producer is None) or producer.greenlet.dead:
+            producer = LiveProducer(session_id, self.registry,\
+                    self.analytics, **self.options)
+            producer.start()
+            self.producers[session_id] = producer
+        return producer, producer.subscribe(cursor)
+
+
+    def stream(self, session_id, cursor=None, keepalive=15):
+        '''Generate text/event-stream chunks for one subscriber.'''
+        producer, queue = self.subscribe(as_object_id(session_id), cursor)
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                try:
+                    event = queue.get(timeout=keepalive)
+                except Empty:
+                    # Quiet for a while. Also how we notice a browser left.
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(event)
+        finally:
+            producer.unsubscribe(queue)
+
+
+def format_cursor(cursor):
+    '''Cursor as an event id: "<channel>:<seq>,..."'''
+    return ','.join(['{}:{}'.format(chn, seq) for chn, seq in\
+            sorted(cursor.items())])
+
+
+def parse_cursor(text):
+    '''Inverse of format_cursor; None if there is nothing usable.'''
+    try:
+        pairs = [item.split(':') for item in text.split(',')]
+        return {int(chn): int(seq) for chn, seq in pairs}
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_event(event):
+    '''One server-sent event: the cursor as id, the series as JSON data.'''
+    chunk = 'id: {:s}\n'.format(format_cursor(event['cursor']))
+    chunk += 'data: {:s}\n\n'.format(to_json(serialize(event['series'])))
+    return chunk
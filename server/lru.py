@@ -0,0 +1,55 @@
+'''A small, thread-safe, least-recently-used cache.'''
+import threading
+from collections import OrderedDict
+
+
+class LRU(object):
+    '''A small, thread-safe, least-recently-used mapping.'''
+
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+        '''Return the cached item (refreshing its place), or None.'''
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+
+    def put(self, key, item):
+        '''Cache an item, evicting the least recently used as necessary.'''
+        with self.lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+
+    def pop(self, key):
+        '''Forget an item; return it, if we had it.'''
+        with self.lock:
+            return self.items.pop(key, None)
+
+
+    def __contains__(self, key):
+        return key in self.items
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    @property
+    def stats(self):
+        '''Hit/miss counts and occupancy.'''
+        return {'size': len(self), 'capacity': self.capacity,\
+                'hits': self.hits, 'misses': self.misses}
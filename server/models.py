@@ -1,9 +1,42 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from bson import ObjectId
+from contextlib import ExitStack
+import itertools
+import base64
+import json
+import threading
 from database import *
 import logging as log
 from ipdb import set_trace as debug
-from filters import lowpass
+from filters import StreamingFilter
+from beats import BeatDetector
+from pyramid import SUMMARY_FIELDS, empty_summary, summarize, finish
+
+
+# Segment storage formats. 'list' stores each column as a BSON array of
+# doubles (the original format). 'packed' stores each column as one binary
+# blob with a small dtype/shape header; see database.pack_array.
+DEFAULT_SEGMENT_FORMAT = 'list'
+PACKED_DTYPES = {'time': '<f8', 'epoch': '<f8', 'vals': '<f4',\
+        'filtered': '<f4'}
+
+# Volts per ADC count; used when raw values are packed as int32 counts.
+ADC_SCALE = 2.5 / (2**24-1)
+
+# Number of recent segments behind the running sampling-rate estimate.
+DT_HISTORY = 25
+
+# Samples that must be waiting before a batch is filtered as it arrives;
+# smaller ones wait for the next (sosfilt's overhead is per call).
+FILTER_BATCH = 256
+
+# Model fields only the writer needs (its working state); left out of what
+# clients and exports see. See TimeSeriesController.public_model.
+WRITER_STATE = ['filter_state', 'beat_state']
+
+# Value columns returned for each choice of columns; see range_array.
+COLUMN_SETS = {'filtered': ['filtered'], 'raw': ['vals'],\
+        'both': ['vals', 'filtered']}
 
 
 class ModelController(object):
@@ -16,8 +49,9 @@ class ModelController(object):
     '''
 
     def __init__(self, model_name, database, data=None, _id=None,\
-            verbose=log.INFO):
-        '''Connect to database. Load or create the model.'''
+            model=None, verbose=log.INFO):
+        '''Connect to database. Load or create the model. If a model is
+           supplied, it is used as is: no database round trip.'''
 
         # We have ourselves a database.
         self.db = database
@@ -28,6 +62,12 @@ class ModelController(object):
         log.basicConfig(level=verbose)
         self.log = log.getLogger(__name__)
 
+        if (model is not None):
+            # We already have the model in hand.
+            self.model = model
+            self._id = model['_id']
+            return
+
         if (data is None) and (_id is None):
             # If nothing is specified, let's load all session models!
             self._list()
@@ -113,6 +153,9 @@ class ModelController(object):
     def required_attributes(self):
         return []
 
+    # Indexes this controller's queries rely on: (collection, keys, options).
+    indexes = []
+
 
 class SessionController(ModelController):
     '''Handle session creation, updating, and so on.
@@ -122,6 +165,9 @@ class SessionController(ModelController):
         time series.
     '''
 
+    indexes = [('time_series', [('owner_id', 1), ('physical_channel', 1)],\
+            {}), ('annotations', [('owner_id', 1)], {})]
+
     def __init__(self, database, data=None, _id=None):
         '''Initialize the model as a sessions object.'''
         ModelController.__init__(self, 'sessions', database, data=data,\
@@ -150,7 +196,7 @@ class SessionController(ModelController):
         # First find all the time series I own; delete those.
         cursor = self.db.time_series.find({'owner_id': self._id})
         for ts in cursor:
-            series = TimeSeriesController(self.db, _id=ts['_id'])
+            series = TimeSeriesController(self.db, model=ts)
             series.delete() # will take care of its own segment deletion.
 
         # And now, I delete myself.
@@ -159,18 +205,28 @@ class SessionController(ModelController):
 
     def load_series(self):
         '''Add channel TimeSeries objects to dictionary indexed by physical
-           channel.'''
-        # Loop over the declared channels.
+           channel.
+        -----
+            All of the session's time series come back in one query, and
+            legacy series (no segment counter yet) are counted in one more.
+            Nothing else is read: segments and statistics load lazily, the
+            first time something touches them.
+        '''
+        cursor = self.db.time_series.find({'owner_id': self._id})
+        models = {doc['physical_channel']: doc for doc in cursor}
+        count_segments(self.db, [doc for doc in models.values() if\
+                'segment_counter' not in doc])
+
+        # Index by physical channel, in the declared channel order.
         self._series = {}
         for channel in self.model['channels']:
-
-            # What is the physical channel number?
             pchn = channel['physical_channel']
-            query = {'owner_id': self._id, 'physical_channel': pchn}
-            
-            # Find time series corresponding to the channel.
-            s_id = self.db.time_series.find_one(query, {'_id':1})
-            self._series[pchn] = TimeSeriesController(self.db, _id=q(s_id))
+            if pchn not in models:
+                self.log.warning(' > No time series for channel {}.'.\
+                        format(pchn))
+                continue
+            self._series[pchn] = TimeSeriesController(self.db,\
+                    model=models[pchn])
 
 
     def create(self, data):
@@ -183,6 +239,39 @@ class SessionController(ModelController):
             channel['owner_id'] = self._id
             ts = TimeSeriesController(self.db, data=channel)
         self.load_series()
+        self.load_annotations() # none yet; but clients expect the list.
+
+
+    def commit(self):
+        '''Write completed segments from every channel in one go.'''
+        segments, updates, summaries, beats = [], [], [], []
+        with ExitStack() as stack:
+            # Hold every series until its segments are safely written.
+            for series in self.time_series.values():
+                stack.enter_context(series.lock)
+            for series in self.time_series.values():
+                docs, meta = series.pending_writes()
+                segments += docs
+                summaries += series.pending_summaries()
+                beats += series.pending_beats()
+                if meta:
+                    updates.append(UpdateOne(qwrap(series._id),\
+                            {'$set': meta}))
+            if len(segments) > 0:
+                self.db.segments.insert_many(segments)
+            if len(summaries) > 0:
+                self.db.summaries.bulk_write(summaries)
+            if len(beats) > 0:
+                self.db.beats.insert_many(beats)
+            if len(updates) > 0:
+                self.db.time_series.bulk_write(updates)
+
+
+    def close(self):
+        '''Flush partially filled segments on every channel.'''
+        for series in self.time_series.values():
+            series.close(commit=False)
+        self.commit()
 
 
     @property
@@ -206,24 +295,91 @@ class TimeSeriesController(ModelController):
         fixed-length segments. 
     '''
 
-    def __init__(self, database, data=None, _id=None):
-        '''Create or load the time series.'''
+    # Every segment lookup is by owner; ordered by sequence number or time.
+    indexes = [('segments', [('owner_id', 1), ('seq', 1)], {'unique': True,\
+            'partialFilterExpression': {'seq': {'$exists': True}}}),\
+            ('segments', [('owner_id', 1), ('is_flushed', 1), ('seq', 1)], {}),\
+            ('segments', [('owner_id', 1), ('is_flushed', 1),\
+            ('min_time', 1)], {}),\
+            ('summaries', [('owner_id', 1), ('level', 1), ('start', 1)],\
+            {'unique': True}),\
+            ('summaries', [('owner_id', 1), ('level', 1), ('max_time', 1)],\
+            {}),\
+            ('beats', [('owner_id', 1), ('max_time', 1)], {})]
+
+    def __init__(self, database, data=None, _id=None, model=None):
+        '''Create or load the time series. Pass model (a time_series
+           document already in hand) to skip the database entirely.'''
+        # Completed segments waiting to be written; see commit.
+        self._pending = []
+        self._summaries = [] # summary buckets, likewise; see pyramid.py.
+        self.autocommit = True
+        self._segment = None # in-progress segment; see segment.
+        self._rates = None # cached (dt, fs); see mean_sampling_rate.
+        self._filter = None # see streaming_filter.
+        self._nb_filtered = 0 # samples of the current segment filtered.
+        self._detector = None # see detect_beats.
+        self._new_beats = [] # (t, height, bpm) since the last segment.
+        self._beats = [] # beats documents waiting to be written.
+
+        # Writers (a StorageWriter thread) and readers (request handlers) can
+        # share this controller; see registry.py.
+        self.lock = threading.RLock()
         ModelController.__init__(self, 'time_series', database, data=data,\
-                _id=_id)
-        self.mean_sampling_rate() # cache current sampling rates, etc.
+                _id=_id, model=model)
 
 
     def read(self):
         '''Read the current time series from the database.'''
         self._read()
-        self.load_segment()
+        count_segments(self.db, [m for m in [self.model] if\
+                'segment_counter' not in m])
+
+
+    @property
+    def segment(self):
+        '''The in-memory segment being filled. Created on first use.'''
+        if self._segment is None:
+            count_segments(self.db, [m for m in [self.model] if\
+                    'segment_counter' not in m])
+            self.add_segment()
+        return self._segment
+
+
+    @property
+    def stats(self):
+        '''Running statistics. Legacy series have them rebuilt (and saved)
+           the first time they are needed.'''
+        if 'stats' not in self.model:
+            self.rebuild_stats()
+        return self.model['stats']
+
+
+    @property
+    def public_model(self):
+        '''A copy of the model to hand out: without the writer's working
+           state (filter and beat detector state, unfinished summary
+           buckets, recent segment durations). Copied under the lock, so
+           it is consistent even while data are being pushed.'''
+        with self.lock:
+            model = {key: value for key, value in self.model.items()\
+                    if key not in WRITER_STATE}
+            if 'summary' in model:
+                model['summary'] = {key: value for key, value in\
+                        model['summary'].items() if key != 'partial'}
+            if 'stats' in model:
+                model['stats'] = {key: value for key, value in\
+                        model['stats'].items() if key != 'dt_recent'}
+        return model
 
 
     def delete(self):
         '''Delete current time series, as well as all segments.'''
 
-        # First, delete all the segments that I own.
+        # First, delete all the segments (summaries, beats) that I own.
         self.db.segments.delete_many({'owner_id': self._id})
+        self.db.summaries.delete_many({'owner_id': self._id})
+        self.db.beats.delete_many({'owner_id': self._id})
 
         # Now delete myself! Au revoir, cruel world.
         self._delete()
@@ -232,34 +388,191 @@ class TimeSeriesController(ModelController):
     @property
     def series(self):
         '''Synthesize entire series from the available segments.'''
-        # Initialize time and value lists.
-        t,v = [],[]
-        segments = self.db.segments
-        cursor = segments.find({'owner_id':self._id, 'is_flushed':True},\
-                {'vals': 1, 'filtered':1, 'time':1}).\
-                               sort('min_time', 1)
-        # Concatenate segments.
-        for seg in cursor:
-            # v += seg['filtered']
-            v += seg['filtered']
-            t += seg['time']
-        return (t, v)
+        return self.series_array()
 
 
     def in_range(self, min_time=0, max_time=np.inf):
         '''Return series in specified range.'''
-        t,v = [],[]
-        segments = self.db.segments
-        query = {}
-        query['owner_id'] = self._id
-        query['is_flushed'] = True
-        query['min_time'] = {'$gt': min_time}
-        query['max_time'] = {'$lt': max_time}
-        cursor = segments.find_one(query)
+        return self.range_array(min_time, max_time)
+
+
+    def series_array(self, columns='filtered'):
+        '''Return the entire series as contiguous arrays; see range_array.'''
+        return self.range_array(columns=columns)
+
+
+    def range_array(self, min_time=-np.inf, max_time=np.inf,\
+            columns='filtered'):
+        '''Return samples with min_time <= t <= max_time as float64 arrays.
+        INPUTS
+            min_time, max_time - float
+                Time range of interest (shifted time, in seconds).
+            columns - string
+                'filtered' returns (t, filtered); 'raw' returns (t, vals);
+                'both' returns (t, vals, filtered). Columns not asked for are
+                never fetched.
+        '''
+        names = COLUMN_SETS[columns]
+
+        # Completed segments not yet written. Look before querying: a commit
+        # in between leaves a segment in both places, never in neither.
+        with self.lock:
+            pending = [doc for doc in self._pending if\
+                    (doc['max_time'] >= min_time) and\
+                    (doc['min_time'] <= max_time)]
+
+        # Only segments overlapping the range.
+        query = {'owner_id': self._id, 'is_flushed': True}
+        if min_time > -np.inf:
+            query['max_time'] = {'$gte': min_time}
+        if max_time < np.inf:
+            query['min_time'] = {'$lte': max_time}
+
+        # Count samples from segment metadata; allocate once.
+        meta = list(self.db.segments.find(query, {'itr': 1, 'seq': 1}).\
+                sort('seq', 1))
+        stored = set([seg.get('seq') for seg in meta])
+        pending = [doc for doc in pending if doc['seq'] not in stored]
+        total = int(np.sum([seg['itr'] for seg in meta + pending]))
+        out = [np.empty(total) for _ in range(1 + len(names))]
+
+        # Fill, segment by segment; stored segments first, then pending.
+        fields = {name: 1 for name in ['time'] + names}
+        if len(meta) > 0 and ('seq' in meta[-1]):
+            query['seq'] = {'$lte': meta[-1]['seq']}
+        cursor = self.db.segments.find(query, fields).sort('seq', 1)
+        k = 0
+        for seg in itertools.chain(cursor, pending):
+            t = unpack_array(seg['time'])
+            n = min(len(t), total - k)
+            out[0][k:k+n] = t[:n]
+            for array, name in zip(out[1:], names):
+                array[k:k+n] = unpack_array(seg[name])[:n]
+            k += n
+
+        # Time is monotonic, so trimming the ends is a pair of slices.
+        lo = np.searchsorted(out[0][:k], min_time, side='left')
+        hi = np.searchsorted(out[0][:k], max_time, side='right')
+        return tuple(array[lo:hi] for array in out)
+
+
+    def count_range(self, min_time=-np.inf, max_time=np.inf):
+        '''Count stored samples with min_time <= t <= max_time.
+        OUTPUTS
+            nb_samples - int
+                Number of samples in range.
+            last_seq - int
+                Sequence number of the last segment counted. Pass it on to
+                iter_range, so data arriving meanwhile doesn't change the
+                answer.
+        '''
+        query = {'owner_id': self._id, 'is_flushed': True}
+        query['max_time'] = {'$gte': min_time}
+        query['min_time'] = {'$lte': max_time}
+        fields = {'itr': 1, 'seq': 1, 'min_time': 1, 'max_time': 1}
+        nb_samples, last_seq = 0, -1
+        for seg in self.db.segments.find(query, fields).sort('seq', 1):
+            last_seq = seg['seq']
+            if (seg['min_time'] >= min_time) and (seg['max_time'] <= max_time):
+                nb_samples += seg['itr']
+                continue
+            # Straddles an end of the range; look at the actual times.
+            doc = self.db.segments.find_one(qry(seg), {'time': 1})
+            t = unpack_array(doc['time'])
+            nb_samples += len(t[trim(t, min_time, max_time)])
+        return nb_samples, last_seq
+
+
+    def iter_range(self, min_time=-np.inf, max_time=np.inf,\
+            columns='filtered', last_seq=None, batch_size=16):
+        '''Generate (t, values...) arrays, one segment at a time, for stored
+           samples with min_time <= t <= max_time. Memory use is constant,
+           however long the series.'''
+        query = {'owner_id': self._id, 'is_flushed': True}
+        query['max_time'] = {'$gte': min_time}
+        query['min_time'] = {'$lte': max_time}
+        if last_seq is not None:
+            query['seq'] = {'$lte': last_seq}
+        names = ['time'] + COLUMN_SETS[columns]
+        cursor = self.db.segments.find(query, {name: 1 for name in names}).\
+                sort('seq', 1).batch_size(batch_size)
         for seg in cursor:
-            v += seg['filtered']
-            t += seg['time']
-        return (t,v)
+            t = unpack_array(seg['time'])
+            keep = trim(t, min_time, max_time)
+            yield tuple(unpack_array(seg[name])[:len(t)][keep] for name in\
+                    names)
+
+
+    def summary_level(self, min_time=-np.inf, max_time=np.inf,\
+            nb_buckets=1000):
+        '''The coarsest summary level (samples per bucket) that still has at
+           least nb_buckets buckets between min_time and max_time; None if
+           only the raw data are that fine, or there are no summaries (a
+           legacy series not yet migrated; see backfill_summaries).'''
+        if 'summary' not in self.model:
+            return None
+        stats = self.stats
+        duration, fs = self.props
+        if (fs == 0) or (stats['min_time'] is None):
+            return None
+
+        # Time is continuous across pauses, so fs gives the sample count.
+        span = min(max_time, stats['max_time']) - \
+                max(min_time, stats['min_time'])
+        for level in sorted(self.model['summary']['levels'], reverse=True):
+            if span * fs / level >= nb_buckets:
+                return level
+        return None
+
+
+    def iter_summary(self, level, min_time=-np.inf, max_time=np.inf):
+        '''Generate buckets at one level that start in the time range, a
+           document at a time, as dicts of arrays (see pyramid.py).'''
+        query = self.summary_query(level, min_time, max_time)
+        fields = {name: 1 for name in SUMMARY_FIELDS}
+        for doc in self.db.summaries.find(query, fields).sort('start', 1):
+            keep = trim(doc['t'], min_time, max_time)
+            yield {name: np.asarray(doc[name])[keep] for name in\
+                    SUMMARY_FIELDS}
+
+
+    def summary_query(self, level, min_time, max_time):
+        '''Summaries documents at one level overlapping the time range.'''
+        return {'owner_id': self._id, 'level': level,\
+                'max_time': {'$gte': min_time}, 'min_time': {'$lte': max_time}}
+
+
+    def segments_after(self, seq=-1, columns='filtered', limit=None):
+        '''Return completed segments numbered after seq, oldest first.
+        INPUTS
+            seq - int
+                Sequence number of the last segment already seen.
+            columns - string
+                As in range_array.
+            limit - int
+                Return at most this many segments.
+        OUTPUTS
+            segments - list
+                A (seq, t, values...) tuple of arrays for each segment;
+                includes segments completed but not yet written.
+        '''
+        names = COLUMN_SETS[columns]
+        with self.lock: # before querying; see range_array.
+            pending = [doc for doc in self._pending if doc['seq'] > seq]
+        query = {'owner_id': self._id, 'is_flushed': True, 'seq': {'$gt': seq}}
+        fields = {name: 1 for name in ['seq', 'time'] + names}
+        cursor = self.db.segments.find(query, fields).sort('seq', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        segments = []
+        for doc in itertools.chain(cursor, pending):
+            if (len(segments) > 0) and (doc['seq'] <= segments[-1][0]):
+                continue # written while we were looking.
+            columns = [unpack_array(doc[name]) for name in ['time'] + names]
+            segments.append(tuple([doc['seq']] + columns))
+            if limit and (len(segments) >= limit):
+                break
+        return segments
 
 
     def at_least(self, min_time):
@@ -270,15 +583,78 @@ class TimeSeriesController(ModelController):
         query['owner_id'] = self._id
         query['is_flushed'] = True
         query['min_time'] = {'$gte': min_time}
-        segs = segments.find(query)
-        print(segs.count())
-        nb_segs = np.min([segs.count(), 3])
-        # Grab the latest three segments; can fill the buffer that way.
-        for k in range(nb_segs):
-            seg = segs.next()
-            v += seg['filtered']
-            t += seg['time']
-        return t,v
+        fields = {'time': 1, 'filtered': 1}
+        # Grab the next three segments; can fill the buffer that way.
+        for seg in segments.find(query, fields).sort('seq', 1).limit(3):
+            v.append(unpack_array(seg['filtered']))
+            t.append(unpack_array(seg['time']))
+        return concatenate(t, v)
+
+
+    def position_at(self, time):
+        '''Read position (seq, offset) of the first sample at or after time.'''
+        query = {'owner_id': self._id, 'is_flushed': True,\
+                'max_time': {'$gte': time}}
+        cursor = self.db.segments.find(query, {'seq': 1, 'time': 1}).\
+                sort('seq', 1).limit(1)
+        for seg in cursor:
+            offset = np.searchsorted(unpack_array(seg['time']), time)
+            return seg['seq'], int(offset)
+        return self.latest_position()
+
+
+    def latest_position(self, nb_segments=1):
+        '''Read position at the start of the last few completed segments.'''
+        return max(self.model['segment_counter'] - nb_segments, 0), 0
+
+
+    def read_from(self, seq=0, offset=0, max_segments=3, cache=None,\
+            read_ahead=0):
+        '''Return the samples from a read position on, and the next position.
+        INPUTS
+            seq, offset - int
+                Read position: sample offset within segment number seq.
+            max_segments - int
+                Read at most this many segments.
+            cache - LRU
+                Optional cache of segment arrays, keyed by (series, seq).
+                Completed segments never change, so entries never go stale.
+            read_ahead - int
+                Segments beyond max_segments to fetch into the cache, so
+                the next read (during playback, say) finds them there.
+        OUTPUTS
+            t, v - array
+                Time and filtered values; only samples not read before.
+            seq, offset - int
+                Where the next read should start.
+        '''
+        last = min(seq + max_segments, self.model['segment_counter']) - 1
+        segments = {}
+        if cache is not None:
+            for k in range(seq, last + 1):
+                segment = cache.get((self._id, k))
+                if segment is None:
+                    break
+                segments[k] = segment
+        first_missing = seq + len(segments)
+        if first_missing <= last:
+            limit = last - first_missing + 1 + read_ahead
+            for segment in self.segments_after(first_missing - 1, limit=limit):
+                if cache is not None:
+                    cache.put((self._id, segment[0]), segment)
+                segments[segment[0]] = segment
+
+        # Stitch together, skipping what the reader has already seen.
+        t, v = [], []
+        for k in range(seq, last + 1):
+            if k not in segments:
+                break
+            t.append(segments[k][1][offset:])
+            v.append(segments[k][2][offset:])
+            seq, offset = k + 1, 0
+        if len(t) == 0:
+            return np.array([]), np.array([]), seq, offset
+        return np.concatenate(t), np.concatenate(v), seq, offset
 
 
     def last_segment(self):
@@ -289,25 +665,13 @@ class TimeSeriesController(ModelController):
         query['owner_id'] = self._id
         query['is_flushed'] = True
         try:
-            seg = segments.find(query).sort('$natural',-1).next()
-        except:
+            seg = segments.find(query).sort('seq', -1).limit(1).next()
+        except StopIteration:
             seg = None
         if seg:
-            v += seg['filtered']
-            # v += seg['vals']
-            t += seg['time']
-        return (t,v)
-
-
-    def load_segment(self):
-        '''Load the latest segment.'''
-        latest = self.db.segments.\
-                find({'owner_id':self._id}, {'_id':1}).\
-                sort([('created_at', -1)]).\
-                limit(-1).next()
-
-        # Assign current segment as attribute on this time series.
-        self.segment = SegmentController(self.db, _id=q(latest))
+            v.append(unpack_array(seg['filtered']))
+            t.append(unpack_array(seg['time']))
+        return concatenate(t, v)
 
 
     def create(self, data):
@@ -315,24 +679,112 @@ class TimeSeriesController(ModelController):
         data['segment_size'] = 800
         data['freq_cutoff'] = 10
         data['filter_order'] = 3
-        data['filter_coefs'] = []
+        data['filter_state'] = []
+        data['beat_state'] = None
+        if 'filter_stages' not in data:
+            data['filter_stages'] = [['lowpass', data['filter_order'],\
+                    data['freq_cutoff']]]
         data['start_time'] = -1
+        data['segment_counter'] = 0
+        data['stats'] = empty_stats()
+        data['summary'] = empty_summary()
+        if 'segment_format' not in data:
+            data['segment_format'] = DEFAULT_SEGMENT_FORMAT
+        if data['segment_format'] == 'packed':
+            dtypes = dict(PACKED_DTYPES)
+            dtypes.update(data.get('column_dtypes', {}))
+            data['column_dtypes'] = dtypes
         self._create(data)
-        self.add_segment()
 
 
-    def add_segment(self, current_segment=None):
-        '''Add a new segment to the time series.'''
+    def add_segment(self):
+        '''Start a new, in-memory segment. It hits the database only once it
+           is complete; see complete_segment and commit.'''
         segment_data = {}
         segment_data['owner_id'] = self._id
         segment_data['segment_size'] = self.model['segment_size']
-        if self.number_of_segments == 0:
-            segment_data['initial_segment'] = True
-        else:
-            segment_data['initial_segment'] = False
-        segment = SegmentController(self.db, data=segment_data)
-        self._update()
-        self.load_segment()
+        segment_data['format'] = self.model.get('segment_format', 'list')
+        if segment_data['format'] == 'packed':
+            segment_data['column_dtypes'] = self.model['column_dtypes']
+        segment_data['seq'] = self.model['segment_counter']
+        segment_data['initial_segment'] = \
+                (self.model['segment_counter'] == 0)
+        self._segment = SegmentController(self.db, data=segment_data)
+        self._nb_filtered = 0
+
+
+    def complete_segment(self):
+        '''Filter and finalize the current segment; queue it for writing.'''
+        self.filter_segment() # butterworth filter this guy.
+        self._pending.append(self.segment.flush())
+        self.summarize_segment()
+        self.queue_beats()
+        self.update_stats(self.segment)
+        self.model['segment_counter'] += 1
+        self.add_segment()
+
+
+    def pending_writes(self):
+        '''Hand over queued segments, plus the metadata update they imply.'''
+        if len(self._pending) == 0:
+            return [], None
+        docs, self._pending = self._pending, []
+        meta = {}
+        meta['filter_state'] = self.model.get('filter_state', [])
+        if 'beat_state' in self.model:
+            meta['beat_state'] = self.model['beat_state']
+        meta['segment_counter'] = self.model['segment_counter']
+        meta['stats'] = self.stats
+        if 'summary' in self.model:
+            meta['summary'] = self.model['summary']
+        return docs, meta
+
+
+    def pending_summaries(self):
+        '''Hand over queued summary buckets, as upserts. Unfinished buckets
+           are written when recording stops, then replaced once complete.'''
+        docs, self._summaries = self._summaries, []
+        return [UpdateOne({'owner_id': doc['owner_id'], 'level': doc['level'],\
+                'start': doc['start']}, {'$set': doc}, upsert=True) for doc\
+                in docs]
+
+
+    def pending_beats(self):
+        '''Hand over queued beats documents.'''
+        docs, self._beats = self._beats, []
+        return docs
+
+
+    def commit(self):
+        '''Write completed segments: one insert, one small $set.'''
+        with self.lock:
+            docs, meta = self.pending_writes()
+            summaries = self.pending_summaries()
+            beats = self.pending_beats()
+            if len(docs) == 1:
+                self.db.segments.insert_one(docs[0])
+            elif len(docs) > 1:
+                self.db.segments.insert_many(docs)
+            if len(summaries) > 0:
+                self.db.summaries.bulk_write(summaries)
+            if len(beats) > 0:
+                self.db.beats.insert_many(beats)
+            if meta:
+                self.collection.update_one(qwrap(self._id), {'$set': meta})
+
+
+    def close(self, commit=True):
+        '''Write out a partially filled segment (when streaming stops, say).'''
+        with self.lock:
+            if (self._segment is not None) and\
+                    (self._segment.model['itr'] > 0):
+                self.complete_segment()
+            self.queue_partial_summaries()
+            if self._detector is not None: # the last beat is final now.
+                self._new_beats += self._detector.flush()
+                self.queue_beats()
+            if commit:
+                self.commit()
 
 
     @property
@@ -348,22 +800,29 @@ class TimeSeriesController(ModelController):
            retain the actual time in the form of the unix epoch time.i
         '''
         dt, fs = self.mean_sampling_rate()
-        seg = self.last_segment()
+        last_time = self.stats['max_time'] or 0
 
         # Reference time is such that current timestamp is sampled to match
         # the last segment.
-        return (timestamp - (np.max(seg[0]) + dt))
+        return (timestamp - (last_time + dt))
 
 
     def push(self, timestamp, value):
         '''Push a new (timestamp, value) into the time series.'''
 
+        with self.lock:
+            self._push(timestamp, value)
+            if self.autocommit:
+                self.commit()
+
+
+    def _push(self, timestamp, value):
+        '''Push a sample; completed segments are queued, not yet written.'''
+
         # Check to see if there is room in the current segment.
         if self.segment.is_full:
-            # Need to flush this segment to disk and start anew.
-            self.filter_segment() # butterworth filter this guy.
-            self.segment.flush()
-            self.add_segment() 
+            # Need to flush this segment and start anew.
+            self.complete_segment()
 
         # If this is the first segment, reference time is current epoch time.
         if not self.segment.has_reference_time:
@@ -379,9 +838,7 @@ class TimeSeriesController(ModelController):
         # Check for expired segment (this timestamp too big to fit given the
         # average dt.
         if self.segment.is_expired(shifted_time, self.mean_dt):
-            self.filter_segment() # butterworth filter this guy.
-            self.segment.flush()
-            self.add_segment() 
+            self.complete_segment()
             self.segment.model['reference_time'] = \
                     self.calculate_reference_time(timestamp)
             # Recalculate the shift w.r.t new data.
@@ -391,68 +848,227 @@ class TimeSeriesController(ModelController):
         self.segment.push(shifted_time, value, epoch=timestamp)
 
 
-    def filter_segment(self):
-        '''Run a low pass filter on the data in the current segment.'''
+    def extend(self, timestamps, values):
+        '''Push a batch of (timestamp, value) pairs into the time series.'''
+        with self.lock:
+            for timestamp, value in zip(timestamps, values):
+                self._push(float(timestamp), float(value))
+            if self.segment.model['itr'] - self._nb_filtered >= FILTER_BATCH:
+                self.filter_segment() # as the data arrive.
+            if self.autocommit:
+                self.commit()
 
-        # For convenience!
-        t = self.segment.model['time']
-        y = self.segment.model['vals']
 
-        # Set parameters of the filter.
-        order = self.model['filter_order']
-        freq = self.model['freq_cutoff']
-        coefs = self.model['filter_coefs']
-        
-        # Filter segment; store filter coefficients in time series.
-        y_filt, coefs = lowpass(t, y, freq_cutoff=freq, filter_order=order,\
-                                zi=coefs) 
+    def filter_segment(self):
+        '''Filter samples added to the current segment since last time.'''
+        itr = self.segment.model['itr']
+        if itr <= self._nb_filtered:
+            return
+        filt = self.streaming_filter()
+        if filt is None:
+            return # sampling rate not known yet; filter these later.
+
+        # Filtering the data. Both get written when the segment does.
+        batch = slice(self._nb_filtered, itr)
+        self.segment.model['filtered'][batch] = \
+                filt.filter(self.segment.model['vals'][batch])
+        self.model['filter_state'] = filt.state
+        self.detect_beats(filt.fs, self.segment.model['time'][batch],\
+                self.segment.model['filtered'][batch])
+        self._nb_filtered = itr
+
+
+    def detect_beats(self, fs, t, v):
+        '''Feed newly filtered samples to the beat detector; see beats.py.'''
+        if 'beat_state' not in self.model:
+            return # legacy series; see processor.scan_for_peaks.
+        if self._detector is None:
+            self._detector = BeatDetector(fs, state=self.model['beat_state'])
+        self._new_beats += self._detector.push(t, v)
+
+
+    def queue_beats(self):
+        '''Queue beats found since last time as one beats document; note
+           where the detector is, to resume from there.'''
+        if self._detector is None:
+            return
+        self.model['beat_state'] = self._detector.state
+        if len(self._new_beats) == 0:
+            return
+        t, height, bpm = [list(column) for column in zip(*self._new_beats)]
+        self._beats.append({'owner_id': self._id, 'min_time': t[0],\
+                'max_time': t[-1], 't': t, 'height': height, 'bpm': bpm})
+        self._new_beats = []
 
-        # Update the models.
-        self.model['filter_coefs'] = coefs
 
-        # Filtering the data.
-        self.segment.model['filtered'] = y_filt
-        
-        # Fast updates of time series and the segment.
-        self.db.time_series.update_one(qwrap(self._id),\
-                {'$set':{'filter_coefs': coefs}})
-        self.db.segments.update_one(qwrap(self.segment._id),\
-                {'$set':{'filtered': y_filt}})
+    @property
+    def bpm(self):
+        '''Heart rate from the beat detector, as of the latest beat; 0
+           until there are beats (or if this series isn't being recorded).'''
+        return self._detector.bpm if self._detector is not None else 0
+
+
+    def beats_in(self, min_time=-np.inf, max_time=np.inf):
+        '''Stored beats in the time range, as arrays: times, heights, and
+           the heart rate as of each.'''
+        query = {'owner_id': self._id, 'max_time': {'$gte': min_time},\
+                'min_time': {'$lte': max_time}}
+        t, height, bpm = [], [], []
+        for doc in self.db.beats.find(query).sort('min_time', 1):
+            keep = trim(doc['t'], min_time, max_time)
+            t += doc['t'][keep]
+            height += doc['height'][keep]
+            bpm += doc['bpm'][keep]
+        return np.array(t), np.array(height), np.array(bpm)
+
+
+    def streaming_filter(self):
+        '''The filter for this series, at the running sampling rate.
+        -----
+            The rate is rounded to the nearest Hz, which changes nothing
+            noticeable about the filter but means the design (cached; see
+            filters.design_sos) is found rather than redone. State carries
+            over, including across restarts by way of the model. Series
+            that predate filter_stages are lowpass filtered, as they were.
+        '''
+        fs = self.mean_fs
+        if fs == 0: # first segment; estimate from what we have.
+            t = self.segment.time
+            fs = 1/np.median(np.diff(t)) if len(t) > 1 else 0
+        if not np.isfinite(fs) or (fs <= 0):
+            return None
+        fs = float(max(round(fs), 1))
+        if (self._filter is None) or (self._filter.fs != fs):
+            stages = self.model.get('filter_stages') or [['lowpass',\
+                    self.model['filter_order'], self.model['freq_cutoff']]]
+            self._filter = StreamingFilter(fs, stages,\
+                    state=self.model.get('filter_state'))
+        return self._filter
+
+
+    def summarize_segment(self):
+        '''Fold the completed segment into the summaries.'''
+        if 'summary' not in self.model:
+            return # legacy series; see backfill_summaries.
+        itr = self.segment.model['itr']
+        self.fold_summary(self.segment.time,\
+                self.segment.model['filtered'][:itr])
+
+
+    def fold_summary(self, t, v):
+        '''Fold the next samples into every level; queue completed buckets.'''
+        summary = self.model['summary']
+        for level in summary['levels']:
+            key = str(level)
+            start, buckets, summary['partial'][key] = summarize(t, v,\
+                    summary['nb_samples'], level, summary['partial'][key])
+            if buckets is not None:
+                self.queue_summary(level, start, buckets)
+        summary['nb_samples'] += len(t)
+
+
+    def queue_summary(self, level, start, buckets):
+        '''Queue one summaries document: consecutive buckets at one level.'''
+        doc = {'owner_id': self._id, 'level': level, 'start': start,\
+                'min_time': buckets['t'][0], 'max_time': buckets['t_end'][-1]}
+        doc.update(buckets)
+        self._summaries.append(doc)
+
+
+    def queue_partial_summaries(self):
+        '''Queue the unfinished bucket at each level, so summaries reach the
+           end of the data while recording is stopped.'''
+        if 'summary' not in self.model:
+            return
+        for key, partial in self.model['summary']['partial'].items():
+            if partial is not None:
+                buckets = finish({name: [value] for name, value in\
+                        partial.items()})
+                self.queue_summary(int(key), partial['index'], buckets)
+
+
+    def rebuild_summary(self):
+        '''Summarize stored segments from scratch (legacy series); save.'''
+        with self.lock:
+            self.commit()
+            self.db.summaries.delete_many({'owner_id': self._id})
+            self.model['summary'] = empty_summary()
+            for t, v in self.iter_range():
+                self.fold_summary(t, v)
+            self.queue_partial_summaries()
+            summaries = self.pending_summaries()
+            if len(summaries) > 0:
+                self.db.summaries.bulk_write(summaries)
+            self.collection.update_one(qwrap(self._id),\
+                    {'$set': {'summary': self.model['summary']}})
 
 
     @property
     def props(self):
         '''Return the total duration and mean sampling rate of time series.'''
-
-        # Do it all in a single query, rather than separate properties.
-        query = {'owner_id': self._id}
-        limit = {'min_time': 1, 'max_time': 1}
-        segments = list(self.db.segments.find(query, limit))
-        duration = np.sum([s['max_time'] - s['min_time'] for s in segments]) 
-        samples = len(segments) * self.model['segment_size']
-        sampling_rate = samples/duration
+        stats = self.stats
+        duration = stats['duration']
         if not duration:
-            duration = 0
-            sampling_rate = 0
-        return duration, sampling_rate
+            return 0, 0
+        return duration, stats['nb_samples']/duration
 
 
     def mean_sampling_rate(self):
-        '''Return the mean sampling rate of the entire series.'''
-        query = {}
-        query['owner_id'] = self._id
-        query['is_flushed'] = True
-        segments = self.db.segments.find(query) 
-         
-        # Estimate sampling rate in segments.
-        dt = []
-        for k, segment in enumerate(segments):
-            dt.append(np.mean(np.diff(segment['time'])))
+        '''Return the (robust, running) sampling interval and rate.'''
+        dt = self.stats['dt_recent']
 
         # Cache the values.
-        self.mean_dt = np.median(dt) if len(dt) > 0 else 0
-        self.mean_fs = np.median(1/np.array(dt)) if len(dt) > 0 else 0
-        return self.mean_dt, self.mean_fs 
+        mean_dt = np.median(dt) if len(dt) > 0 else 0
+        mean_fs = np.median(1/np.array(dt)) if len(dt) > 0 else 0
+        self._rates = (mean_dt, mean_fs)
+        return self._rates
+
+
+    @property
+    def mean_dt(self):
+        '''Cached running sampling interval.'''
+        if self._rates is None:
+            self.mean_sampling_rate()
+        return self._rates[0]
+
+
+    @property
+    def mean_fs(self):
+        '''Cached running sampling rate.'''
+        if self._rates is None:
+            self.mean_sampling_rate()
+        return self._rates[1]
+
+
+    def update_stats(self, segment):
+        '''Fold a completed segment into the running statistics.'''
+        stats = self.stats
+        nb_samples = segment.model['itr']
+        stats['nb_samples'] += nb_samples
+        stats['nb_segments'] += 1
+        stats['duration'] += float(segment.duration)
+        if stats['min_time'] is None:
+            stats['min_time'] = float(segment.min_time)
+        stats['max_time'] = float(segment.max_time)
+        if segment.model['dt'] > 0:
+            stats['dt_recent'] = (stats['dt_recent'] +\
+                    [segment.model['dt']])[-DT_HISTORY:]
+        self.mean_sampling_rate()
+
+
+    def rebuild_stats(self):
+        '''Recompute statistics from scratch (legacy series) and save them.'''
+        self.model['stats'] = empty_stats()
+        query = {'owner_id': self._id, 'is_flushed': True}
+        fields = {'time': 1, 'min_time': 1, 'max_time': 1}
+        for doc in self.db.segments.find(query, fields).sort('seq', 1):
+            segment = SegmentController(self.db, model=doc)
+            dt = np.diff(segment.model['time'])
+            segment.model['itr'] = len(segment.model['time'])
+            segment.model['dt'] = float(np.mean(dt)) if len(dt) > 0 else 0.0
+            self.update_stats(segment)
+        self.collection.update_one(qwrap(self._id),\
+                {'$set': {'stats': self.model['stats']}})
 
 
     @property
@@ -469,14 +1085,22 @@ class SegmentController(ModelController):
         data. It must be associated with a time series object. The time series
         object actually handles the creating, updating, and filtering, and the
         stitching together of individual segments.
+
+        A segment being filled lives only in memory, in preallocated arrays.
+        Once complete it is written to the database exactly once, and never
+        modified afterwards.
     '''
 
-    def __init__(self, database, _id=None, data=None):
+    def __init__(self, database, _id=None, data=None, model=None):
 
-        if (_id is None): # initialize segment
-            data = self.init_new_segment(data)
-        ModelController.__init__(self, 'segments', database, _id=_id,\
-                data=data)
+        if (model is not None): # wrap a document we already have.
+            model['time'] = unpack_array(model['time'])
+            ModelController.__init__(self, 'segments', database, model=model)
+        elif (_id is None): # initialize segment, in memory only.
+            model = self.init_new_segment(data)
+            ModelController.__init__(self, 'segments', database, model=model)
+        else:
+            ModelController.__init__(self, 'segments', database, _id=_id)
 
 
     def read(self):
@@ -485,22 +1109,23 @@ class SegmentController(ModelController):
 
 
     def init_new_segment(self, data):
+        data['_id'] = ObjectId()
+        data['created_at'] = created_at()
         data['itr'] = 0
         data['min_time'] = 0
         data['max_time'] = 0
         data['reference_time'] = -1
 
         # Time is incremental 'delta' time; unix epoch stores actual time.
-        data['time'] = list(np.zeros(data['segment_size']))
-        data['epoch'] = list(np.zeros(data['segment_size']))
+        data['time'] = np.zeros(data['segment_size'])
+        data['epoch'] = np.zeros(data['segment_size'])
 
         # vals stores raw values; filtered stores digitally filtered version.
-        data['vals'] = list(np.zeros(data['segment_size']))
-        data['filtered'] = list(np.zeros(data['segment_size']))
+        data['vals'] = np.zeros(data['segment_size'])
+        data['filtered'] = np.zeros(data['segment_size'])
 
-        # When the segment is full it is flushed to the database.
+        # When the segment is complete it is flushed to the database.
         data['is_flushed'] = False
-        if '_id' in data: del data['_id']
         return data
 
 
@@ -511,9 +1136,9 @@ class SegmentController(ModelController):
 
 
     def flush(self):
-        '''Flush current segment to the disk. Load new segment into object.'''
+        '''Finalize the segment. Returns the document to be written.'''
 
-        # Officially publish the segment to the database..
+        # Officially publish the segment.
         self.model['is_flushed'] = True
         
         # Update min/max times as well as segment duration.
@@ -521,23 +1146,42 @@ class SegmentController(ModelController):
         self.model['max_time'] = self.max_time
         self.model['duration'] = self.duration
 
-        # Push to database.
-        self._update()
+        # Summarize the sampling interval, for running statistics.
+        dt = np.diff(self.time)
+        self.model['dt'] = float(np.mean(dt)) if len(dt) > 0 else 0.0
+        return self.document
+
+
+    def encode(self, column):
+        '''Encode the filled part of a column in the storage format.'''
+        data = self.model[column][:self.model['itr']]
+        if self.model.get('format') != 'packed':
+            return data.tolist()
+        dtype = self.model['column_dtypes'][column]
+        scale = ADC_SCALE if (dtype[1] == 'i') else None
+        return pack_array(data, dtype=dtype, scale=scale)
+
+
+    @property
+    def document(self):
+        '''The segment as it should be stored in the database.'''
+        document = dict(self.model)
+        for column in ['time', 'epoch', 'vals', 'filtered']:
+            document[column] = self.encode(column)
+        return document
 
 
     def push(self, timestamp, value, epoch=None):
         '''Push an observation into the segment.'''
 
-        # Increment pointer.
-        itr = self.model['itr']
-        self.model['itr'] += 1
-
         # Insert element at appropriate place!
+        itr = self.model['itr']
         if not self.is_full:
             self.model['time'][itr] = timestamp
             self.model['vals'][itr] = value
             if epoch:
-                self.model['epoch'] = epoch
+                self.model['epoch'][itr] = epoch
+            self.model['itr'] += 1
 
 
     def is_expired(self, shifted_timestamp, dt):
@@ -547,38 +1191,33 @@ class SegmentController(ModelController):
         safety_factor = 25
         we_know_dt = (dt>0)
         data_present = self.model['itr'] > 0
-        big_jump = (shifted_timestamp - self.max_time) > (dt * safety_factor)
-        expired = (we_know_dt * data_present * big_jump)
-        if expired:
-            itr = self.model['itr']
-            self.model['time'] = self.model['time'][:itr]
-            self.model['vals'] = self.model['vals'][:itr]
-            self.model['filtered'] = self.model['filtered'][:itr]
-        return expired
+        if not (we_know_dt and data_present):
+            return False
+        return (shifted_timestamp - self.max_time) > (dt * safety_factor)
 
 
     @property
     def vals(self):
         '''The values recorded in this segment.'''
-        return self.model['vals']
+        return self.model['vals'][:self.model['itr']]
 
 
     @property
     def time(self):
         '''The time values recorded in this segment.'''
-        return self.model['time']
+        return self.model['time'][:self.model['itr']]
 
 
     @property
     def min_time(self):
         '''Minimum time present in the segment.'''
-        return np.min(self.model['time'])
+        return np.min(self.time)
 
 
     @property
     def max_time(self):
         '''Maximum time associated with segment.'''
-        return np.max(self.model['time'])
+        return np.max(self.time)
 
 
     @property
@@ -599,6 +1238,100 @@ class SegmentController(ModelController):
         return self.model['reference_time'] > 0
 
 
+def trim(t, min_time, max_time):
+    '''Slice of (monotonic) t with min_time <= t <= max_time.'''
+    lo = np.searchsorted(t, min_time, side='left')
+    hi = np.searchsorted(t, max_time, side='right')
+    return slice(lo, hi)
+
+
+def empty_stats():
+    '''Running statistics for a time series with no data yet.'''
+    stats = {}
+    stats['nb_samples'] = 0
+    stats['nb_segments'] = 0
+    stats['duration'] = 0.0
+    stats['min_time'] = None
+    stats['max_time'] = None
+    stats['dt_recent'] = []
+    return stats
+
+
+def count_segments(database, models):
+    '''Give legacy time series models (written before segments were
+       append-only) a segment counter, counting all of them in one query.'''
+    if len(models) == 0:
+        return
+    ids = [model['_id'] for model in models]
+    match = {'owner_id': {'$in': ids}, 'is_flushed': True}
+    group = {'_id': '$owner_id', 'count': {'$sum': 1}}
+    counts = {doc['_id']: doc['count'] for doc in\
+            database.segments.aggregate([{'$match': match}, {'$group': group}])}
+    for model in models:
+        model['segment_counter'] = counts.get(model['_id'], 0)
+
+
+def encode_cursor(positions):
+    '''Opaque read cursor for {series_id: (seq, offset)}; see read_from.'''
+    positions = {str(_id): [int(seq), int(offset)] for _id, (seq, offset)\
+            in positions.items()}
+    text = json.dumps(positions, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Inverse of encode_cursor. Returns {} for a cursor we can't read.'''
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {ObjectId(_id): (int(seq), int(offset)) for _id,\
+                (seq, offset) in positions.items()}
+    except (ValueError, TypeError, AttributeError):
+        return {}
+
+
+def backfill_sequence(database):
+    '''Number legacy segments (written before segments carried a sequence
+       number) in time order, and bring each series' counter up to date.'''
+    legacy = {'seq': {'$exists': False}, 'is_flushed': True}
+    for owner_id in database.segments.distinct('owner_id', legacy):
+        query = {'owner_id': owner_id, 'seq': {'$exists': True}}
+        latest = list(database.segments.find(query, {'seq': 1}).\
+                sort('seq', -1).limit(1))
+        seq = latest[0]['seq'] + 1 if latest else 0
+        query = {'owner_id': owner_id, 'seq': {'$exists': False},\
+                'is_flushed': True}
+        cursor = database.segments.find(query, {'_id': 1}).\
+                sort([('min_time', 1), ('_id', 1)])
+        for segment in cursor:
+            database.segments.update_one(qry(segment), {'$set': {'seq': seq}})
+            seq += 1
+        database.time_series.update_one(qwrap(owner_id),\
+                {'$set': {'segment_counter': seq}})
+
+
+def backfill_summaries(database):
+    '''Build summaries for legacy series (written before there were any).
+       Run at startup, before anything streams: rebuilding writes to the
+       series, so it must not race a writer.'''
+    models = list(database.time_series.find({'summary': {'$exists': False}}))
+    count_segments(database, [model for model in models if\
+            'segment_counter' not in model])
+    for model in models:
+        series = TimeSeriesController(database, model=model)
+        series.log.info(' > Summarizing legacy series {}.'.format(series._id))
+        series.rebuild_summary()
+
+
+def ensure_indexes(database):
+    '''Create the indexes every controller declares, and bring legacy data
+       up to date. Call at startup.'''
+    backfill_sequence(database)
+    backfill_summaries(database)
+    for controller in [SessionController, TimeSeriesController]:
+        for collection, keys, options in controller.indexes:
+            database[collection].create_index(keys, **options)
+
+
 if __name__=='__main__':
 
     '''Simulate connection to a data source.'''
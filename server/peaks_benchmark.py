@@ -0,0 +1,181 @@
+'''Check peak finding against the original code, and time both.
+-----
+    Runs find_peaks on every window scan_for_peaks looks at (3 s, half
+    overlapping) plus a batch of random windows of recorded data, and
+    scan_for_peaks on the whole recording and on a longer one (the data,
+    repeated). Results (peaks, or the error raised) must match the original
+    implementations, copied here verbatim.
+
+    python peaks_benchmark.py --data chl_data.dat --minutes 10
+'''
+import argparse
+import numpy as np
+from time import time
+from mathtools.utils import Vessel
+from processor import find_peaks, scan_for_peaks, dex
+
+
+def legacy_find_peaks(t, v):
+    '''The original find_peaks, verbatim.'''
+
+    v = np.array(v)
+    t = np.array(t)
+    minf = np.median(v)
+    maxf = v.max()
+
+    depths = np.linspace(minf, maxf, 500)
+    metric = []
+    for d in depths:
+        idx = np.nonzero(v>d)[0]
+        metric.append(len(idx))
+
+    m = np.cumsum(metric)/sum(metric)
+    winner = dex(m<0.85)[-1]
+    depth = depths[winner]
+
+    idx = np.nonzero(v>depth)[0]
+    df = np.diff(idx)
+
+    # Find cluster breaks; partition peak clusters.
+    cluster_breaks = np.nonzero(df>50)[0]+1
+    clusters = []
+    k = 0
+    for next_k in cluster_breaks:
+        clusters.append(idx[k:next_k])
+        k = next_k
+
+    # Identify the indices at the peaks of the clusters.
+    peak_indices = []
+    peak_height = []
+    for cluster in clusters:
+        cluster_argmax = np.argmax(v[cluster])
+        if (len(v) - cluster[cluster_argmax])>600:
+            peak_indices.append(cluster[cluster_argmax])
+
+    return np.array(peak_indices)
+
+
+def legacy_scan_for_peaks(t, v, dt=3):
+    '''The original scan_for_peaks, verbatim (but for legacy_find_peaks).'''
+    if len(t) == 0:
+        return []
+    t_ = 1.0 * t
+    t_ -= t_[0]
+    maxt = t_.max()
+    tot_increments = int(2*maxt/dt)
+    peaks = []
+    for k in range(tot_increments):
+        i_ = dex((t_>=k*dt/2) * (t_<k*dt/2+dt))
+        start_idx = i_[0]
+        t_sub = t_[i_]
+        v_sub = v[i_]
+        peaks += list(legacy_find_peaks(t_sub, v_sub) + start_idx)
+
+    # Clean up the peaks. Peaks that are too close together should be
+    # discarded.
+    peaks = np.unique(peaks)
+    dpks = np.diff(peaks)
+    mdp = np.median(dpks)
+    std = np.std(dpks)
+    z_scores = (dpks - mdp)**2/std**2
+    i_ = dex(z_scores>1.0)
+    discard = []
+
+    # Find all peaks that are too close, statistically speaking.
+    for peak_idx in i_:
+        if v[peaks[peak_idx]] > v[peaks[peak_idx+1]]:
+            discard.append(peaks[peak_idx+1])
+        else:
+            discard.append(peaks[peak_idx])
+
+    # Discard the smaller of the two nearby peaks.
+    for peak in discard:
+        i_ = dex(peak == peaks)
+        peaks= np.delete(peaks, i_)
+
+    return peaks
+
+
+def outcome(func, *args):
+    '''What func returns, or the type of error it raises.'''
+    try:
+        return func(*args)
+    except Exception as error:
+        return type(error)
+
+
+def same(a, b):
+    '''Same peaks (values and dtype), or the same error.'''
+    if isinstance(a, type) or isinstance(b, type):
+        return a is b
+    a, b = np.asarray(a), np.asarray(b)
+    return (a.dtype == b.dtype) and np.array_equal(a, b)
+
+
+def windows(t, nb_random=200, dt=3, seed=0):
+    '''The windows scan_for_peaks uses, then random ones of 1-20 s.'''
+    t_ = t - t[0]
+    for k in range(int(2*t_.max()/dt)):
+        yield np.nonzero((t_>=k*dt/2) * (t_<k*dt/2+dt))[0]
+    rng = np.random.default_rng(seed)
+    for _ in range(nb_random):
+        start = rng.uniform(0, t_.max())
+        yield np.nonzero((t_>=start) * (t_<start+rng.uniform(1, 20)))[0]
+
+
+def best_of(func, repeats=3):
+    '''Best wall time of a few runs; and the last result.'''
+    times = []
+    for _ in range(repeats):
+        start = time()
+        result = func()
+        times.append(time() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='chl_data.dat')
+    parser.add_argument('--minutes', type=float, default=10)
+    args = parser.parse_args()
+    data = Vessel(args.data)
+    t, v = np.array(data.t), np.array(data.v)
+
+    # A longer recording: the data over and over, time carrying on.
+    nb_copies = int(np.ceil(60 * args.minutes / (t[-1] - t[0])))
+    period = t[-1] - t[0] + np.median(np.diff(t))
+    t_long = np.concatenate([t + k * period for k in range(nb_copies)])
+    v_long = np.tile(v, nb_copies)
+
+    # Same answers, window by window?
+    cases = [i_ for i_ in windows(t) if len(i_) > 0]
+    nb_errors = 0
+    for i_ in cases:
+        old = outcome(legacy_find_peaks, t[i_], v[i_])
+        new = outcome(find_peaks, t[i_], v[i_])
+        assert same(old, new), 'find_peaks changed on {:d} samples at {:d}'.\
+                format(len(i_), i_[0])
+        nb_errors += isinstance(old, type)
+    assert same(legacy_scan_for_peaks(t, v), scan_for_peaks(t, v)),\
+            'scan_for_peaks changed!'
+    print(' > find_peaks matches on {:d} windows ({:d} raising);'\
+            ' scan_for_peaks matches.'.format(len(cases), nb_errors))
+
+    # Time it.
+    scan = cases[:int(2*(t[-1]-t[0])/3)]
+    t_old, _ = best_of(lambda: [outcome(legacy_find_peaks, t[i_], v[i_]) for\
+            i_ in scan])
+    t_new, _ = best_of(lambda: [outcome(find_peaks, t[i_], v[i_]) for i_ in\
+            scan])
+    print(' > find_peaks, per window:  {:8.3f} ms -> {:8.3f} ms ({:.0f}x)'.\
+            format(1e3*t_old/len(scan), 1e3*t_new/len(scan), t_old/t_new))
+    t_old, _ = best_of(lambda: legacy_scan_for_peaks(t, v))
+    t_new, _ = best_of(lambda: scan_for_peaks(t, v))
+    print(' > scan_for_peaks:          {:8.1f} ms -> {:8.1f} ms ({:.0f}x)'.\
+            format(1e3*t_old, 1e3*t_new, t_old/t_new))
+    t_old, old = best_of(lambda: legacy_scan_for_peaks(t_long, v_long), 1)
+    t_new, new = best_of(lambda: scan_for_peaks(t_long, v_long), 1)
+    assert same(old, new), 'scan_for_peaks changed on the long recording!'
+    print(' > scan_for_peaks, {:.0f} min: {:8.1f} ms -> {:8.1f} ms ({:.0f}x)'.\
+            format(args.minutes, 1e3*t_old, 1e3*t_new, t_old/t_new))
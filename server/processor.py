@@ -4,17 +4,23 @@ from ipdb import set_trace as debug
 from database import *
 from models import *
 from mathtools.fit import Fit
+from projection import projections
 from taut_string import *
 import seaborn as sns
 from seaborn import xkcd_rgb
 from mathtools.utils import mahal
 from scipy.signal import resample
 from filters import *
+from sig_proc import peak_threshold, run_argmax, normalize_pulses
 sns.set_context('talk')
 plt.ion()
 plt.close('all')
 
 
+# Pulse features are compared on this (dilated) time grid.
+FEATURE_GRID = np.linspace(0,1,200)
+
+
 def dex(booleans):
     '''Convenience function for returning indices satisfying a boolean.'''
     return np.nonzero(booleans)[0]
@@ -28,97 +34,77 @@ def grab_session(session_name='MJL.VSM'):
 
 
 def find_peaks(t, v):
-    '''Extract pressure wave pulses from the time series.'''
+    '''Extract pressure wave pulses from the time series.
+    -----
+        The threshold is the depth, of 500 between the median and the max,
+        at which the cumulative count of samples above each depth reaches
+        85% of the total. Runs of samples above it (no more than 50 samples
+        apart) are pulses; the highest sample of each is its peak. The last
+        run may be unfinished, so it is left out, as are peaks within 600
+        samples of the end.
+    '''
 
     v = np.array(v)
     t = np.array(t)
-    minf = np.median(v)
-    maxf = v.max()
-
-    depths = np.linspace(minf, maxf, 500)
-    metric = []
-    for d in depths:
-        idx = np.nonzero(v>d)[0]
-        metric.append(len(idx))
-        
-    m = np.cumsum(metric)/sum(metric)
-    # mx = np.linspace(0,1,len(m))
-    
-    # fit = Fit(mx, nb_bases=25, reg_coefs=[0,1e-3,1e-3])
-    # ft = fit.fit(m)
-
-    # Extract the derivatives.
-    # dy = ft.dy
-    # d2y = ft.d2y
- 
-    # Find the break in the curve (where curvature, i.e. second derivative
-    # is the highest.
-    # winner = np.argmax(abs(ft.d2y)) + 100
-    # Winner is the first element less than 90% of cumsum.
-    winner = dex(m<0.85)[-1]
-    depth = depths[winner]
-
-    idx = np.nonzero(v>depth)[0] 
-    df = np.diff(idx)
+
+    # Winner is the last depth short of 85% of the cumsum.
+    depth = peak_threshold(v)
 
     # Find cluster breaks; partition peak clusters.
-    cluster_breaks = np.nonzero(df>50)[0]+1
-    clusters = []
-    k = 0
-    for next_k in cluster_breaks:
-        clusters.append(idx[k:next_k])
-        k = next_k
+    idx = np.nonzero(v>depth)[0]
+    cluster_breaks = np.nonzero(np.diff(idx)>50)[0]+1
+    if len(cluster_breaks) == 0:
+        return np.array([])
+    starts = np.append(0, cluster_breaks[:-1])
 
     # Identify the indices at the peaks of the clusters.
-    peak_indices = []
-    peak_height = []
-    for cluster in clusters:
-        cluster_argmax = np.argmax(v[cluster])
-        if (len(v) - cluster[cluster_argmax])>600:
-            peak_indices.append(cluster[cluster_argmax])
-
-    return np.array(peak_indices)
+    peak_indices = idx[run_argmax(v[idx[:cluster_breaks[-1]]], starts)]
+    peak_indices = peak_indices[(len(v) - peak_indices)>600]
+    if len(peak_indices) == 0:
+        return np.array([])
+    return peak_indices
 
 
 def scan_for_peaks(t, v, dt=3):
-    '''Scan through data in increments of dt to find peaks.'''
+    '''Scan through data in increments of dt to find peaks.
+    -----
+        Windows are dt long and overlap by half. Time is monotonic, so
+        each window's bounds are a pair of searchsorted positions, and its
+        data a view; scanning is linear in the length of the series.
+    '''
     if len(t) == 0:
         return []
     t_ = 1.0 * t
     t_ -= t_[0]
     maxt = t_.max()
     tot_increments = int(2*maxt/dt)
+    lower = np.arange(tot_increments)*dt/2
+    starts = np.searchsorted(t_, lower, side='left')
+    stops = np.searchsorted(t_, lower + dt, side='left')
     peaks = []
-    for k in range(tot_increments):
-        i_ = dex((t_>=k*dt/2) * (t_<k*dt/2+dt))
-        start_idx = i_[0]
-        t_sub = t_[i_]
-        v_sub = v[i_]
-        peaks += list(find_peaks(t_sub, v_sub) + start_idx)
+    for start_idx, stop_idx in zip(starts, stops):
+        if stop_idx == start_idx:
+            continue # a gap in the data.
+        found = find_peaks(t_[start_idx:stop_idx], v[start_idx:stop_idx])
+        if len(found) > 0:
+            peaks.append(found + start_idx)
 
     # Clean up the peaks. Peaks that are too close together should be
     # discarded.
-    peaks = np.unique(peaks)
+    peaks = np.unique(np.concatenate(peaks)) if peaks else np.unique([])
     dpks = np.diff(peaks)
     mdp = np.median(dpks)
     std = np.std(dpks)
     z_scores = (dpks - mdp)**2/std**2
     i_ = dex(z_scores>1.0)
-    discard = []
-
-    # Find all peaks that are too close, statistically speaking.
-    for peak_idx in i_:
-        if v[peaks[peak_idx]] > v[peaks[peak_idx+1]]:
-            discard.append(peaks[peak_idx+1])
-        else:
-            discard.append(peaks[peak_idx])
-
-    # Discard the smaller of the two nearby peaks.
-    for peak in discard:
-        i_ = dex(peak == peaks)
-        peaks= np.delete(peaks, i_)
-    
-    return peaks
+    if len(i_) == 0:
+        return peaks
+
+    # Of each pair of peaks too close (statistically speaking) together,
+    # discard the smaller.
+    first, second = peaks[i_], peaks[i_+1]
+    discard = np.where(v[first] > v[second], second, first)
+    return peaks[~np.isin(peaks, discard)]
 
 
 def extract_pulses(t,v,peaks):
@@ -151,28 +137,51 @@ def filter_pulses(pulses, thresh_factor=1.0):
     return pulses[keepers,:]
 
 
+def features(pulses):
+    '''Extract the features of every pulse at once.
+    -----
+        Pulses are normalized and dilated together (see
+        sig_proc.normalize_pulses), then each is linearly interpolated onto
+        FEATURE_GRID in its own dilated time, holding its last value past
+        its end. All of them are then smoothed with the same Fit, a cached
+        operator; see projection.py.
+    INPUTS
+        pulses - array
+            One pulse per row, as from extract_pulses.
+    OUTPUTS
+        t_final - array
+            FEATURE_GRID.
+        fpulses - array
+            Smoothed, normalized pulses, a row per pulse.
+        valid - array
+            Which rows mean anything; pulses that can't be normalized (or
+            give something non-finite) are masked out.
+    '''
+    v, dilation, valid = normalize_pulses(pulses)
+    nb_samples = v.shape[1]
+    v[~valid] = 0
+    dilation = np.where(valid, dilation, 1)
+
+    # Sample position of each grid point, in each pulse's dilated time.
+    position = FEATURE_GRID[None,:]/dilation[:,None]*(nb_samples-1)
+    lo = np.clip(np.floor(position).astype(int), 0, max(nb_samples-2, 0))
+    hi = np.minimum(lo+1, nb_samples-1)
+    frac = np.clip(position-lo, 0, 1)
+    rows = np.arange(v.shape[0])[:,None]
+    on_grid = v[rows,lo]*(1-frac) + v[rows,hi]*frac
+
+    fpulses = projections.fit(FEATURE_GRID, on_grid, nb_bases=75,\
+            x_new=FEATURE_GRID)
+    valid &= np.isfinite(fpulses).all(1)
+    return FEATURE_GRID, fpulses, valid
+
+
 def feature(pulse):
-    '''Extract the features from the pulse.'''
-    v = pulse
-    t_ = np.linspace(0,1,len(v))
-    v /= v.max()
-
-    md = np.median(v)
-    half_max = (1+md)/2
-    half_max_pos = np.nonzero( v <= half_max )[0][0]
-
-    dilation_factor = 0.1/t_[half_max_pos]
-    td = t_ * dilation_factor
-    stretch_point = np.nonzero(td >= 0.2)[0][0]
-    md = v[stretch_point]
-    delta = (1-md)
-    v -= md
-    v /= delta
-    t_final = np.linspace(0,1,200)
-    fitter = Fit(td, nb_bases=75)
-    f = fitter.fit(v)
-    f = fitter.resample(t_final)
-    return t_final, f.y
+    '''Extract the features from the pulse. See features.'''
+    t_final, fpulses, valid = features([pulse])
+    if not valid[0]:
+        raise ValueError('Could not normalize this pulse.')
+    return t_final, fpulses[0]
 
 
 def estimate_bpm(t,v):
@@ -188,22 +197,15 @@ def golden_representation(t,v):
     peaks = scan_for_peaks(t,v,dt=3)
     times, pulses = extract_pulses(t, v, peaks)
     clean_pulses = filter_pulses(pulses)
-    fpulses = []
-    for k, pulse in enumerate(clean_pulses):
-        try:
-            tf, fp = feature(pulse)
-            fpulses.append(fp)
-        except:
-            pass
-
-    # Stack these guys up.
-    fpulses = np.vstack(fpulses)
+    tf, fpulses, valid = features(clean_pulses)
+    if not valid.any():
+        raise ValueError('None of {:d} pulses could be normalized.'.\
+                format(len(clean_pulses)))
 
     # Compute the mean pulse.
-    the_pulse = np.median(fpulses,0)
-    fitter = Fit(tf, nb_bases=50, reg_coefs=[0,1e-3,1e-3])
-    f = fitter.fit(the_pulse)
-    the_pulse = f.y
+    the_pulse = np.median(fpulses[valid],0)
+    the_pulse = projections.fit(tf, the_pulse, nb_bases=50,\
+            reg_coefs=[0,1e-3,1e-3])
 
     i_ = dex(tf<0.60)
 
@@ -0,0 +1,89 @@
+'''Fits on grids we see again and again, kept as matrices.
+-----
+    A Fit (mathtools.fit) is linear in the data: fitting values on grid x,
+    and perhaps resampling the fit on x_new, is multiplication by a fixed
+    matrix, whose k-th column is the fit of the k-th unit vector. The first
+    fit on a grid builds that matrix: one Fit, and a solve per grid point.
+    Every fit after that is a matrix-vector product (or, for a stack of
+    rows, one matrix product). Operators are kept in an LRU, keyed by a
+    fingerprint of each grid, the Fit options, and the quantity wanted.
+'''
+import hashlib
+import numpy as np
+from mathtools.fit import Fit
+from lru import LRU
+
+
+def fingerprint(x):
+    '''A key for grid x: its shape and a digest of its values.'''
+    if x is None:
+        return None
+    x = np.ascontiguousarray(x, dtype=float)
+    return x.shape, hashlib.sha1(x.tobytes()).hexdigest()
+
+
+class ProjectionCache(object):
+    '''Bounded cache of fit operators; see the module docstring.'''
+
+    def __init__(self, capacity=32):
+        self.operators = LRU(capacity)
+
+
+    def operator(self, x, nb_bases, reg_coefs=None, basis_type=None,\
+            x_new=None, output='y'):
+        '''The matrix taking values on x to a fit of them.
+        INPUTS
+            x - array
+                Grid the data are on.
+            nb_bases, reg_coefs, basis_type
+                As for Fit; None leaves Fit's default.
+            x_new - array
+                Resample the fit here; None for the fit on x itself.
+            output - str
+                What to give: 'y', or another linear attribute of the fit
+                ('dy', 'd2y' or 'coefs', say).
+        OUTPUTS
+            operator - array
+                (len(output), len(x)), read-only.
+        '''
+        options = {'nb_bases': nb_bases}
+        if reg_coefs is not None:
+            options['reg_coefs'] = list(reg_coefs)
+        if basis_type is not None:
+            options['basis_type'] = basis_type
+        key = (fingerprint(x), fingerprint(x_new), output, nb_bases,\
+                None if reg_coefs is None else tuple(reg_coefs), basis_type)
+        operator = self.operators.get(key)
+        if operator is not None:
+            return operator
+
+        # Fit every unit vector; each fit is a column.
+        fitter = Fit(np.asarray(x, dtype=float), **options)
+        columns = []
+        for unit in np.eye(len(x)):
+            result = fitter.fit(unit)
+            if x_new is not None:
+                result = fitter.resample(x_new)
+            columns.append(np.array(getattr(result, output), dtype=float))
+        operator = np.column_stack(columns)
+        operator.setflags(write=False)
+        self.operators.put(key, operator)
+        return operator
+
+
+    def fit(self, x, y, nb_bases, reg_coefs=None, basis_type=None,\
+            x_new=None, output='y'):
+        '''Fit y (a vector, or one series per row) on x; see operator.'''
+        operator = self.operator(x, nb_bases, reg_coefs, basis_type, x_new,\
+                output)
+        return np.dot(y, operator.T)
+
+
+    @property
+    def stats(self):
+        '''Hit/miss counts and occupancy.'''
+        return self.operators.stats
+
+
+# Shared by everything that fits on fixed grids.
+projections = ProjectionCache()
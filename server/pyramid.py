@@ -0,0 +1,176 @@
+'''Min/max/mean/count summaries of a time series, at several resolutions.
+-----
+    Level L cuts a series into buckets of L consecutive samples, numbered
+    by global sample index: bucket k holds samples kL through (k+1)L - 1,
+    whichever segments they arrived in. Each bucket records the time of its
+    first and last samples, its min and max (and when they happened), its
+    mean, and its count.
+
+    Summaries are built as segments are completed. A segment rarely ends on
+    a bucket boundary, so the unfinished last bucket of each level is carried
+    (as an accumulator) into the next segment. Completed buckets are written
+    to the 'summaries' collection in one document per level per segment;
+    unfinished ones only when recording stops. See TimeSeriesController.
+'''
+import numpy as np
+
+
+# Samples per bucket at each level, finest first.
+SUMMARY_LEVELS = [10, 100, 1000]
+
+# Per-bucket arrays stored in each summaries document.
+SUMMARY_FIELDS = ['t', 't_end', 'min', 't_min', 'max', 't_max', 'mean',\
+        'count']
+
+# What envelope (and EnvelopeMerge) need of each bucket.
+ENVELOPE_FIELDS = ['min', 't_min', 'max', 't_max']
+
+
+def empty_summary(levels=SUMMARY_LEVELS):
+    '''Summary state for a time series with no data yet: samples summarized
+       so far, and the unfinished bucket (if any) at each level.'''
+    return {'levels': list(levels), 'nb_samples': 0,\
+            'partial': {str(L): None for L in levels}}
+
+
+def summarize(t, v, first_index, level, partial=None):
+    '''Fold samples into level-sized buckets.
+    INPUTS
+        t, v - array
+            Times and values of consecutive samples.
+        first_index - int
+            Global index of the first sample (samples seen before it).
+        level - int
+            Samples per bucket.
+        partial - dict
+            Accumulator for the unfinished bucket left over from before, as
+            returned by the previous call; or None.
+    OUTPUTS
+        start - int
+            Number of the first bucket in buckets.
+        buckets - dict
+            An array per SUMMARY_FIELDS entry, for completed buckets only.
+        partial - dict
+            Accumulator for the unfinished last bucket; None if there is
+            none.
+    '''
+    t, v = np.asarray(t, dtype=float), np.asarray(v, dtype=float)
+    n = len(t)
+    if n == 0:
+        return first_index // level, None, partial
+
+    # Bucket boundaries within this batch.
+    bucket = (first_index + np.arange(n)) // level
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    ends = np.append(starts[1:], n)
+    counts = ends - starts
+
+    # Sort by value within each bucket: the extremes are then at the ends.
+    # (lexsort is stable, so tied values stay in time order.)
+    order = np.lexsort((v, bucket))
+    lo, hi = order[starts], order[ends - 1]
+    acc = {'t': t[starts], 't_end': t[ends - 1], 'min': v[lo],\
+            't_min': t[lo], 'max': v[hi], 't_max': t[hi],\
+            'sum': np.add.reduceat(v, starts), 'count': counts.astype(float)}
+    acc = {key: values.tolist() for key, values in acc.items()}
+
+    # Finish off the bucket carried over from the last batch.
+    start = int(bucket[0])
+    if (partial is not None) and (partial['index'] == start):
+        first = merge(partial, {key: acc[key][0] for key in acc})
+        for key in acc:
+            acc[key][0] = first[key]
+
+    # The last bucket is complete only if the batch ends on a boundary.
+    if (first_index + n) % level == 0:
+        partial = None
+        nb_complete = len(starts)
+    else:
+        partial = {key: acc[key][-1] for key in acc}
+        partial['index'] = int(bucket[-1])
+        nb_complete = len(starts) - 1
+    if nb_complete == 0:
+        return start, None, partial
+    return start, finish({key: acc[key][:nb_complete] for key in acc}),\
+            partial
+
+
+def merge(a, b):
+    '''Combine accumulators for two consecutive stretches of one bucket.'''
+    out = dict(a)
+    out['t_end'] = b['t_end']
+    if b['min'] < a['min']:
+        out['min'], out['t_min'] = b['min'], b['t_min']
+    if b['max'] >= a['max']:
+        out['max'], out['t_max'] = b['max'], b['t_max']
+    out['sum'] = a['sum'] + b['sum']
+    out['count'] = a['count'] + b['count']
+    return out
+
+
+def finish(acc):
+    '''Turn accumulators (lists per field) into stored bucket arrays.'''
+    buckets = {key: acc[key] for key in SUMMARY_FIELDS if key in acc}
+    buckets['mean'] = (np.array(acc['sum']) / np.array(acc['count'])).tolist()
+    return buckets
+
+
+def envelope(buckets):
+    '''Bucket extremes as (t, v): each bucket's min and max, in time order.
+       Twice as many points as buckets; pulse peaks survive intact.'''
+    t_min, t_max = np.asarray(buckets['t_min']), np.asarray(buckets['t_max'])
+    v_min, v_max = np.asarray(buckets['min']), np.asarray(buckets['max'])
+    min_first = t_min <= t_max
+    t = np.column_stack((np.where(min_first, t_min, t_max),\
+            np.where(min_first, t_max, t_min))).ravel()
+    v = np.column_stack((np.where(min_first, v_min, v_max),\
+            np.where(min_first, v_max, v_min))).ravel()
+    return t, v
+
+
+def merge_groups(buckets, factor):
+    '''Merge every factor consecutive buckets; extremes (and their times)
+       only, which is all envelope needs.'''
+    shape = (-1, factor)
+    v_min = buckets['min'].reshape(shape)
+    v_max = buckets['max'].reshape(shape)
+    lo = v_min.argmin(1)[:, None]
+    hi = v_max.argmax(1)[:, None]
+    pick = lambda values, k: np.take_along_axis(values.reshape(shape), k, 1)
+    return {'min': pick(v_min, lo)[:, 0], 't_min': pick(buckets['t_min'],\
+            lo)[:, 0], 'max': pick(v_max, hi)[:, 0], 't_max':\
+            pick(buckets['t_max'], hi)[:, 0]}
+
+
+class EnvelopeMerge(object):
+    '''Streaming envelope of buckets, factor buckets to a point pair.
+    -----
+        Summary levels are a factor of ten apart; this takes the level
+        just fine enough the rest of the way to a point budget. Buckets
+        that don't yet make a full group are carried over to the next push;
+        flush() merges whatever is left.
+    '''
+
+    def __init__(self, factor):
+        self.factor = factor
+        self._buckets = None
+
+
+    def push(self, buckets):
+        '''Return the envelope (t, v) of every group completed.'''
+        buckets = {key: np.asarray(buckets[key]) for key in ENVELOPE_FIELDS}
+        if self._buckets is not None:
+            buckets = {key: np.concatenate((self._buckets[key],\
+                    buckets[key])) for key in ENVELOPE_FIELDS}
+        nb_used = (len(buckets['min']) // self.factor) * self.factor
+        self._buckets = {key: buckets[key][nb_used:] for key in buckets}
+        return envelope(merge_groups({key: buckets[key][:nb_used] for key in\
+                buckets}, self.factor))
+
+
+    def flush(self):
+        '''Envelope of the final, partial group (if there is one).'''
+        buckets, self._buckets = self._buckets, None
+        if (buckets is None) or (len(buckets['min']) == 0):
+            return np.array([]), np.array([])
+        return envelope(merge_groups(buckets, len(buckets['min'])))
@@ -0,0 +1,132 @@
+'''A process-wide registry of live model controllers.'''
+import threading
+import logging
+from bson import ObjectId
+from models import *
+from lru import LRU
+
+
+class ControllerRegistry(object):
+    '''Share session controllers (and segment data) across requests.
+    -----
+        Every REST handler used to rebuild a SessionController (and the
+        whole graph of controllers beneath it) on each request. The registry
+        hands out one controller per _id instead. Sessions being recorded
+        are pinned: the registry returns the very controller the BioBoard is
+        pushing into, so readers see running statistics and segments that
+        are completed but not yet written without touching Mongo. Idle
+        sessions sit in an LRU cache. Flushed segments never change, so
+        their arrays are cached too; see TimeSeriesController.read_from.
+
+        Anything that changes a session behind a controller's back must go
+        through the registry (reload_annotations, say, or invalidate) to keep
+        it honest. Pinned controllers are never dropped: the writer is still
+        pushing into them.
+    '''
+
+    def __init__(self, database, capacity=32, segment_capacity=256):
+        '''Create an empty registry.
+        INPUTS
+            database - pymongo database
+                Where controllers load from.
+            capacity - int
+                Number of idle sessions kept around.
+            segment_capacity - int
+                Number of flushed segments' arrays kept around.
+        '''
+        self.db = database
+        self.sessions = LRU(capacity)
+        self.segment_arrays = LRU(segment_capacity) # see read_from.
+        self.pinned = {} # sessions being streamed to, by _id.
+        self.lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+
+
+    def session(self, session_id):
+        '''Return the live controller for a session, loading it if needed.'''
+        session_id = as_object_id(session_id)
+        with self.lock:
+            session = self.pinned.get(session_id) or\
+                    self.sessions.get(session_id)
+            if session is None:
+                session = SessionController(self.db, _id=session_id)
+                self.sessions.put(session_id, session)
+            return session
+
+
+    def create_session(self, data):
+        '''Create a new session; it goes straight into the cache.'''
+        session = SessionController(self.db, data=data)
+        with self.lock:
+            self.sessions.put(session._id, session)
+        return session
+
+
+    def delete_session(self, session_id):
+        '''Delete a session and everything it owns; forget about it.'''
+        session = self.session(session_id)
+        series_ids = [series._id for series in session.time_series.values()]
+        session.delete()
+        with self.lock:
+            self.pinned.pop(session._id, None) # gone; nothing left to read.
+        self.invalidate(session._id)
+        with self.segment_arrays.lock:
+            for key in list(self.segment_arrays.items.keys()):
+                if key[0] in series_ids:
+                    self.segment_arrays.pop(key)
+
+
+    def pin(self, session):
+        '''Mark session as being streamed to. Readers get this controller.'''
+        with self.lock:
+            self.sessions.pop(session._id)
+            self.pinned[session._id] = session
+
+
+    def unpin(self, session_id):
+        '''Streaming stopped. The controller is still current; cache it.'''
+        session_id = as_object_id(session_id)
+        with self.lock:
+            session = self.pinned.pop(session_id, None)
+            if session is not None:
+                self.sessions.put(session_id, session)
+
+
+    def invalidate(self, session_id):
+        '''Drop an idle session so the next request reloads it from the
+           database. A pinned session stays: readers must keep seeing the
+           controller being recorded to.'''
+        session_id = as_object_id(session_id)
+        with self.lock:
+            self.sessions.pop(session_id)
+
+
+    def reload_annotations(self, session_id):
+        '''Annotations changed; refresh them on the session, if we hold it.'''
+        session_id = as_object_id(session_id)
+        with self.lock:
+            session = self.pinned.get(session_id) or\
+                    self.sessions.items.get(session_id)
+        if session is not None:
+            session.load_annotations()
+
+
+    def live_sessions(self):
+        '''Every session controller currently held.'''
+        with self.lock:
+            return list(self.pinned.values()) +\
+                    list(self.sessions.items.values())
+
+
+    @property
+    def stats(self):
+        '''Cache health, for the curious.'''
+        return {'pinned': len(self.pinned), 'sessions': self.sessions.stats,\
+                'segment_arrays': self.segment_arrays.stats}
+
+
+def as_object_id(_id):
+    '''Accept an ObjectId or its string form.'''
+    if isinstance(_id, str):
+        return ObjectId(_id)
+    return _id
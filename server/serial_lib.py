@@ -1,8 +1,16 @@
 from glob import glob
 import re
+import json
+import itertools
+import numpy as np
 from ipdb import set_trace as debug
 from bson import ObjectId
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+try:
+    import orjson # optional; a good deal faster than json.
+except ImportError:
+    orjson = None
 
 
 def find_serial_devices():
@@ -17,12 +25,156 @@ def find_serial_devices():
     for device in devices: 
         if re.search(SERIAL_REGEX, device):
             valid_devices.append(device)
-    sleep(1)
     return valid_devices
 
 
+def probe_ports(ports, ping):
+    '''Ping all candidate ports at once; return those that answered.
+    INPUTS
+        ports - list
+            Names of serial ports to check.
+        ping - function
+            ping(port) returns True if a biomonitor lives on the port.
+    '''
+    if len(ports) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        answers = list(pool.map(ping, ports))
+    return [port for port, answer in zip(ports, answers) if answer]
+
+
+# Biomonitor frames look like "B1 <channel> <value> <timestamp>", hex encoded.
+BIO_FRAME_REGEX = re.compile(rb"B1[ \t]*(\d*)[ \t]*(\w{0,8})[ \t]*(\w*)")
+
+# Longest partial line worth keeping (a frame is ~40 bytes). Anything before
+# the last MAX_FRAME bytes of a line that never ends is garbage.
+MAX_FRAME = 128
+
+
+def _hex_lookup():
+    '''Map ASCII bytes onto hex digit values; anything else becomes 0xFF.'''
+    lookup = np.full(256, 0xFF, dtype=np.uint8)
+    lookup[0] = 0 # NUL padding from fixed-width byte arrays.
+    for k, digit in enumerate('0123456789abcdef'):
+        lookup[ord(digit)] = k
+        lookup[ord(digit.upper())] = k
+    return lookup
+
+
+HEX_LOOKUP = _hex_lookup()
+
+
+def decode_hex(fields, max_digits=16):
+    '''Decode a list of hex byte strings into a uint64 array, all at once.
+    INPUTS
+        fields - list
+            Hex encoded byte strings, e.g. [b'1f', b'00a3'].
+        max_digits - int
+            Fields longer than this cannot fit in 64 bits and are rejected.
+    OUTPUTS
+        decoded - array_like
+            The decoded integers.
+        valid - array_like
+            Boolean mask; False where a field was empty or not valid hex.
+    '''
+    if len(fields) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    # Fixed-width byte matrix, right padded with NULs; one row per field.
+    raw = np.array(fields, dtype=bytes)
+    width = raw.dtype.itemsize
+    digits = HEX_LOOKUP[raw.view(np.uint8).reshape(-1, width)]
+    lengths = np.char.str_len(raw)
+    valid = (lengths > 0) * (lengths <= max_digits) * \
+            np.all(digits != 0xFF, axis=1)
+
+    # Weight each digit by its place value, counted from the right.
+    place = lengths[:, None] - 1 - np.arange(width)[None, :]
+    place[(place < 0) | ~valid[:, None]] = 0
+    digits[~valid, :] = 0
+    weights = np.uint64(16) ** place.astype(np.uint64)
+    decoded = np.sum(digits.astype(np.uint64) * weights, axis=1,\
+            dtype=np.uint64)
+    return decoded, valid
+
+
+def parse_frames(buffer):
+    '''Parse every complete frame in a chunk of raw serial output.
+    INPUTS
+        buffer - bytes
+            Raw bytes read from the biomonitor. Anything after the final
+            newline is an incomplete frame and is handed back untouched.
+    OUTPUTS
+        channels, timestamps, values - array_like
+            Column arrays holding one entry per valid frame.
+        remainder - bytes
+            Trailing partial line; prepend it to the next read.
+        nb_bad - int
+            Number of B1 frames that failed to decode.
+    '''
+    cut = buffer.rfind(b'\n') + 1
+    complete, remainder = buffer[:cut], buffer[cut:]
+
+    # One pass of the regex over the whole block, then decode by column.
+    frames = BIO_FRAME_REGEX.findall(complete)
+    if len(frames) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, remainder, 0
+    channel_fields, value_fields, timestamp_fields = zip(*frames)
+    channels, chn_ok = decode_hex(channel_fields)
+    values, val_ok = decode_hex(value_fields, max_digits=8)
+    timestamps, ts_ok = decode_hex(timestamp_fields)
+
+    # Only keep frames where every field made it through.
+    valid = chn_ok * val_ok * ts_ok
+    nb_bad = int(len(frames) - np.sum(valid))
+    return (channels[valid].astype(np.int64),\
+            timestamps[valid].astype(np.int64),\
+            values[valid].astype(np.int64), remainder, nb_bad)
+
+
+class FrameReader(object):
+    '''Drain a serial connection in chunks and decode frames in bulk.
+    -----
+        Rather than reading the port one line at a time, each call to read
+        grabs everything currently waiting in the OS buffer. Complete frames
+        are decoded together; a trailing partial line is carried over to the
+        next read. A partial line is never longer than MAX_FRAME: a noisy
+        port sending no newlines would otherwise grow it without bound, and
+        have all of it parsed again on every read. What is cut off counts
+        as a bad frame.
+    '''
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.remainder = b''
+        self.timed_out = False
+        self.garbled = False # the last read threw garbage away.
+        self.nb_bad_frames = 0
+
+
+    def read(self):
+        '''Return (channels, timestamps, values) arrays for waiting frames.'''
+
+        # Block for at most the port timeout if nothing is waiting yet.
+        chunk = self.ser.read(self.ser.in_waiting or 1)
+        self.timed_out = (len(chunk) == 0)
+        channels, timestamps, values, self.remainder, nb_bad = \
+                parse_frames(self.remainder + chunk)
+        self.garbled = (len(self.remainder) > MAX_FRAME)
+        if self.garbled:
+            self.remainder = self.remainder[-MAX_FRAME:]
+            nb_bad += 1
+        self.nb_bad_frames += nb_bad
+        return channels, timestamps, values
+
+
 def read_data(ser):
-    '''Read data from the biomonitor at serial connection ser.'''
+    '''Read data from the biomonitor at serial connection ser.
+    -----
+        Compatibility shim; reads and decodes a single line. Use FrameReader
+        to pull data off the port in bulk.
+    '''
     biomonitor_output = ser.readline()
     bio_regex = r"(B1)\s*(\d*)\s*(\w{0,8})\s*(\w*)"
     parsed = re.search(bio_regex, str(biomonitor_output))
@@ -46,55 +198,103 @@ def read_data(ser):
     return (channel_number, timestamp, value)
 
 
+# Values that never need converting on the way to or from JSON. Lists made
+# up entirely of these (samples, [t, v] pairs) are passed through untouched.
+LEAF_TYPES = frozenset([float, int, bool, str, type(None), np.float64])
+
+# Sequences, converted element by element (tuples come back as lists).
+SEQUENCE_TYPES = frozenset([list, tuple])
+
+
+@lru_cache(maxsize=4096)
 def camel_to_snake(camel):
     '''Convert camelCase to snake_case.'''
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', camel)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+@lru_cache(maxsize=4096)
 def snake_to_camel(snake):
     '''Convert snake_case to camelCase.'''
     return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), snake)
 
 
+@lru_cache(maxsize=4096)
+def is_id_key(key):
+    '''Does this (snake_case) key hold an ObjectId?'''
+    return (key is not None) and ('_id' in key)
+
+
+def all_leaves(items):
+    '''Is every item of a list a plain value, or a list (or tuple) of plain
+       values (like [t, v] pairs)? The loops all run in C.'''
+    kinds = set(map(type, items))
+    if kinds <= LEAF_TYPES:
+        return True
+    if kinds <= SEQUENCE_TYPES:
+        return set(map(type, itertools.chain.from_iterable(items))) <=\
+                LEAF_TYPES
+    return False
+
+
 def deserialize(obj, key=None):
     '''Return object if it is simple; otherwise recursively iterate through.'''
-    if (type(obj) is list): # loop through elements, if list.
-        nlist = []
-        for el in obj:
-            nlist.append(deserialize(el))
-        return nlist
-    elif (type(obj) is dict): # loop through key,value pairs, if dict.
+    kind = type(obj)
+    if kind is dict: # convert keys; loop through values.
         ndict = {}
         for k,v in obj.items():
-            nk = camel_to_snake(k)
+            nk = camel_to_snake(k) if (type(k) is str) else k
             ndict[nk] = deserialize(v, key=nk)
         return ndict
-    else: # convert string _id to ObjectId, etc.
-        if (type(obj) is str) and (re.search(r'(_id)', key)):
-            # Convert into an ObjectId so we can search in Mongo!
-            return ObjectId(obj)
-        else:
+    elif kind in SEQUENCE_TYPES: # loop through, unless they're all simple.
+        if all_leaves(obj):
             return obj
+        return [deserialize(el) for el in obj]
+    elif (kind is str) and is_id_key(key):
+        # Convert into an ObjectId so we can search in Mongo!
+        return ObjectId(obj)
+    return obj
 
 
 def serialize(obj, key=None):
-    '''Return object if it is simple; otherwise recursively iterate through.'''
-    if (type(obj) is list): # loop through elements
-        nlist = []
-        for el in obj:
-            nlist.append(serialize(el))
-        return nlist
-    elif (type(obj) is dict): # loop through key,value pairs
+    '''Return object if it is simple; otherwise recursively iterate through.
+    -----
+        ObjectIds become strings and NumPy scalars become Python numbers.
+        NumPy arrays are left alone: to_json writes them out directly.
+    '''
+    kind = type(obj)
+    if kind is dict: # convert keys; loop through values.
         ndict = {}
         for k,v in obj.items():
-            ndict[snake_to_camel(k)] = serialize(v, key=k)
+            nk = snake_to_camel(k) if (type(k) is str) else k
+            ndict[nk] = serialize(v, key=k)
         return ndict
-    else: # Check to see if the bare object needs special processing.
-        if (type(obj) is ObjectId) and (re.search(r'(_id)', key)):
-            # Convert the ObjectId to a string so we can push through JSON.
-            return str(obj)
-        else:
+    elif kind in SEQUENCE_TYPES: # loop through, unless they're all simple.
+        if all_leaves(obj):
             return obj
-        if isinstance(obj, np.generic):
-            return np.asscalar(obj)
+        return [serialize(el) for el in obj]
+    elif kind is ObjectId:
+        # Convert the ObjectId to a string so we can push through JSON.
+        return str(obj)
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def json_default(obj):
+    '''Encode what json can't: arrays, NumPy scalars, ObjectIds.'''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+
+def to_json(obj):
+    '''Encode (serialized) data as a JSON string, as quickly as we can.'''
+    if orjson is not None:
+        options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        return orjson.dumps(obj, default=json_default, option=options).decode()
+    return json.dumps(obj, default=json_default)
@@ -0,0 +1,128 @@
+'''Benchmark serialize/deserialize (and JSON encoding) against the originals.
+-----
+    Builds a payload shaped like a /history response (a few channels, each
+    a time series model plus a long list of [t, v] pairs), checks that the
+    new implementation produces the same JSON the old one did, and times
+    both.
+
+    python serialize_benchmark.py --samples 200000 --channels 3
+'''
+import re
+import json
+import argparse
+import numpy as np
+from time import time
+from bson import ObjectId
+from serial_lib import serialize, deserialize, to_json
+
+
+def legacy_camel_to_snake(camel):
+    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', camel)
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+
+
+def legacy_snake_to_camel(snake):
+    return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), snake)
+
+
+def legacy_deserialize(obj, key=None):
+    '''The original deserialize, verbatim.'''
+    if (type(obj) is list): # loop through elements, if list.
+        nlist = []
+        for el in obj:
+            nlist.append(legacy_deserialize(el))
+        return nlist
+    elif (type(obj) is dict): # loop through key,value pairs, if dict.
+        ndict = {}
+        for k,v in obj.items():
+            nk = legacy_camel_to_snake(k)
+            ndict[nk] = legacy_deserialize(v, key=nk)
+        return ndict
+    else: # convert string _id to ObjectId, etc.
+        if (type(obj) is str) and (re.search(r'(_id)', key)):
+            # Convert into an ObjectId so we can search in Mongo!
+            return ObjectId(obj)
+        else:
+            return obj
+
+
+def legacy_serialize(obj, key=None):
+    '''The original serialize, verbatim.'''
+    if (type(obj) is list): # loop through elements
+        nlist = []
+        for el in obj:
+            nlist.append(legacy_serialize(el))
+        return nlist
+    elif (type(obj) is dict): # loop through key,value pairs
+        ndict = {}
+        for k,v in obj.items():
+            ndict[legacy_snake_to_camel(k)] = legacy_serialize(v, key=k)
+        return ndict
+    else: # Check to see if the bare object needs special processing.
+        if (type(obj) is ObjectId) and (re.search(r'(_id)', key)):
+            # Convert the ObjectId to a string so we can push through JSON.
+            return str(obj)
+        else:
+            return obj
+        if isinstance(obj, np.generic):
+            return np.asscalar(obj)
+
+
+def history_payload(nb_samples=200000, nb_channels=3):
+    '''Something shaped like what DataHistory used to hand to serialize.'''
+    payload = []
+    for channel in range(1, nb_channels+1):
+        t = np.arange(nb_samples) / 500.
+        v = np.sin(t) * 0.1
+        series = {'_id': ObjectId(), 'owner_id': ObjectId(),\
+                'physical_channel': channel, 'description': 'PVDF Sensor',\
+                'segment_size': 800, 'freq_cutoff': 10, 'filter_order': 3,\
+                'filter_coefs': [0.1, 0.2, 0.3], 'segment_counter': 250,\
+                'stats': {'nb_samples': nb_samples, 'dt_recent': [0.002]*25,\
+                'min_time': 0.0, 'max_time': float(t[-1])}}
+        series['data'] = list(zip(t, v))
+        payload.append(series)
+    return payload
+
+
+def best_of(func, repeats=3):
+    '''Best wall time of a few runs; and the last result.'''
+    times = []
+    for _ in range(repeats):
+        start = time()
+        result = func()
+        times.append(time() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--samples', type=int, default=200000)
+    parser.add_argument('--channels', type=int, default=3)
+    args = parser.parse_args()
+    payload = history_payload(args.samples, args.channels)
+
+    # Same output as before?
+    old = json.loads(json.dumps(legacy_serialize(payload)))
+    new = json.loads(to_json(serialize(payload)))
+    assert old == new, 'serialize output changed!'
+    request = json.loads(json.dumps(old[0]['stats']))
+    request['ownerId'] = old[0]['ownerId']
+    assert legacy_deserialize(request) == deserialize(request),\
+            'deserialize output changed!'
+
+    # Time it: the walk alone, then the walk plus encoding.
+    t_old, _ = best_of(lambda: legacy_serialize(payload))
+    t_new, _ = best_of(lambda: serialize(payload))
+    print(' > serialize:            {:8.1f} ms -> {:8.1f} ms ({:.0f}x)'.\
+            format(1e3*t_old, 1e3*t_new, t_old/t_new))
+    t_old, _ = best_of(lambda: json.dumps(legacy_serialize(payload)))
+    t_new, _ = best_of(lambda: to_json(serialize(payload)))
+    print(' > serialize + encode:   {:8.1f} ms -> {:8.1f} ms ({:.0f}x)'.\
+            format(1e3*t_old, 1e3*t_new, t_old/t_new))
+    incoming = json.loads(json.dumps(old))
+    t_old, _ = best_of(lambda: legacy_deserialize(incoming))
+    t_new, _ = best_of(lambda: deserialize(incoming))
+    print(' > deserialize:          {:8.1f} ms -> {:8.1f} ms ({:.0f}x)'.\
+            format(1e3*t_old, 1e3*t_new, t_old/t_new))
@@ -6,7 +6,7 @@ from gevent.wsgi import WSGIServer
 from database import *
 from models import *
 from device import *
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, make_response
 from flask_cors import *
 from flask_restful import abort, Api, Resource, reqparse
 from time import sleep, time
@@ -15,6 +15,11 @@ from analysis import *
 from sig_proc import *
 from bson import ObjectId
 from processor import *
+from registry import *
+from analytics_cache import AnalyticsCache
+from live import LiveHub, parse_cursor
+from wire import wants_binary, encode_series, BINARY_MIMETYPE
+from export import SeriesExport, EXPORT_FORMATS, EXPORT_MIMETYPES
 
 
 # Configure logging.
@@ -24,23 +29,54 @@ log = logging.getLogger(__name__)
 # Create a RESTFUL web server.
 app = Flask(__name__)
 api = Api(app)
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    '''Write responses with the fast, NumPy-aware encoder.'''
+    response = make_response(to_json(data), code)
+    response.headers.extend(headers or {})
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
 valid_headers = ['Content-Type', 'Access-Control-Allow-Origin', '*']
 cors = CORS(app, allow_headers=valid_headers)
         
-# Connect to the Mongo database.
+# Connect to the Mongo database; make sure our indexes are in place.
 db = connect_to_database() 
+ensure_indexes(db)
+
+# Share live controllers across requests (and with the boards).
+registry = ControllerRegistry(db)
+
+# Heart rate and pulse metrics, computed once per new segment, not per poll.
+analytics = AnalyticsCache()
+
+# One producer per watched session pushes new data to every browser.
+live = LiveHub(registry, analytics)
+
+# Connect to any and all biomonitors.
+boards = BoardManager()
+boards.start()
+
+def respond_with_series(series_data):
+    '''Send series whose 'data' is a (t, v) pair: as JSON [t, v] pairs by
+       default, or as packed columns for clients that ask; see wire.py.'''
+    if wants_binary(request):
+        return Response(encode_series(series_data), mimetype=BINARY_MIMETYPE)
+    for time_series in series_data: # [t, v] rows; to_json writes arrays.
+        t, v = time_series['data']
+        time_series['data'] = np.column_stack((np.asarray(t, dtype=float),\
+                np.asarray(v, dtype=float)))
+    return serialize(series_data)
 
-# Connect to a biomonitor.
-board = BioBoard()
-board.start()
 
-# Ensure board is stopped when server is stopped.
+# Ensure boards are stopped when server is stopped.
 def exit_gracefully(signal, frame):
     '''When we kill the server (via CTL-C), gracefully close board 
        connections as well.
     '''
-    log.info(" > Closing down biomonitor board.")
-    board.kill()
+    log.info(" > Closing down biomonitor boards.")
+    boards.kill()
     sys.exit(0)
 
 
@@ -52,11 +88,16 @@ class Status(Resource):
     '''Return the board connection status.'''
     
     def get(self):
-        # Look at the board. Report its current status.
-        data = {}
-        data['is_connected'] = board.is_connected 
-        data['status_message'] = board.status_message 
-        data['device_port'] = board.port 
+        # Look at the boards. Report the first one up top, as before.
+        devices = boards.status
+        if len(devices) > 0:
+            data = dict(devices[0])
+        else:
+            data = {}
+            data['is_connected'] = False
+            data['status_message'] = 'Searching for biomonitor device.'
+            data['device_port'] = None
+        data['devices'] = devices
         return serialize(data)
 
 
@@ -73,7 +114,7 @@ class Sessions(Resource):
         # Grab data from request.
         data = request.json
         data = deserialize(data)
-        session = SessionController(db, data=data)
+        session = registry.create_session(data)
         return serialize(session.model)
 
 
@@ -82,24 +123,26 @@ class Session(Resource):
 
     def get(self, session_id):
         '''Get an existing session model.'''
-        session = SessionController(db, _id=session_id)
+        session = registry.session(session_id)
         return serialize(session.model)
 
     def delete(self, session_id):
         '''Delete current session, and its associated time series, etc.'''
-        session = SessionController(db, _id=session_id)
-        session.delete() # this will delete all child time series, etc.
+        # This will delete all child time series, etc.
+        registry.delete_session(session_id)
 
     def put(self, session_id):
         '''Provides commands to start/stop recording data to a session.'''
         data = request.json
         data = deserialize(data)
-        s = SessionController(db, _id=session_id)
+        s = registry.session(session_id)
         command = data['cmd']
         if command == 'start': # start streaming data to session
-            board.stream_to(s)
+            boards.stream_to(s, port=data.get('port')) # or once one's found.
+            registry.pin(s)
         elif command=='stop':
-            board.stop_stream()
+            boards.stop_stream(s._id)
+            registry.unpin(s._id)
 
 
 class Annotations(Resource):
@@ -109,6 +152,8 @@ class Annotations(Resource):
         data = request.json
         data = deserialize(data)
         db.annotations.insert_one(data)
+        if 'owner_id' in data: # session models carry their annotations.
+            registry.reload_annotations(data['owner_id'])
 
 
 class Annotation(Resource):
@@ -116,27 +161,76 @@ class Annotation(Resource):
 
     def delete(self, annotation_id):
         '''Delete specified annotation, and its associated time series, etc.'''
-        db.annotations.delete_one({'_id': ObjectId(annotation_id)})
+        annotation = db.annotations.find_one_and_delete(\
+                {'_id': ObjectId(annotation_id)})
+        if annotation and ('owner_id' in annotation):
+            registry.reload_annotations(annotation['owner_id'])
 
 
 class DataHistory(Resource):
     '''Returns all available data for a given data session.'''
 
     def get(self, session_id):
-        '''Return entire data series.'''
-        s = SessionController(db, _id=session_id)
+        '''Stream data series, a segment at a time.
+        -----
+            Query parameters (all optional):
+                min, max - time range, in seconds.
+                channel - physical channel; all channels if absent.
+                points - decimate each channel to about this many points
+                    (the chart width, say); zoomed out, starting from the
+                    stored summaries.
+                mode - how: minmax (the default; each bucket's extremes) or
+                    lttb.
+                format - json (the default), binary, csv, or npz.
+        '''
+        s = registry.session(session_id)
         if not s._id: abort(404)
-        
-        # Return all data on all available channels.
-        series_data = []
-        for channel, ts in s.time_series.items():
-            time_series = ts.model
-            t,v = ts.series
-            time_series['data'] = list(zip(t,v))
-            series_data.append(time_series)
 
-        # Return all available data for this session.
-        return serialize(series_data)
+        # What does the client want?
+        min_time = float(request.args.get('min', -np.inf))
+        max_time = float(request.args.get('max', np.inf))
+        channel = request.args.get('channel')
+        points = request.args.get('points')
+        points = int(points) if points else None
+        mode = request.args.get('mode', 'minmax')
+        if mode not in DECIMATORS:
+            abort(400, message='Unknown mode "{:s}".'.format(mode))
+        fmt = request.args.get('format') or\
+                ('binary' if wants_binary(request) else 'json')
+        if fmt not in EXPORT_FORMATS:
+            abort(400, message='Unknown format "{:s}".'.format(fmt))
+
+        # Count first (so binary and npz headers can go out first); then
+        # send the data along as it is read.
+        exports = [SeriesExport(ts, min_time, max_time, points, mode) for\
+                chn, ts in s.time_series.items() if\
+                (channel is None) or (str(chn) == channel)]
+        response = Response(EXPORT_FORMATS[fmt](exports),\
+                mimetype=EXPORT_MIMETYPES[fmt])
+        if fmt in ['csv', 'npz']:
+            filename = '{:s}.{:s}'.format(str(s.model.get('name', s._id)),\
+                    fmt).replace('"', '')
+            response.headers['Content-Disposition'] = \
+                    'attachment; filename="{:s}"'.format(filename)
+        return response
+
+
+class Beats(Resource):
+    '''Heart beats found as the data were recorded.'''
+
+    def get(self, session_id):
+        '''Beat times, heights, and the heart rate as of each beat, per
+           channel; optionally limited to ?min and ?max (seconds).'''
+        s = registry.session(session_id)
+        if not s._id: abort(404)
+        min_time = float(request.args.get('min', -np.inf))
+        max_time = float(request.args.get('max', np.inf))
+        beats = []
+        for chn, ts in s.time_series.items():
+            t, height, bpm = ts.beats_in(min_time, max_time)
+            beats.append({'physical_channel': chn, 't': t, 'height': height,\
+                    'bpm': bpm})
+        return serialize(beats)
 
 
 class StreamData(Resource):
@@ -144,8 +238,14 @@ class StreamData(Resource):
     def get(self, session_id):
         '''Get whatever segment of time series is available.'''
 
-        # Specify the frequency to display to web.
+        # Specify the frequency to display to web; or, given points (from
+        # the chart width, say), decimate to that many, preserving peaks.
         target_frequency = 100
+        points = request.args.get('points')
+        points = int(points) if points else None
+        mode = request.args.get('mode', 'lttb')
+        if mode not in DECIMATORS:
+            abort(400, message='Unknown mode "{:s}".'.format(mode))
 
         # Extract query parameters (range on stream request).
         min_time = request.args.get('min')
@@ -160,48 +260,51 @@ class StreamData(Resource):
         # if max_time < 0:
         #     max_time = np.inf
 
-        s = SessionController(db, _id=session_id)
-        series_data = []
-        # print('Minimum time is: {:.2f}'.format(min_time))
-        # print('Maximum time is: {:.2f}'.format(max_time))
+        # A cursor, if the client has one, says exactly what it has seen.
+        positions = decode_cursor(request.args.get('cursor', ''))
+        live_view = (max_time < 0)
+
+        s = registry.session(session_id)
+        series_data, next_positions = [], {}
         for channel, series in s.time_series.items():
-            time_series = series.model
+            time_series = series.public_model
 
-            # Actual data.
-            if max_time<0:
-                t,v = series.last_segment()
+            # Where to read from: the cursor; else latest data or min_time.
+            if series._id in positions:
+                seq, offset = positions[series._id]
+            elif live_view:
+                seq, offset = series.latest_position()
             else:
-                try:
-                    # print('Getting at least...')
-                    t,v = series.at_least(min_time)
-                except:
-                    t,v = [],[]
-
-            if len(t)>0:
+                seq, offset = series.position_at(min_time)
+            if live_view: # never lag more than three segments behind.
+                seq, offset = max((seq, offset), series.latest_position(3))
+
+            # Actual data; only samples this client hasn't seen. Playback
+            # reads ahead, so the next step comes straight from the cache.
+            t, v, seq, offset = series.read_from(seq, offset,\
+                    cache=registry.segment_arrays,\
+                    read_ahead=(0 if live_view else 3))
+            next_positions[series._id] = (seq, offset)
+
+            if (len(t)>0) and points:
+                t_, v_ = decimate(t, v, points, mode)
+            elif len(t)>0:
                 # Downsample data for display purposes.
                 t_,v_ = downsample(t, v, target_frequency)
-
-                # For demonstration purposes, compute quanities of interest.
-                # This is super inefficient! Don't do this in general. Cache!
-                t_all, v_all = series.series
-                t_all = np.array(t_all)
-                v_all = np.array(v_all)
-                t_cur = np.mean(t)
-                delta_t = 20
-                idx = dex((t_all>t_cur-delta_t)*(t_all<t_cur+delta_t))
-                bpm = estimate_bpm(t_all[idx], v_all[idx])
-                # print('LEN: {:d}'.format( len(t_all)))
-                # print('t: {:f}'.format( t_cur))
-                _, _, _, metric = golden_representation(t_all[idx],\
-                        v_all[idx])
             else:
-                t_cur = -1
-                bpm = 0
-                metric = 0
                 t_, v_ = t,v
+
+            # Quantities of interest. Live views are kept up to date as
+            # segments arrive; playback windows are memoized.
+            if live_view:
+                bpm, metric = analytics.live(series)
+            elif len(t)>0:
+                bpm, metric = analytics.around(series, np.mean(t))
+            else:
+                bpm, metric = 0, 0
                 
             # Add data, sampling rate, current time, beats per minute, etc.
-            time_series['data'] = list(zip(t_,v_))
+            time_series['data'] = (t_, v_)
             time_series['bpm'] = bpm
             time_series['metric'] = metric
             time_series['duration'], time_series['sampling_rate'] = \
@@ -217,10 +320,30 @@ class StreamData(Resource):
             # Add current time series to the series list.
             series_data.append(time_series)
 
+        # Hand back where to pick up next time.
+        cursor = encode_cursor(next_positions)
+        for time_series in series_data:
+            time_series['cursor'] = cursor
+
         # Aaaand we're done.
-        return serialize(series_data)
+        return respond_with_series(series_data)
         
 
+class LiveData(Resource):
+    '''Push new data to the browser as it is recorded (server-sent events).'''
+
+    def get(self, session_id):
+        '''Hold the connection open; send each new stretch of data.'''
+        # Browsers resend the last event id when they reconnect.
+        cursor = request.headers.get('Last-Event-ID') or\
+                request.args.get('cursor')
+        stream = live.stream(session_id, parse_cursor(cursor))
+        response = Response(stream, mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
 '''Define our API routes.'''
 # Obtain device status.
 api.add_resource(Status, '/status', methods=['GET', 'POST'])
@@ -236,6 +359,14 @@ api.add_resource(Session, '/session/<session_id>', methods=allowed_methods)
 path = '/session/<session_id>/stream'
 api.add_resource(StreamData, path, methods=['GET'])
 
+# Push live data as it arrives.
+path = '/session/<session_id>/live'
+api.add_resource(LiveData, path, methods=['GET'])
+
+# Beats, and heart rate, as recorded.
+path = '/session/<session_id>/beats'
+api.add_resource(Beats, path, methods=['GET'])
+
 # Expose all available historical data for this stream.
 path = '/session/<session_id>/history'
 api.add_resource(DataHistory, path, methods=['GET'])
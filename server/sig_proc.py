@@ -22,8 +22,8 @@ def downsample(t, x, target_sampling_rate):
 
     # Determine the padding size & pad the data.
     padsize = int(np.ceil(len(x)/R)*R - len(x))
-    t = np.append(t, np.zeros(padsize)*np.NaN)
-    x = np.append(x, np.zeros(padsize)*np.NaN)
+    t = np.append(t, np.zeros(padsize)*np.nan)
+    x = np.append(x, np.zeros(padsize)*np.nan)
 
     # Reshape the data.
     x = x.reshape(-1, R)
@@ -39,3 +39,150 @@ def downsample(t, x, target_sampling_rate):
 
 
 
+
+
+def buckets(n, nb_buckets):
+    '''Cut n samples into (at most) nb_buckets equal buckets. Returns the
+       bucket size and the number of buckets actually needed.'''
+    size = int(np.ceil(n / max(nb_buckets, 1)))
+    return size, int(np.ceil(n / size))
+
+
+def as_rows(x, size):
+    '''View x as (buckets, size) rows; the last row is padded with copies
+       of the final sample, which never beat it for argmin/argmax.'''
+    padsize = -len(x) % size
+    if padsize > 0:
+        x = np.append(x, np.full(padsize, x[-1]))
+    return x.reshape(-1, size)
+
+
+def lttb(t, x, points):
+    '''Largest-Triangle-Three-Buckets decimation to (about) points samples.
+    -----
+        Keeps the first and last samples, cuts the rest into equal buckets,
+        and from each bucket keeps the sample forming the largest triangle
+        with the sample kept from the bucket before and the mean of the
+        bucket after. Peaks survive, since they make big triangles. Only the
+        choice of sample is sequential; everything else is done for all
+        buckets at once, and each choice is one pass over one bucket.
+    '''
+    t, x = np.asarray(t, dtype=float), np.asarray(x, dtype=float)
+    n = len(t)
+    if n <= max(points, 3):
+        return t, x
+    size, nb = buckets(n - 2, max(points, 3) - 2)
+    T, X = as_rows(t[1:-1], size), as_rows(x[1:-1], size)
+
+    # Mean of each bucket (padding aside); the last sample follows the last.
+    starts = np.arange(nb) * size
+    counts = np.diff(np.append(starts, n - 2))
+    mean = lambda y: np.add.reduceat(y[1:-1], starts) / counts
+    t_next = np.append(mean(t)[1:], t[-1])
+    x_next = np.append(mean(x)[1:], x[-1])
+
+    # Twice the triangle area is |a*x + b*t + c|, for a, b, c set by the
+    # other two corners.
+    picks = np.empty(nb, dtype=int)
+    t_prev, x_prev = t[0], x[0]
+    for k in range(nb):
+        a = t_prev - t_next[k]
+        b = x_next[k] - x_prev
+        area = np.abs(a * X[k] + b * T[k] - (a * x_prev + b * t_prev))
+        picks[k] = area.argmax()
+        t_prev, x_prev = T[k, picks[k]], X[k, picks[k]]
+    index = np.concatenate(([0], 1 + starts + picks, [n - 1]))
+    return t[index], x[index]
+
+
+def minmax(t, x, points):
+    '''Min/max envelope: the smallest and largest sample of each of points/2
+       equal buckets, in time order. Fully vectorized.'''
+    t, x = np.asarray(t, dtype=float), np.asarray(x, dtype=float)
+    n = len(t)
+    if n <= max(points, 2):
+        return t, x
+    size, nb = buckets(n, max(points, 2) // 2)
+    X = as_rows(x, size)
+    index = np.sort(np.column_stack((X.argmin(1), X.argmax(1))), axis=1)
+    index = (index + (np.arange(nb) * size)[:, None]).ravel()
+    return t[index], x[index]
+
+
+# Display decimation modes, for ?mode= on the data endpoints.
+DECIMATORS = {'lttb': lttb, 'minmax': minmax}
+
+
+def decimate(t, x, points, mode='lttb'):
+    '''Reduce (t, x) to about points samples for display; see DECIMATORS.'''
+    return DECIMATORS[mode](t, x, points)
+
+
+def count_above(v, levels):
+    '''Number of samples of v strictly greater than each level. One sort,
+       rather than a pass over v per level.'''
+    v = np.sort(np.asarray(v, dtype=float))
+    nb_valid = len(v) - np.count_nonzero(np.isnan(v)) # NaNs sort last.
+    return nb_valid - np.searchsorted(v[:nb_valid], levels, side='right')
+
+
+def peak_threshold(v, nb_depths=500, fraction=0.85):
+    '''The level above which samples count as pulse, as find_peaks sets it:
+       of nb_depths levels from the median to the max, the last at which
+       the cumulative count of samples above each level is still short of
+       fraction of the total. IndexError if there is no such level.'''
+    depths = np.linspace(np.median(v), np.max(v), nb_depths)
+    metric = count_above(v, depths)
+    m = np.cumsum(metric)/metric.sum()
+    return depths[np.nonzero(m<fraction)[0][-1]]
+
+
+def normalize_pulses(pulses):
+    '''Put pulses (rows, all the same length) on a common scale, at once.
+    -----
+        Each pulse is divided by its max. Time runs from 0 to 1 over the
+        pulse, then is dilated so the first sample at or below half max
+        (halfway between the max and the median) falls at 0.1. Finally the
+        value where dilated time reaches 0.2 is taken as zero, and the max
+        stays at one.
+    INPUTS
+        pulses - array
+            One pulse per row.
+    OUTPUTS
+        v - array
+            Normalized pulses; rows that could not be are not meaningful.
+        dilation - array
+            Each pulse's time dilation: its time is
+            np.linspace(0, 1, v.shape[1]) * dilation.
+        valid - array
+            Which rows were normalized: there is a half max point after the
+            first sample, dilated time reaches 0.2, and all is finite.
+    '''
+    v = np.array(pulses, dtype=float, ndmin=2)
+    rows = np.arange(v.shape[0])
+    t_ = np.linspace(0, 1, v.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v /= v.max(1)[:, None]
+        half_max = (1 + np.median(v, 1))/2
+        below = v <= half_max[:, None]
+        half_max_pos = below.argmax(1)
+        dilation = 0.1/t_[half_max_pos]
+        stretch = (t_[None, :] * dilation[:, None]) >= 0.2
+        stretch_point = stretch.argmax(1)
+        md = v[rows, stretch_point]
+        delta = 1 - md
+        v = (v - md[:, None])/delta[:, None]
+    valid = below.any(1) & (half_max_pos > 0) & stretch.any(1) &\
+            (delta != 0) & np.isfinite(v).all(1) & np.isfinite(dilation)
+    return v, dilation, valid
+
+
+def run_argmax(x, starts):
+    '''Index into x of the first maximum of each run, where run k is
+       x[starts[k]:starts[k+1]] (the last run ends with x).'''
+    maxima = np.maximum.reduceat(x, starts)
+    label = np.repeat(np.arange(len(starts)), np.diff(np.append(starts,\
+            len(x))))
+    hits = np.flatnonzero(x == maxima[label])
+    first = np.append(True, np.diff(label[hits]) > 0)
+    return hits[first]
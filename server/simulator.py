@@ -0,0 +1,163 @@
+'''Replay recorded biomonitor data as if it were coming off a serial port.'''
+import numpy as np
+from time import time, sleep
+from mathtools.utils import Vessel
+
+
+# Conversion between volts and raw 24-bit ADC counts.
+MAXVAL = 2**24-1
+COV_FACTOR = 2.5 / MAXVAL
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def load_recording(filename='data/good_collection.dat'):
+    '''Load a recording; return (dt, counts) suitable for replay.
+    -----
+        Understands the two formats we have lying around: good_collection.dat
+        (t in microseconds, y in volts) and chl_data.dat (t in seconds, v in
+        volts).
+    '''
+    recording = Vessel(filename)
+    if 'y' in recording.keys:
+        t, v = 1e-6 * np.array(recording.t), np.array(recording.y)
+    else:
+        t, v = np.array(recording.t), np.array(recording.v)
+    dt = np.median(np.diff(t))
+    counts = np.clip(np.round(v / COV_FACTOR), 0, MAXVAL).astype(np.int64)
+    return dt, counts
+
+
+def hex_columns(numbers, width):
+    '''Fixed-width, lowercase hex digits for an integer array, as a matrix.'''
+    shifts = 4 * np.arange(width-1, -1, -1)
+    nibbles = (numbers[:, None] >> shifts[None, :]) & 0xF
+    return HEX_DIGITS[nibbles]
+
+
+def encode_frames(channels, timestamps, values):
+    '''Encode column arrays as raw "B1 <chn> <value> <timestamp>" frames.'''
+    nb_frames = len(channels)
+    lines = np.empty((nb_frames, 26), dtype=np.uint8)
+    lines[:, 0:3] = np.frombuffer(b'B1 ', dtype=np.uint8)
+    lines[:, 3] = HEX_DIGITS[channels % 10] # the board uses a single digit.
+    lines[:, 4] = ord(' ')
+    lines[:, 5:13] = hex_columns(values, 8)
+    lines[:, 13] = ord(' ')
+    lines[:, 14:24] = hex_columns(timestamps % 16**10, 10)
+    lines[:, 24:26] = np.frombuffer(b'\r\n', dtype=np.uint8)
+    return lines.tobytes()
+
+
+class ReplaySource(object):
+    '''A factory of fake serial ports that replay a recording.
+    -----
+        Pass an instance wherever serial.Serial is expected (BioBoard takes
+        a serial_class argument). Every port it opens draws from the same
+        running sample clock, so replay continues seamlessly across the
+        BioBoard's ping and its main connection.
+    '''
+
+    def __init__(self, recording='data/good_collection.dat', rate=500,\
+            channels=[1], block_size=4096):
+        '''Configure the replay.
+        INPUTS
+            recording - string
+                Vessel file holding the data to replay. Looped forever.
+            rate - float
+                Samples per second, per channel. Use None to replay as fast
+                as the reader can swallow it.
+            channels - list
+                Physical channels to emit. Each carries the recording.
+            block_size - int
+                Samples per channel generated per read when rate is None.
+        '''
+        self.dt, self.counts = load_recording(recording)
+        self.rate = rate
+        self.channels = np.array(channels, dtype=np.int64)
+        self.block_size = block_size
+        self.start_time = time()
+        self.emitted = 0 # samples per channel
+
+
+    def __call__(self, port, baud_rate=921600, timeout=None):
+        return ReplaySerial(self, port, timeout)
+
+
+    def due(self):
+        '''How many samples per channel should have been emitted by now?'''
+        if self.rate is None:
+            return self.emitted + self.block_size
+        return int((time() - self.start_time) * self.rate)
+
+
+    def generate(self):
+        '''Produce frames for all samples that have come due.'''
+        due = self.due()
+        if due <= self.emitted:
+            return b''
+        sample = np.arange(self.emitted, due)
+        dt = self.dt if self.rate is None else 1/self.rate
+        timestamps = np.round(sample * dt * 1e6).astype(np.int64)
+        values = self.counts[sample % len(self.counts)]
+
+        # Interleave channels, sample by sample, as the board does.
+        nb_chn = len(self.channels)
+        channels = np.tile(self.channels, len(sample))
+        timestamps = np.repeat(timestamps, nb_chn)
+        values = np.repeat(values, nb_chn)
+        self.emitted = due
+        return encode_frames(channels, timestamps, values)
+
+
+    @property
+    def frames_emitted(self):
+        '''Total frames written across all channels.'''
+        return self.emitted * len(self.channels)
+
+
+class ReplaySerial(object):
+    '''Just enough of the serial.Serial interface for the BioBoard.'''
+
+    def __init__(self, source, port, timeout=None):
+        self.source = source
+        self.port = port
+        self.timeout = timeout
+        self._pending = b''
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self._pending = b''
+
+
+    @property
+    def in_waiting(self):
+        self._pending += self.source.generate()
+        return len(self._pending)
+
+
+    def read(self, size=1):
+        '''Return up to size bytes, waiting up to timeout for the first.'''
+        deadline = time() + (self.timeout or 0)
+        while self.in_waiting == 0 and time() < deadline:
+            sleep(0.001)
+        out, self._pending = self._pending[:size], self._pending[size:]
+        return out
+
+
+    def readline(self):
+        '''Return the next full frame, or b'' on timeout.'''
+        deadline = time() + (self.timeout or 0)
+        while (b'\n' not in self._pending) and (time() < deadline):
+            if self.in_waiting == 0:
+                sleep(0.001)
+        cut = self._pending.find(b'\n') + 1
+        out, self._pending = self._pending[:cut], self._pending[cut:]
+        return out
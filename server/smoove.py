@@ -6,6 +6,7 @@ import seaborn as sns
 from seaborn import xkcd_rgb as xkcd
 from ipdb import set_trace as debug
 from taut_string import *
+from sig_proc import normalize_pulses
 
 
 def func(x, a, b, c):
@@ -18,22 +19,11 @@ def euc(x,y):
 
 def feature(pulse):
     '''Extract the features from the pulse.'''
-    v = pulse
-    t_ = np.linspace(0,1,len(v))
-    v /= v.max()
-
-    md = np.median(v)
-    half_max = (1+md)/2
-    half_max_pos = np.nonzero( v <= half_max )[0][0]
-
-    dilation_factor = 0.1/t_[half_max_pos]
-    td = t_ * dilation_factor
-    stretch_point = np.nonzero(td >= 0.2)[0][0]
-    md = v[stretch_point]
-    delta = (1-md)
-    v -= md
-    v /= delta
-    return td, v
+    v, dilation, valid = normalize_pulses(pulse)
+    if not valid[0]:
+        raise ValueError('Could not normalize this pulse.')
+    td = np.linspace(0,1,len(v[0])) * dilation[0]
+    return td, v[0]
 
 
 if __name__=='__main__':
@@ -0,0 +1,78 @@
+'''A compact binary encoding of time series payloads for the browser.
+-----
+    Layout (all little-endian):
+
+        uint32          length of the JSON header, in bytes
+        bytes           JSON header, space-padded to a multiple of 8 bytes
+        bytes           column buffers, each starting on an 8-byte boundary
+
+    The header is what the JSON endpoints would have returned, minus the
+    'data' lists. Each series instead lists its columns: name, dtype,
+    length, and byte offset (from the start of the column buffers). The
+    browser wraps each one directly as a typed array; see src/api/wire.js.
+'''
+import json
+import struct
+import numpy as np
+from serial_lib import serialize, to_json
+
+
+BINARY_MIMETYPE = 'application/octet-stream'
+WIRE_VERSION = 1
+
+# Time needs double precision; values do fine in single.
+COLUMN_DTYPES = [('t', '<f8'), ('v', '<f4')]
+
+
+def wants_binary(request):
+    '''Did the client ask for binary, via ?format= or the Accept header?'''
+    requested = request.args.get('format')
+    if requested is not None:
+        return requested == 'binary'
+    best = request.accept_mimetypes.best_match(['application/json',\
+            BINARY_MIMETYPE])
+    return best == BINARY_MIMETYPE
+
+
+def padding(nb_bytes, alignment=8):
+    '''Bytes needed to bring nb_bytes up to a multiple of alignment.'''
+    return -nb_bytes % alignment
+
+
+def encode_series(series_data):
+    '''Encode series (dicts whose 'data' is a (t, v) pair) as bytes.'''
+    header = {'version': WIRE_VERSION, 'series': []}
+    buffers, offset = [], 0
+    for time_series in series_data:
+        meta = {k: v for k, v in time_series.items() if k != 'data'}
+        meta = serialize(meta)
+        meta['columns'] = []
+        for (name, dtype), column in zip(COLUMN_DTYPES, time_series['data']):
+            array = np.ascontiguousarray(column, dtype=dtype)
+            meta['columns'].append({'name': name,\
+                    'dtype': np.dtype(dtype).name, 'length': len(array),\
+                    'offset': offset})
+            buffers.append(array.tobytes())
+            buffers.append(b'\0' * padding(array.nbytes))
+            offset += array.nbytes + padding(array.nbytes)
+        header['series'].append(meta)
+
+    # The header goes first; pad it so every column stays aligned.
+    text = to_json(header).encode()
+    text += b' ' * padding(4 + len(text))
+    return b''.join([struct.pack('<I', len(text)), text] + buffers)
+
+
+def decode_series(payload):
+    '''Inverse of encode_series (handy for tests and Python clients).'''
+    length = struct.unpack('<I', payload[:4])[0]
+    header = json.loads(payload[4:4+length].decode())
+    start = 4 + length
+    for meta in header['series']:
+        columns = [np.frombuffer(payload,\
+                dtype=np.dtype(c['dtype']).newbyteorder('<'),\
+                count=c['length'], offset=start+c['offset']) for c in\
+                meta.pop('columns')]
+        meta['data'] = tuple(columns)
+    return header['series']
+
@@ -1,4 +1,5 @@
 import axios from 'axios'
+import wire from './wire'
 
 const BASE_URL = 'http://localhost:1492' 
 // Basic API for talking to the backend.
@@ -39,13 +40,69 @@ export default {
       url += '/stream'
       url += '?' + 'min=' + data['minTime']
       url += '&' + 'max=' + data['maxTime']
+      if (data.cursor) {
+        // Server-issued; fetches only data we have not seen yet.
+        url += '&' + 'cursor=' + encodeURIComponent(data.cursor)
+      }
+      if (data.points) {
+        // Decimate to the chart width (mode 'lttb' or 'minmax'), rather
+        // than to a fixed 100 Hz.
+        url += '&' + 'points=' + data.points
+        url += '&' + 'mode=' + (data.mode || 'lttb')
+      }
+      if (data.binary) {
+        return this.getBinary(url, true)
+      }
       return axios.get(url, data)
     },
 
+    liveResource(resourceName, data, onData) {
+      // Server pushes new data as it arrives; returns the EventSource.
+      var url = BASE_URL + '/' + resourceName + '/' + data.id
+      url += '/live'
+      var source = new EventSource(url)
+      source.onmessage = function(event) {
+        onData(JSON.parse(event.data))
+      }
+      return source
+    },
+
     getHistory(resourceName, data) {
       var url = BASE_URL + '/' + resourceName + '/' + data.id
       url += '/history'
       return axios.get(url, data)
+    },
+
+    historyUrl(resourceName, data) {
+      // Link for bulk download; data.format is 'csv' or 'npz', say. Also
+      // takes minTime, maxTime, channel, points and mode.
+      var url = BASE_URL + '/' + resourceName + '/' + data.id
+      url += '/history?format=' + (data.format || 'json')
+      var params = {min: data.minTime, max: data.maxTime,
+		    channel: data.channel, points: data.points, mode: data.mode}
+      for (var key in params) {
+        if (params[key] !== undefined) {
+          url += '&' + key + '=' + params[key]
+        }
+      }
+      return url
+    },
+
+    getBinary(url, pairs) {
+      // Ask for packed columns; resolve with the decoded series list.
+      var config = {responseType: 'arraybuffer',
+		    headers: {Accept: 'application/octet-stream'}}
+      return axios.get(url, config).then(function(resp) {
+        resp.data = wire.decodeSeries(resp.data, pairs)
+        return resp
+      })
+    },
+
+    getHistoryBinary(resourceName, data) {
+      // data.points (the chart width, say) asks for a peak-preserving
+      // overview rather than every sample; see historyUrl.
+      data = Object.assign({}, data, {format: 'binary'})
+      return this.getBinary(this.historyUrl(resourceName, data), data.pairs)
     }
   
 }
@@ -0,0 +1,36 @@
+// Decode the binary time series format the server sends when asked
+// (?format=binary, or Accept: application/octet-stream). See server/wire.py.
+
+const ARRAY_TYPES = {float64: Float64Array, float32: Float32Array}
+
+export default {
+
+    decodeSeries(buffer, pairs) {
+      // Returns the series list; each series gains typed arrays t and v.
+      // With pairs set, data is also rebuilt as [[t, v], ...] for charts.
+      var view = new DataView(buffer)
+      var headerLength = view.getUint32(0, true)
+      var text = new TextDecoder('utf-8').decode(
+        new Uint8Array(buffer, 4, headerLength))
+      var header = JSON.parse(text)
+      var start = 4 + headerLength
+      var series = header.series
+      for (var k=0; k<series.length; k++) {
+        var columns = series[k].columns
+        for (var c=0; c<columns.length; c++) {
+          var ArrayType = ARRAY_TYPES[columns[c].dtype]
+          series[k][columns[c].name] = new ArrayType(buffer,
+            start + columns[c].offset, columns[c].length)
+        }
+        if (pairs) {
+          var data = new Array(series[k].t.length)
+          for (var i=0; i<data.length; i++) {
+            data[i] = [series[k].t[i], series[k].v[i]]
+          }
+          series[k].data = data
+        }
+      }
+      return series
+    }
+
+}
@@ -10,6 +10,7 @@ var defaultChannels = [{description: 'PVDF Sensor',
 			physicalChannel: 1, id:0}]
 var currentSession = {}
 var sessionList = []
+var liveSource = null
 
 export default new Vuex.Store({
 
@@ -22,6 +23,7 @@ export default new Vuex.Store({
     currentData: [],
     dataHistory: [],
     elapsedTime: 0,
+    streamCursor: null,
     bpm: {0:[], 1:[], 2:[]},
     metric: {0:[], 1:[], 2:[]}
   },
@@ -59,6 +61,9 @@ export default new Vuex.Store({
     },
     setCurrentData(state, data) {
       state.currentData = data
+      if (data.length>0 && data[0].cursor) {
+	state.streamCursor = data[0].cursor
+      }
 
       // Update reportable parameters.
       var nChan = data.length
@@ -76,6 +81,9 @@ export default new Vuex.Store({
     setTime(state, data) {
       state.elapsedTime = data
     },
+    resetCursor(state) {
+      state.streamCursor = null
+    },
   },
 
   // ------ ACTIONS ------------------------
@@ -135,7 +143,9 @@ export default new Vuex.Store({
       })
     },
     getHistory(context, data) {
-      api.getHistory('session', data).then(function(resp) {
+      // Whole sessions are big; fetch them as packed binary columns.
+      data.pairs = true
+      api.getHistoryBinary('session', data).then(function(resp) {
 	context.commit('setDataHistory', resp.data)
       })
     },
@@ -143,6 +153,17 @@ export default new Vuex.Store({
       api.streamResource('session', data).then(function(resp) {
 	context.commit('setCurrentData', resp.data)
       })
+    },
+    watchStream(context, data) {
+      // Let the server push new data, rather than polling for it.
+      if (liveSource) { liveSource.close() }
+      liveSource = api.liveResource('session', data, function(series) {
+	context.commit('setCurrentData', series)
+      })
+    },
+    unwatchStream(context) {
+      if (liveSource) { liveSource.close() }
+      liveSource = null
     }
   }
 })